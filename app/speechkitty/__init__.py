@@ -1,5 +1,66 @@
-from .directory import Directory
-from .transcriber import Transcriber
-from .result_parser import Parser
+import importlib
+from typing import TYPE_CHECKING
 
-__all__ = ["Directory", "Transcriber", "Parser"]
+# Classes are imported on first access, so a script that only scans a directory doesn't
+# pay for pandas, boto3 and aiohttp
+_EXPORTS = {
+    "Directory": ".directory",
+    "Transcriber": ".transcriber",
+    "Parser": ".result_parser",
+    "ResultCache": ".result_cache",
+    "Pipeline": ".pipeline",
+    "MetricsRegistry": ".metrics",
+    "JobJournal": ".journal",
+    "RetryPolicy": ".retry",
+    "CircuitBreaker": ".retry",
+    "CircuitOpenError": ".retry",
+    "TransientError": ".retry",
+    "TranscriptStore": ".transcript_store",
+    "SearchIndex": ".search_index",
+    "VoiceDetector": ".vad",
+    "OffsetMap": ".vad",
+}
+
+if TYPE_CHECKING:
+    from .directory import Directory
+    from .transcriber import Transcriber
+    from .result_parser import Parser
+    from .result_cache import ResultCache
+    from .pipeline import Pipeline
+    from .metrics import MetricsRegistry
+    from .journal import JobJournal
+    from .retry import CircuitBreaker, CircuitOpenError, RetryPolicy, TransientError
+    from .transcript_store import TranscriptStore
+    from .search_index import SearchIndex
+    from .vad import OffsetMap, VoiceDetector
+
+__all__ = [
+    "Directory",
+    "Transcriber",
+    "Parser",
+    "ResultCache",
+    "Pipeline",
+    "MetricsRegistry",
+    "JobJournal",
+    "RetryPolicy",
+    "CircuitBreaker",
+    "CircuitOpenError",
+    "TransientError",
+    "TranscriptStore",
+    "SearchIndex",
+    "VoiceDetector",
+    "OffsetMap",
+]
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    # Later lookups don't come here
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
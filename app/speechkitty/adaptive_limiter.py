@@ -0,0 +1,180 @@
+import asyncio
+import collections
+import email.utils
+import time
+from typing import Optional
+
+from .metrics import NullMetrics
+
+# Responses meaning the endpoint is over its capacity
+OVERLOAD_STATUSES = (429, 503)
+
+
+class _Slot:
+    __slots__ = ("started", "status", "retry_after")
+
+    def __init__(self, started: float) -> None:
+        self.started = started
+        self.status: Optional[int] = None
+        self.retry_after: Optional[str] = None
+
+    def observe(self, response) -> None:
+        """Takes status and Retry-After of the response"""
+        self.status = response.status
+        self.retry_after = response.headers.get("Retry-After")
+
+
+class _SlotContext:
+    __slots__ = ("limiter", "slot")
+
+    def __init__(self, limiter: "AdaptiveLimiter") -> None:
+        self.limiter = limiter
+
+    async def __aenter__(self) -> _Slot:
+        self.slot = await self.limiter.acquire()
+        return self.slot
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        timed_out = exc_type is not None and issubclass(exc_type, asyncio.TimeoutError)
+        self.limiter.release(self.slot, timed_out)
+
+
+class _NullSlotContext:
+    __slots__ = ()
+
+    async def __aenter__(self) -> "_NullSlotContext":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        pass
+
+    def observe(self, response) -> None:
+        pass
+
+
+_NULL_SLOT = _NullSlotContext()
+
+
+class NullLimiter:
+    """Limiter that doesn't limit, used when adaptive limits are off"""
+
+    def slot(self) -> _NullSlotContext:
+        return _NULL_SLOT
+
+
+class AdaptiveLimiter:
+    """Limits number of concurrent requests to an endpoint finding the limit on its own:
+    the limit grows by increase every time a full window of requests succeeds, and is
+    multiplied by decrease when the endpoint answers 429 or 503, times out, or when latency
+    rises above target_latency (0 turns latency check off). Requests are held back until
+    the time given by Retry-After.
+
+    Usage:
+        async with limiter.slot() as slot:
+            async with session.get(url) as response:
+                slot.observe(response)"""
+
+    def __init__(
+        self,
+        name: str = "",
+        initial: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 256,
+        increase: float = 1,
+        decrease: float = 0.5,
+        target_latency: float = 0.0,
+        metrics=None,
+    ) -> None:
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.in_flight = 0
+        self._waiters: collections.deque = collections.deque()
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+
+    def slot(self) -> _SlotContext:
+        return _SlotContext(self)
+
+    async def acquire(self) -> _Slot:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            if self.in_flight < max(1, int(self.limit)) and not self._waiters:
+                self.in_flight += 1
+                return _Slot(now)
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Slot may have been taken for us right before the cancellation, pass it on
+                if waiter.done() and not waiter.cancelled() and waiter.result():
+                    self.in_flight -= 1
+                    self._wake()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            # Woken up with the slot already taken for us
+            if waiter.result():
+                return _Slot(loop.time())
+
+    def release(self, slot: _Slot, timed_out: bool = False) -> None:
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.in_flight -= 1
+
+        retry_after = parse_retry_after(slot.retry_after)
+        if retry_after is not None:
+            self._blocked_until = max(self._blocked_until, now + retry_after)
+
+        latency = now - slot.started
+        overloaded = timed_out or slot.status in OVERLOAD_STATUSES
+        slow = self.target_latency > 0 and latency > self.target_latency
+        if overloaded or slow:
+            # Requests started before the last decrease saw the old limit, don't punish twice
+            if slot.started >= self._last_decrease:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+        elif slot.status is not None and slot.status < 400:
+            # Additive increase, a full window of successes adds increase to the limit
+            self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+        self.metrics.set("concurrency_limit", self.limit, endpoint=self.name)
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._blocked_until > asyncio.get_running_loop().time():
+            # Acquire will sleep until the pause is over
+            while self._waiters:
+                waiter = self._waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(False)
+            return
+        while self._waiters and self.in_flight < max(1, int(self.limit)):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
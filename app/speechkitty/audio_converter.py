@@ -1,21 +1,76 @@
 import os
+import shutil
+import struct
+import subprocess
 import tempfile
+import threading
 import traceback
 import warnings
-from pydub import AudioSegment
+from typing import IO, TYPE_CHECKING, Callable, List, Optional, Tuple
+
+from .audio_probe import AudioInfo, AudioProbe
+from .vad import OffsetMap, VoiceDetector
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# NumPy types of PCM samples that legs can be interleaved in
+PCM_DTYPES = {"pcm_u8": "u1", "pcm_s16le": "<i2", "pcm_s32le": "<i4", "pcm_f32le": "<f4"}
 
 
 class AudioConverter:
     def __init__(self, raise_exceptions: bool = False) -> None:
         self.temp_dir = tempfile.gettempdir()
         self.raise_exceptions = raise_exceptions
+        self.audio_probe = AudioProbe()
+
+    @staticmethod
+    def ffmpeg() -> str:
+        from pydub import AudioSegment
+
+        return AudioSegment.converter
+
+    def ogg_command(self, file_path: str, ogg_path: str, info: AudioInfo) -> list:
+        """Returns ffmpeg command line that converts the record into opus in one pass"""
+        command = [self.ffmpeg(), "-nostdin", "-hide_banner", "-loglevel", "error"]
+        command += ["-y", "-i", file_path, "-vn"]
+        # Opus in ogg container is already what we need, so just remux it
+        if info.codec == "opus":
+            command += ["-c:a", "copy"]
+        command += ["-f", "opus", ogg_path]
+        return command
+
+    def ogg_name(self, file_path: str) -> str:
+        return os.path.basename(file_path[:-4]) + ".ogg"
 
-    def to_ogg(self, file_path: str) -> str:
+    def to_ogg(
+        self, file_path: str, info: Optional[AudioInfo] = None, speech: Optional[OffsetMap] = None
+    ) -> str:
+        """Converts the record into opus in the temp directory, only the regions of it in
+        speech if they are given. Returns path to the ogg, empty if conversion failed."""
+        if speech is not None:
+            ogg_path = self.temp_dir + "/" + self.ogg_name(file_path)
+
+            def save(stream: IO[bytes]) -> str:
+                with open(ogg_path, "wb") as f:
+                    shutil.copyfileobj(stream, f)
+                return ogg_path
+
+            return self.to_ogg_stream(file_path, save, info, speech) or ""
         try:
-            fmt = os.path.basename(file_path[-3:]).lower()
-            a = AudioSegment.from_file(file_path, fmt)
-            ogg_path = self.temp_dir + "/" + os.path.basename(file_path[:-4]) + ".ogg"
-            a.export(ogg_path, format="opus")
+            # Metadata obtained by the caller saves reading headers twice
+            if info is None:
+                info = self.audio_probe.probe(file_path)
+            ogg_path = self.temp_dir + "/" + self.ogg_name(file_path)
+            process = subprocess.run(
+                self.ogg_command(file_path, ogg_path, info),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+            if process.returncode != 0:
+                stderr = process.stderr.decode(errors="replace").strip()
+                raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {stderr}")
         except Exception as e:
             if self.raise_exceptions:
                 raise e
@@ -24,9 +79,340 @@ class AudioConverter:
                 return ""
         return ogg_path
 
-    async def to_ogg_async(self, file_path: str) -> str:
-        # pydub is CPU bound / blocking IO, run in executor
+    def to_ogg_stream(
+        self,
+        file_path: str,
+        consumer: Callable[[IO[bytes]], Optional[str]],
+        info: Optional[AudioInfo] = None,
+        speech: Optional[OffsetMap] = None,
+    ) -> Optional[str]:
+        """Converts the record into opus passing ffmpeg output to consumer as a pipe,
+        so nothing is written to disk. If regions of speech are given, only they are fed
+        to ffmpeg. Returns what consumer returns, or None if either conversion or
+        consumer failed."""
+        if speech is not None:
+            return self._pcm_to_ogg_stream(
+                file_path,
+                lambda: self.trimmed_info(file_path, speech),
+                lambda out: self.write_regions(file_path, speech, out),
+                consumer,
+            )
+        process = None
+        # Nobody reads stderr while the consumer reads stdout, a pipe would fill up and
+        # block ffmpeg if it wrote a lot of errors
+        stderr = tempfile.TemporaryFile()
+        try:
+            if info is None:
+                info = self.audio_probe.probe(file_path)
+            process = subprocess.Popen(
+                self.ogg_command(file_path, "pipe:1", info),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+            result = consumer(process.stdout)  # type: ignore
+            # Consumer may stop early, closing the pipe makes ffmpeg quit
+            process.stdout.close()  # type: ignore
+            if result is None:
+                process.kill()
+                process.wait()
+                return None
+            _check_exit(process, stderr)
+        except Exception as e:
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            if self.raise_exceptions:
+                raise e
+            else:
+                warnings.warn(f"Convert error: {file_path} {traceback.format_exc()}")
+                return None
+        finally:
+            if process is not None:
+                process.stdout.close()  # type: ignore
+            stderr.close()
+        return result
+
+    async def to_ogg_async(
+        self, file_path: str, info: Optional[AudioInfo] = None, speech: Optional[OffsetMap] = None
+    ) -> str:
+        # ffmpeg is CPU bound / blocking IO, run in executor
         import asyncio
 
         loop = asyncio.get_running_loop()
-        return await loop.run_in_executor(None, self.to_ogg, file_path)
+        args = (file_path, info) if speech is None else (file_path, info, speech)
+        return await loop.run_in_executor(None, self.to_ogg, *args)
+
+    def pair_info(self, left_path: str, right_path: str) -> AudioInfo:
+        """Returns metadata of the stereo record interleave makes of two legs. Raises
+        ValueError if they aren't mono wavs of the same PCM format."""
+        return self._pcm_legs(left_path, right_path)[1]
+
+    def pcm_samples(self, file_path: str) -> Tuple[AudioInfo, "np.ndarray"]:
+        """Returns metadata of a PCM wav and its samples as an array of (frames, channels)
+        mapped from the file, so they are paged in as they are read and nothing is
+        decoded. Raises ValueError for other records."""
+        import numpy as np
+
+        info, offset, size = self.audio_probe.wav_data(file_path)
+        if info.codec not in PCM_DTYPES:
+            raise ValueError(f"Not a PCM wav: {file_path} ({info.codec})")
+        dtype = np.dtype(PCM_DTYPES[info.codec])
+        frames = size // (dtype.itemsize * info.channels)
+        if not frames:
+            return info, np.zeros((0, info.channels), dtype)
+        shape = (frames, info.channels)
+        return info, np.memmap(file_path, dtype, mode="r", offset=offset, shape=shape)
+
+    def _pcm_legs(self, left_path: str, right_path: str) -> Tuple[List, AudioInfo]:
+        legs, infos = [], []
+        for path in (left_path, right_path):
+            info, samples = self.pcm_samples(path)
+            if info.channels != 1:
+                raise ValueError(f"Not a mono PCM wav: {path} ({info.channels} ch)")
+            legs.append(samples[:, 0])
+            infos.append(info)
+        left, right = infos
+        if (left.codec, left.sample_rate) != (right.codec, right.sample_rate):
+            raise ValueError(f"Legs differ in format: {left_path}, {right_path}")
+        info = AudioInfo(
+            duration_seconds=max(left.duration_seconds, right.duration_seconds),
+            channels=2,
+            sample_rate=left.sample_rate,
+            codec=left.codec,
+            container="pcm",
+            bits_per_sample=left.bits_per_sample,
+        )
+        return legs, info
+
+    def detect_speech(self, file_path: str, detector: VoiceDetector) -> Optional[OffsetMap]:
+        """Returns regions of the record with speech, empty if there's none, or None if
+        the record isn't a PCM wav and has to be sent as it is"""
+        try:
+            info, samples = self.pcm_samples(file_path)
+        except ValueError:
+            return None
+        return OffsetMap.from_frames(detector.detect(samples, info.sample_rate), info.sample_rate)
+
+    def chunks(
+        self,
+        file_path: str,
+        detector: VoiceDetector,
+        chunk_seconds: float,
+        speech: Optional[OffsetMap] = None,
+    ) -> Optional[List[OffsetMap]]:
+        """Splits the record at pauses into chunks of about chunk_seconds. Returns map of
+        every chunk, only of its regions in speech if they are given, or None if the
+        record isn't a PCM wav or is too short to be split."""
+        try:
+            info, samples = self.pcm_samples(file_path)
+        except ValueError:
+            return None
+        cuts = detector.cut_points(samples, info.sample_rate, chunk_seconds)
+        if not cuts:
+            return None
+        bounds = (
+            [0.0] + [cut / info.sample_rate for cut in cuts] + [len(samples) / info.sample_rate]
+        )
+        if speech is None:
+            speech = OffsetMap([(bounds[0], bounds[-1])])
+        chunks = [speech.slice(start, end) for start, end in zip(bounds, bounds[1:])]
+        # Pauses cut out of the speech may leave nothing of a chunk
+        return [chunk for chunk in chunks if chunk.duration > 0]
+
+    def trimmed_info(self, file_path: str, speech: OffsetMap) -> AudioInfo:
+        """Returns metadata of raw PCM write_regions makes of the record"""
+        info = self.audio_probe.wav_data(file_path)[0]
+        return AudioInfo(
+            duration_seconds=speech.duration,
+            channels=info.channels,
+            sample_rate=info.sample_rate,
+            codec=info.codec,
+            container="pcm",
+            bits_per_sample=info.bits_per_sample,
+        )
+
+    def write_regions(
+        self, file_path: str, speech: OffsetMap, out: IO[bytes], chunk_frames: int = 65536
+    ) -> AudioInfo:
+        """Writes raw PCM of the regions of the record one after another"""
+        info, samples = self.pcm_samples(file_path)
+        for start, stop in speech.frames(info.sample_rate):
+            for chunk in range(start, min(stop, len(samples)), chunk_frames):
+                out.write(samples[chunk : min(stop, chunk + chunk_frames)].data.cast("B"))
+        return info
+
+    def trim(self, file_path: str, speech: OffsetMap, suffix: str = ".speech") -> str:
+        """Writes a wav of the regions of the record into the temp directory, named after
+        the record with the suffix. Returns path to it, empty if it failed."""
+        name = os.path.basename(file_path[:-4]) + suffix + ".wav"
+        wav_path = os.path.join(self.temp_dir, name)
+        try:
+            info = self.trimmed_info(file_path, speech)
+            frame_size = _frame_size(info)
+            size = sum(stop - start for start, stop in speech.frames(info.sample_rate))
+            with open(wav_path, "wb") as f:
+                f.write(_wav_header(info, size * frame_size))
+                self.write_regions(file_path, speech, f)
+        except Exception as e:
+            if os.path.exists(wav_path):
+                os.unlink(wav_path)
+            if self.raise_exceptions:
+                raise e
+            else:
+                warnings.warn(f"Convert error: {file_path} {traceback.format_exc()}")
+                return ""
+        return wav_path
+
+    def interleave(
+        self, left_path: str, right_path: str, out: IO[bytes], chunk_frames: int = 65536
+    ) -> AudioInfo:
+        """Writes raw stereo PCM with the left leg in the first channel and the right one in
+        the second, padding the shorter leg with silence. Legs are read through memory
+        maps a chunk at a time, so memory use doesn't depend on their length."""
+        import numpy as np
+
+        (left, right), info = self._pcm_legs(left_path, right_path)
+        silence = 128 if info.codec == "pcm_u8" else 0
+        frames = max(len(left), len(right))
+        buffer = np.empty((min(chunk_frames, frames), 2), left.dtype)
+        for start in range(0, frames, chunk_frames):
+            chunk = buffer[: min(chunk_frames, frames - start)]
+            for channel, leg in enumerate((left, right)):
+                samples = leg[start : start + len(chunk)]
+                chunk[: len(samples), channel] = samples
+                chunk[len(samples) :, channel] = silence
+            out.write(chunk.data.cast("B"))
+        return info
+
+    def pcm_command(self, ogg_path: str, info: AudioInfo) -> list:
+        """Returns ffmpeg command line that encodes raw PCM from stdin into opus"""
+        command = [self.ffmpeg(), "-hide_banner", "-loglevel", "error", "-y"]
+        # Codec name without the pcm_ prefix is the name of the raw format
+        command += ["-f", info.codec[4:], "-ar", str(info.sample_rate)]
+        command += ["-ac", str(info.channels)]
+        command += ["-i", "pipe:0", "-f", "opus", ogg_path]
+        return command
+
+    def pair_to_ogg_stream(
+        self,
+        left_path: str,
+        right_path: str,
+        consumer: Callable[[IO[bytes]], Optional[str]],
+    ) -> Optional[str]:
+        """Interleaves two mono legs into a stereo record and converts it into opus passing
+        ffmpeg output to consumer as a pipe, so neither the stereo wav nor the ogg is
+        written to disk. Returns what consumer returns, or None if either conversion or
+        consumer failed."""
+        return self._pcm_to_ogg_stream(
+            left_path,
+            lambda: self.pair_info(left_path, right_path),
+            lambda out: self.interleave(left_path, right_path, out),
+            consumer,
+        )
+
+    def _pcm_to_ogg_stream(
+        self,
+        file_path: str,
+        get_info: Callable[[], AudioInfo],
+        write: Callable[[IO[bytes]], object],
+        consumer: Callable[[IO[bytes]], Optional[str]],
+    ) -> Optional[str]:
+        """Encodes raw PCM that write produces into opus, passing ffmpeg output on to
+        consumer as a pipe"""
+        process = None
+        feeder = None
+        errors: List[Exception] = []
+        # Same as in to_ogg_stream, errors must not block ffmpeg while output is read
+        stderr = tempfile.TemporaryFile()
+
+        def feed() -> None:
+            try:
+                write(process.stdin)  # type: ignore
+            except BrokenPipeError:
+                # ffmpeg quit, its exit code tells why
+                pass
+            except Exception as e:
+                errors.append(e)
+            finally:
+                try:
+                    process.stdin.close()  # type: ignore
+                except BrokenPipeError:
+                    pass
+
+        try:
+            info = get_info()
+            process = subprocess.Popen(
+                self.pcm_command("pipe:1", info),
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+            )
+            # ffmpeg is fed from another thread while this one passes its output on
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            result = consumer(process.stdout)  # type: ignore
+            process.stdout.close()  # type: ignore
+            if result is None:
+                process.kill()
+                process.wait()
+                return None
+            _check_exit(process, stderr)
+            feeder.join()
+            if errors:
+                raise errors[0]
+        except Exception as e:
+            if process is not None and process.poll() is None:
+                process.kill()
+                process.wait()
+            if self.raise_exceptions:
+                raise e
+            else:
+                warnings.warn(f"Convert error: {file_path} {traceback.format_exc()}")
+                return None
+        finally:
+            if feeder is not None:
+                feeder.join()
+            if process is not None:
+                process.stdout.close()  # type: ignore
+            stderr.close()
+        return result
+
+
+def _check_exit(process: subprocess.Popen, stderr: IO[bytes]) -> None:
+    """Waits for ffmpeg to exit, raises with the errors it wrote to the stderr file if it
+    failed"""
+    if process.wait() != 0:
+        stderr.seek(0)
+        errors = stderr.read().decode(errors="replace").strip()
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {errors}")
+
+
+def _frame_size(info: AudioInfo) -> int:
+    """Returns size in bytes of a frame of PCM in the format of info, known from the codec
+    even if the header had no bits per sample"""
+    import numpy as np
+
+    return info.channels * np.dtype(PCM_DTYPES[info.codec]).itemsize
+
+
+def _wav_header(info: AudioInfo, data_size: int) -> bytes:
+    """Returns header of a wav with data of the size in the PCM format of info"""
+    # WAVE_FORMAT_IEEE_FLOAT for floats, WAVE_FORMAT_PCM for the rest
+    format_tag = 3 if info.codec == "pcm_f32le" else 1
+    block_align = _frame_size(info)
+    fmt = struct.pack(
+        "<HHIIHH",
+        format_tag,
+        info.channels,
+        info.sample_rate,
+        info.sample_rate * block_align,
+        block_align,
+        block_align // info.channels * 8,
+    )
+    return (
+        struct.pack("<4sI4s", b"RIFF", 4 + 8 + len(fmt) + 8 + data_size, b"WAVE")
+        + struct.pack("<4sI", b"fmt ", len(fmt))
+        + fmt
+        + struct.pack("<4sI", b"data", data_size)
+    )
@@ -0,0 +1,278 @@
+import os
+import struct
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+
+@dataclass
+class AudioInfo:
+    """Metadata of an audio record obtained without decoding it"""
+
+    duration_seconds: float
+    channels: int
+    sample_rate: int
+    codec: str
+    container: str
+    bits_per_sample: Optional[int] = None
+
+
+class AudioProbe:
+    """Reads duration, channels, sample rate and codec from RIFF/WAV, OGG and MP3 headers.
+    Falls back to ffprobe only for containers it doesn't recognize."""
+
+    # Bytes read from the tail of an OGG stream to find the last page
+    ogg_tail_size = 65536
+
+    wav_codecs = {
+        0x0001: "pcm",
+        0x0003: "pcm_f",
+        0x0006: "pcm_alaw",
+        0x0007: "pcm_mulaw",
+        0x0011: "adpcm_ima_wav",
+        0x0031: "gsm_ms",
+        0x0055: "mp3",
+    }
+
+    mp3_bitrates = {
+        # (version_is_mpeg1, layer): kbps by index 1..14
+        (True, 1): [32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+        (True, 2): [32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+        (True, 3): [32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+        (False, 1): [32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+        (False, 2): [8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+        (False, 3): [8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    }
+    mp3_sample_rates = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+    def probe(self, file_path: str) -> AudioInfo:
+        """Returns metadata of the audio record. Raises FileNotFoundError if there's no file
+        and ValueError if the format can't be recognized."""
+        with open(file_path, "rb") as f:
+            head = f.read(4096)
+            file_size = os.fstat(f.fileno()).st_size
+            info = None
+            if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+                info = self._probe_wav(f)
+            elif head[:4] == b"OggS":
+                info = self._probe_ogg(f, head, file_size)
+            elif head[:3] == b"ID3" or (
+                len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0
+            ):
+                info = self._probe_mp3(f, file_size)
+        if info is None:
+            info = self._probe_ffprobe(file_path)
+        return info
+
+    async def probe_async(self, file_path: str) -> AudioInfo:
+        # Reading headers is cheap, but the storage may be slow, run in executor
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.probe, file_path)
+
+    def wav_data(self, file_path: str) -> Tuple[AudioInfo, int, int]:
+        """Returns metadata of a wav record with offset and size of its samples in the
+        file. Raises ValueError if the file isn't a wav that can be read."""
+        with open(file_path, "rb") as f:
+            head = f.read(12)
+            chunks = None
+            if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+                chunks = self._wav_chunks(f)
+        info = self._wav_info(*chunks) if chunks is not None else None
+        if info is None:
+            raise ValueError(f"Not a wav record: {file_path}")
+        return info, chunks[1], chunks[2]  # type: ignore
+
+    def _probe_wav(self, f) -> Optional[AudioInfo]:
+        chunks = self._wav_chunks(f)
+        return self._wav_info(*chunks) if chunks is not None else None
+
+    def _wav_chunks(self, f) -> Optional[Tuple[bytes, int, int]]:
+        """Returns fmt chunk, offset and size of data chunk"""
+        f.seek(12)
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                if len(fmt) < 16:
+                    return None
+                if chunk_size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if fmt is None:
+                    return None
+                data_start = f.tell()
+                file_size = os.fstat(f.fileno()).st_size
+                # Recorders that are still writing or streamed wavs leave size unset
+                if chunk_size in (0, 0xFFFFFFFF) or data_start + chunk_size > file_size:
+                    chunk_size = file_size - data_start
+                return fmt, data_start, chunk_size
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    def _wav_info(self, fmt: bytes, data_start: int, chunk_size: int) -> Optional[AudioInfo]:
+        audio_format, channels, sample_rate, byte_rate, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+        # WAVE_FORMAT_EXTENSIBLE keeps actual format in the first bytes of SubFormat GUID
+        if audio_format == 0xFFFE and len(fmt) >= 26:
+            audio_format = struct.unpack("<H", fmt[24:26])[0]
+        if not byte_rate or not channels:
+            return None
+
+        codec = self.wav_codecs.get(audio_format, f"wav_0x{audio_format:04x}")
+        if codec == "pcm":
+            codec = "pcm_u8" if bits == 8 else f"pcm_s{bits}le"
+        elif codec == "pcm_f":
+            codec = f"pcm_f{bits}le"
+
+        return AudioInfo(
+            duration_seconds=chunk_size / byte_rate,
+            channels=channels,
+            sample_rate=sample_rate,
+            codec=codec,
+            container="wav",
+            bits_per_sample=bits or None,
+        )
+
+    def _probe_ogg(self, f, head: bytes, file_size: int) -> Optional[AudioInfo]:
+        # Page header is 27 bytes followed by the segment table
+        if len(head) < 28:
+            return None
+        serial = head[14:18]
+        n_segments = head[26]
+        packet = head[27 + n_segments :]
+
+        if packet[:8] == b"OpusHead" and len(packet) >= 16:
+            channels, pre_skip, input_rate = struct.unpack("<BHI", packet[9:16])
+            codec, rate, skip = "opus", 48000, pre_skip
+            # Opus always decodes at 48 kHz, input rate is informational
+            sample_rate = input_rate or rate
+        elif packet[:7] == b"\x01vorbis" and len(packet) >= 16:
+            channels, rate = struct.unpack("<BI", packet[11:16])
+            codec, skip, sample_rate = "vorbis", 0, rate
+        else:
+            return None
+
+        granule = self._ogg_last_granule(f, serial, file_size)
+        if granule is None or not rate:
+            return None
+
+        return AudioInfo(
+            duration_seconds=max(granule - skip, 0) / rate,
+            channels=channels,
+            sample_rate=sample_rate,
+            codec=codec,
+            container="ogg",
+        )
+
+    def _ogg_last_granule(self, f, serial: bytes, file_size: int) -> Optional[int]:
+        tail_size = min(self.ogg_tail_size, file_size)
+        f.seek(file_size - tail_size)
+        tail = f.read(tail_size)
+        pos = len(tail)
+        while True:
+            pos = tail.rfind(b"OggS", 0, pos)
+            if pos < 0 or pos + 27 > len(tail):
+                return None
+            granule = struct.unpack("<q", tail[pos + 6 : pos + 14])[0]
+            # Granule position of -1 means no packet finishes on the page
+            if tail[pos + 14 : pos + 18] == serial and granule >= 0:
+                return granule
+
+    def _probe_mp3(self, f, file_size: int) -> Optional[AudioInfo]:
+        f.seek(0)
+        start = 0
+        head = f.read(10)
+        if head[:3] == b"ID3" and len(head) == 10:
+            # Tag size is a 28-bit synchsafe integer
+            size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+            start = 10 + size + (10 if head[5] & 0x10 else 0)
+
+        f.seek(start)
+        buf = f.read(8192)
+        offset = 0
+        while True:
+            offset = buf.find(b"\xff", offset)
+            if offset < 0 or offset + 4 > len(buf):
+                return None
+            header = self._parse_mp3_header(buf[offset : offset + 4])
+            if header is not None:
+                break
+            offset += 1
+
+        version, layer, bitrate, sample_rate, channels, samples_per_frame = header
+        frame = buf[offset:]
+        frames = None
+        # Xing/Info header of VBR files is located after side information
+        if version == 3:
+            side_info = 17 if channels == 1 else 32
+        else:
+            side_info = 9 if channels == 1 else 17
+        xing = frame[4 + side_info : 4 + side_info + 12]
+        if xing[:4] in (b"Xing", b"Info") and len(xing) >= 12:
+            flags = struct.unpack(">I", xing[4:8])[0]
+            if flags & 0x1:
+                frames = struct.unpack(">I", xing[8:12])[0]
+        elif frame[36:40] == b"VBRI" and len(frame) >= 54:
+            frames = struct.unpack(">I", frame[50:54])[0]
+
+        if frames:
+            duration = frames * samples_per_frame / sample_rate
+        else:
+            audio_size = file_size - start - offset
+            f.seek(max(file_size - 128, 0))
+            if f.read(3) == b"TAG":
+                audio_size -= 128
+            duration = audio_size * 8 / (bitrate * 1000)
+
+        return AudioInfo(
+            duration_seconds=duration,
+            channels=channels,
+            sample_rate=sample_rate,
+            codec=f"mp{layer}",
+            container="mp3",
+        )
+
+    def _parse_mp3_header(self, data: bytes) -> Optional[tuple]:
+        b1, b2, b3 = data[1], data[2], data[3]
+        if b1 & 0xE0 != 0xE0:
+            return None
+        version = (b1 >> 3) & 0x3  # 3 - MPEG1, 2 - MPEG2, 0 - MPEG2.5
+        layer = 4 - ((b1 >> 1) & 0x3)  # 1, 2 or 3
+        bitrate_index = b2 >> 4
+        rate_index = (b2 >> 2) & 0x3
+        if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+            return None
+        bitrate = self.mp3_bitrates[(version == 3, layer)][bitrate_index - 1]
+        sample_rate = self.mp3_sample_rates[version][rate_index]
+        channels = 1 if (b3 >> 6) == 3 else 2
+        if layer == 1:
+            samples_per_frame = 384
+        elif layer == 3 and version != 3:
+            samples_per_frame = 576
+        else:
+            samples_per_frame = 1152
+        return version, layer, bitrate, sample_rate, channels, samples_per_frame
+
+    def _probe_ffprobe(self, file_path: str) -> AudioInfo:
+        from pydub.utils import mediainfo_json
+
+        info = mediainfo_json(file_path)
+        streams = [s for s in info.get("streams", []) if s.get("codec_type") == "audio"]
+        if not streams:
+            raise ValueError(f"No audio stream found: {file_path}")
+        stream = streams[0]
+        duration = stream.get("duration") or info.get("format", {}).get("duration") or 0
+        return AudioInfo(
+            duration_seconds=float(duration),
+            channels=int(stream.get("channels", 0)),
+            sample_rate=int(stream.get("sample_rate", 0)),
+            codec=stream.get("codec_name", ""),
+            container=info.get("format", {}).get("format_name", ""),
+            bits_per_sample=(
+                int(stream["bits_per_sample"]) if stream.get("bits_per_sample") else None
+            ),
+        )
@@ -1,8 +1,10 @@
 import os
+import threading
 import traceback
 import warnings
-import boto3
-from typing import Optional
+from typing import Dict, Optional
+
+from .retry import NO_RETRY, CircuitBreaker, RetryPolicy, TransientError
 
 
 class CloudStorage:
@@ -16,19 +18,55 @@ class CloudStorage:
         aws_secret_access_key: str,
         bucket_name: str,
         raise_exceptions: bool = False,
+        max_pool_connections: int = 32,
+        retries: Optional[Dict[str, RetryPolicy]] = None,
+        breaker: Optional[CircuitBreaker] = None,
     ) -> None:
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
         self.bucket_name = bucket_name
         self.raise_exceptions = raise_exceptions
+        # Default executor of asyncio runs up to 32 threads
+        self.max_pool_connections = max_pool_connections
+        self._client = None
+        self._client_lock = threading.Lock()
+        # Putting and deleting the same key again is safe to repeat
+        self.retries = {"upload": RetryPolicy(), "delete": RetryPolicy()}
+        self.retries.update(retries or {})
+        # Uploads are stopped while the storage keeps failing, deletes are cleanup and
+        # are always tried
+        self.breaker = breaker if breaker is not None else CircuitBreaker("storage")
+
+    def new_client(self):
+        # boto3 takes a while to import, workers that don't upload shouldn't wait for it
+        import boto3
+        from botocore.config import Config
 
-    def get_client(self):
         session = boto3.session.Session(
             region_name=self.region_name,
             aws_access_key_id=self.aws_access_key_id,
             aws_secret_access_key=self.aws_secret_access_key,
         )
-        return session.client(service_name="s3", endpoint_url=self.storage_endpoint)
+        return session.client(
+            service_name="s3",
+            endpoint_url=self.storage_endpoint,
+            config=Config(max_pool_connections=self.max_pool_connections),
+        )
+
+    def get_client(self):
+        """Returns client shared by all calls. It's created on first use, and since boto3
+        clients are thread-safe, it's reused by executor threads of async methods keeping
+        connections to the storage alive."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.new_client()
+        return self._client
+
+    def reset_client(self) -> None:
+        """Drops shared client, for instance after changing credentials or endpoint"""
+        with self._client_lock:
+            self._client = None
 
     def upload_file(self, file_path: str, client=None) -> Optional[str]:
         file_name = os.path.basename(file_path)
@@ -36,7 +74,11 @@ class CloudStorage:
         if not client:
             client = self.get_client()
         try:
-            client.upload_file(file_path, self.bucket_name, file_name)
+            self.retries.get("upload", NO_RETRY).call(
+                client.upload_file, file_path, self.bucket_name, file_name, breaker=self.breaker
+            )
+        except TransientError:
+            raise
         except Exception as e:
             if self.raise_exceptions:
                 raise e
@@ -45,12 +87,35 @@ class CloudStorage:
                 return None
         return file_link
 
+    def upload_stream(self, fileobj, file_name: str, client=None) -> Optional[str]:
+        """Uploads data read from a file-like object, for instance a pipe. Data is sent
+        in multipart chunks as it's being read, so it doesn't have to fit into memory."""
+        file_link = f"{self.storage_base_url}/{self.bucket_name}/{file_name}"
+        if not client:
+            client = self.get_client()
+        try:
+            # Data read from a pipe can't be sent again, so there's a single attempt
+            NO_RETRY.call(
+                client.upload_fileobj, fileobj, self.bucket_name, file_name, breaker=self.breaker
+            )
+        except TransientError:
+            raise
+        except Exception as e:
+            if self.raise_exceptions:
+                raise e
+            else:
+                warnings.warn(f"Upload error: {file_name} {traceback.format_exc()}")
+                return None
+        return file_link
+
     def delete_file(self, file_path: str, client=None) -> None:
         if not client:
             client = self.get_client()
         try:
             for_deletion = [{"Key": os.path.basename(file_path)}]
-            client.delete_objects(Bucket=self.bucket_name, Delete={"Objects": for_deletion})
+            self.retries.get("delete", NO_RETRY).call(
+                client.delete_objects, Bucket=self.bucket_name, Delete={"Objects": for_deletion}
+            )
         except Exception as e:
             if self.raise_exceptions:
                 raise e
@@ -1,15 +1,28 @@
 import os
 import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .scan_index import ScanIndex
 
 
 class Directory:
     """Scans directory for files"""
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, index_path: str = "") -> None:
         self.directory = path
+        # Optional SQLite file to keep listings between runs,
+        # better placed outside of the scanned directory
+        self.index_path = index_path
 
     def walk_dir(self) -> list:
         """Returns list of paths of all files in a directory and its subdirectories"""
+        if self.index_path:
+            with ScanIndex(self.index_path) as index:
+                return [
+                    os.path.join(path, name)
+                    for path, files in index.walk(self.directory)
+                    for name, _, _ in files
+                ]
         paths = []
         for path, subdirs, files in os.walk(self.directory):
             for name in files:
@@ -34,8 +47,99 @@ class Directory:
             wavs_paths = [f for f in paths if re.search(incl, f)]
 
         if skip_processed:
-            processed = [f[:-5] for f in paths if f[-5:] == ".json"]
+            processed = {f[:-5] for f in paths if f[-5:] == ".json"}
             output = [f for f in wavs_paths if f[:-4] not in processed]
             return output
         else:
             return wavs_paths
+
+    def iter_records(
+        self,
+        regexp_include: str = "^.+\\.(:?wav|mp3|wma|aac|ogg)$",
+        regexp_exclude: str = "",
+        skip_processed: bool = False,
+        extensions: Optional[Tuple[str, ...]] = None,
+        dir_include: str = "",
+        dir_exclude: str = "",
+    ) -> Iterator[os.DirEntry]:
+        """Yields entries of files matching given regex expressions while scanning a directory
+        and its subdirectories, so the caller can start working before the scan is over.
+
+        Entries cache their stat() result, so size and mtime don't cost extra calls.
+        Files whose names don't end with one of extensions (case insensitive) are dropped
+        before running regular expressions. Subdirectories whose paths don't match
+        dir_include or match dir_exclude are not descended into."""
+        incl = re.compile(regexp_include)
+        excl = re.compile(regexp_exclude) if regexp_exclude else None
+        dir_incl = re.compile(dir_include) if dir_include else None
+        dir_excl = re.compile(dir_exclude) if dir_exclude else None
+        if extensions:
+            extensions = tuple(e.lower() for e in extensions)
+
+        stack = [self.directory]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+
+            subdirs, files = [], []
+            for entry in entries:
+                try:
+                    # Same as os.walk, symlinks to directories aren't followed
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subdirs.append(entry)
+                        continue
+                except OSError:
+                    continue
+                files.append(entry)
+
+            # Results are written next to the records, so looking into the same directory is enough
+            processed = set()
+            if skip_processed:
+                processed = {e.path[:-5] for e in files if e.name[-5:] == ".json"}
+
+            for entry in files:
+                if extensions and not entry.name.lower().endswith(extensions):
+                    continue
+                if not incl.search(entry.path) or (excl and excl.search(entry.path)):
+                    continue
+                if skip_processed and entry.path[:-4] in processed:
+                    continue
+                yield entry
+
+            for entry in reversed(subdirs):
+                if dir_incl and not dir_incl.search(entry.path):
+                    continue
+                if dir_excl and dir_excl.search(entry.path):
+                    continue
+                stack.append(entry.path)
+
+    def get_pairs(
+        self,
+        left_suffix: str = ".wav-in",
+        right_suffix: str = ".wav-out",
+        extension: str = ".wav",
+        skip_processed: bool = False,
+    ) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        """Returns (record_path, left_path, right_path) for calls whose legs were recorded
+        into separate files named record_path with a suffix, like call.wav-in.wav and
+        call.wav-out.wav for call.wav. A leg that wasn't found is None. Calls that already
+        have the merged json next to record_path are skipped if skip_processed is set."""
+        pairs: Dict[str, List[Optional[str]]] = {}
+        suffixes = ((left_suffix + extension, 0), (right_suffix + extension, 1))
+        for entry in self.iter_records(".", extensions=(extension,)):
+            for suffix, leg in suffixes:
+                if entry.name.endswith(suffix):
+                    record_path = entry.path[: -len(suffix)] + extension
+                    pairs.setdefault(record_path, [None, None])[leg] = entry.path
+                    break
+        if skip_processed:
+            pairs = {
+                path: legs
+                for path, legs in pairs.items()
+                if not os.path.exists(path[: -len(extension)] + ".json")
+            }
+        return [(path, left, right) for path, (left, right) in sorted(pairs.items())]
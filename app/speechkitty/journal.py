@@ -0,0 +1,87 @@
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+# States in the order files pass them
+STATES = ["probed", "converted", "uploaded", "submitted", "done", "failed"]
+# Everything the previous run has paid for is kept from these states on
+RESUMABLE_STATES = ["converted", "uploaded", "submitted"]
+FIELDS = ["delay", "ogg_path", "ogg_link", "object_key", "operation_id", "submitted_at", "error"]
+
+
+class JobJournal:
+    """Persistent record of the state of every file being transcribed, so that a run that
+    crashed or was stopped can resume files from the last completed stage, above all keep
+    polling operations that were already submitted instead of submitting them again.
+
+    SQLite database in WAL mode, safe to use from executor threads."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # Commit survives a crash of the process, which is what we need, and is much faster
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "path TEXT PRIMARY KEY, state TEXT NOT NULL, delay REAL NOT NULL DEFAULT 0, "
+            "ogg_path TEXT NOT NULL DEFAULT '', ogg_link TEXT NOT NULL DEFAULT '', "
+            "object_key TEXT NOT NULL DEFAULT '', operation_id TEXT NOT NULL DEFAULT '', "
+            "submitted_at REAL NOT NULL DEFAULT 0, error TEXT NOT NULL DEFAULT '', "
+            "updated_at REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state)")
+        self.connection.commit()
+
+    def record(self, path: str, state: str, **fields) -> None:
+        """Sets state of the file along with the fields given. Fields of previous states are
+        kept, except for probed, which starts a new run of the file."""
+        if state not in STATES:
+            raise ValueError(f"Unknown state: {state}")
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+        if state == "submitted" and "submitted_at" not in fields:
+            fields["submitted_at"] = time.time()
+        with self._lock:
+            if state == "probed":
+                self.connection.execute("DELETE FROM jobs WHERE path = ?", (path,))
+            names = ["path", "state", "updated_at"] + list(fields)
+            values = [path, state, time.time()] + list(fields.values())
+            updates = ", ".join(f"{name} = excluded.{name}" for name in names[1:])
+            self.connection.execute(
+                f"INSERT INTO jobs ({', '.join(names)}) VALUES ({', '.join('?' * len(names))}) "
+                f"ON CONFLICT(path) DO UPDATE SET {updates}",
+                values,
+            )
+            self.connection.commit()
+
+    def get(self, path: str) -> Optional[dict]:
+        with self._lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE path = ?", (path,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def pending(self) -> List[dict]:
+        """Returns files that can be resumed, submitted ones first"""
+        placeholders = ", ".join("?" * len(RESUMABLE_STATES))
+        with self._lock:
+            rows = self.connection.execute(
+                f"SELECT * FROM jobs WHERE state IN ({placeholders}) "
+                "ORDER BY state = 'submitted' DESC, updated_at",
+                RESUMABLE_STATES,
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            ).fetchall()
+        return {state: count for state, count in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
@@ -0,0 +1,207 @@
+import bisect
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Seconds, from quick header reads to long SpeechKit operations
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NullTimer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class NullMetrics:
+    """Metrics that are not recorded, used when instrumentation is off"""
+
+    enabled = False
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        pass
+
+    def set(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        pass
+
+    def timer(self, name: str, **labels) -> _NullTimer:
+        return _NULL_TIMER
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics: "MetricsRegistry", name: str, labels: dict) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class JsonLinesSink:
+    """Appends every recorded value to a file as a JSON line"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def emit(self, kind: str, name: str, value: float, labels: dict) -> None:
+        line = json.dumps(
+            {"ts": time.time(), "type": kind, "name": name, "labels": labels, "value": value},
+            ensure_ascii=False,
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class MetricsRegistry:
+    """Keeps counters, gauges and histograms in process and passes every recorded value
+    on to sinks. Values are labeled by keyword arguments, e.g. observe("stage_seconds",
+    1.5, stage="convert"). Contents can be exposed in Prometheus text format."""
+
+    enabled = True
+
+    def __init__(
+        self, sinks: Optional[list] = None, buckets=DEFAULT_BUCKETS, prefix: str = "speechkitty_"
+    ) -> None:
+        self.sinks = sinks or []
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.gauges: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], _Histogram] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._emit("counter", name, value, labels)
+
+    def set(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+        self._emit("gauge", name, value, labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        # Index of the first bucket the value fits in, len(buckets) means +Inf
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+        self._emit("histogram", name, value, labels)
+
+    def timer(self, name: str, **labels) -> _Timer:
+        return _Timer(self, name, labels)
+
+    def _emit(self, kind: str, name: str, value: float, labels: dict) -> None:
+        for sink in self.sinks:
+            sink.emit(kind, name, value, labels)
+
+    def get(self, name: str, **labels) -> Optional[float]:
+        """Returns value of the counter or gauge, or count of the histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        if key in self.counters:
+            return self.counters[key]
+        if key in self.gauges:
+            return self.gauges[key]
+        if key in self.histograms:
+            return self.histograms[key].count
+        return None
+
+    def to_prometheus(self) -> str:
+        """Returns metrics in Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            for kind, values in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {self.prefix}{name} {kind}")
+                    for (key_name, labels), value in sorted(values.items()):
+                        if key_name == name:
+                            lines.append(f"{self.prefix}{name}{_labels(labels)} {_number(value)}")
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {self.prefix}{name} histogram")
+                for (key_name, labels), histogram in sorted(
+                    self.histograms.items(), key=lambda item: item[0]
+                ):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + (math.inf,), histogram.counts):
+                        cumulative += count
+                        bucket_labels = labels + (("le", _number(bound)),)
+                        lines.append(
+                            f"{self.prefix}{name}_bucket{_labels(bucket_labels)} {cumulative}"
+                        )
+                    lines.append(
+                        f"{self.prefix}{name}_sum{_labels(labels)} {_number(histogram.sum)}"
+                    )
+                    lines.append(f"{self.prefix}{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes metrics for the textfile collector of node_exporter. File is replaced
+        atomically, so the collector never reads it half-written."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(temp_path, path)
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
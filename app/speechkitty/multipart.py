@@ -0,0 +1,120 @@
+import os
+import uuid
+from typing import IO, AsyncGenerator, Iterator, Optional
+
+
+class MultipartFileBody:
+    """multipart/form-data body with a single file field, read from disk chunk by chunk.
+
+    Works as a file-like object, provides chunks() for requests and an async iterator for
+    aiohttp, either way only one chunk of the file is held in memory. Length is known in
+    advance, so the request is sent with Content-Length rather than chunked."""
+
+    def __init__(
+        self,
+        file_path: str,
+        field_name: str = "audio",
+        chunk_size: int = 64 * 1024,
+        file_content_type: str = "application/octet-stream",
+    ) -> None:
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.boundary = uuid.uuid4().hex
+        file_name = os.path.basename(file_path).replace('"', "%22")
+        self.preamble = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{file_name}"\r\n'
+            f"Content-Type: {file_content_type}\r\n\r\n"
+        ).encode()
+        self.epilogue = f"\r\n--{self.boundary}--\r\n".encode()
+        self.file_size = os.path.getsize(file_path)
+        self._position = 0
+        self._file: Optional[IO[bytes]] = None
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self.preamble) + self.file_size + len(self.epilogue)
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        if size is None or size < 0:
+            size = len(self)
+        chunks = []
+        while size > 0:
+            chunk = self._read_part(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _read_part(self, size: int) -> bytes:
+        position = self._position
+        file_end = len(self.preamble) + self.file_size
+        if position < len(self.preamble):
+            chunk = self.preamble[position : position + size]
+        elif position < file_end:
+            if self._file is None:
+                self._file = open(self.file_path, "rb")
+            chunk = self._file.read(min(size, file_end - position))
+            if not chunk:
+                raise IOError(f"File is shorter than expected: {self.file_path}")
+            if position + len(chunk) == file_end:
+                self.close()
+        else:
+            offset = position - file_end
+            chunk = self.epilogue[offset : offset + size]
+        self._position += len(chunk)
+        return chunk
+
+    def chunks(self) -> "SizedChunks":
+        """Returns the body for requests, sent in chunks of chunk_size. http.client reads
+        file-like bodies in blocks of its own size instead."""
+        return SizedChunks(self)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self) -> "MultipartFileBody":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    async def iter_chunks_async(self) -> AsyncGenerator[bytes, None]:
+        """Yields the body reading the file in executor, so the event loop keeps running
+        between chunks. File is closed when iteration ends or the generator is closed."""
+        import aiofiles
+
+        yield self.preamble
+        remaining = self.file_size
+        async with aiofiles.open(self.file_path, "rb") as f:
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise IOError(f"File is shorter than expected: {self.file_path}")
+                remaining -= len(chunk)
+                yield chunk
+        yield self.epilogue
+
+
+class SizedChunks:
+    """Iterable over chunks of a body with the length of the body, so requests sends it
+    with Content-Length rather than chunked"""
+
+    def __init__(self, body: MultipartFileBody) -> None:
+        self.body = body
+
+    def __len__(self) -> int:
+        return len(self.body)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.body.read(self.body.chunk_size)
+            if not chunk:
+                return
+            yield chunk
@@ -0,0 +1,160 @@
+import asyncio
+import heapq
+import itertools
+from typing import Optional
+
+import aiohttp
+
+from .metrics import NullMetrics
+from .retry import CircuitOpenError
+
+
+class _Operation:
+    __slots__ = ("id", "session", "future", "attempts", "created")
+
+    def __init__(
+        self, id: str, session: aiohttp.ClientSession, future: asyncio.Future, created: float
+    ) -> None:
+        self.id = id
+        self.session = session
+        self.future = future
+        self.attempts = 0
+        self.created = created
+
+
+class OperationPoller:
+    """Polls all pending SpeechKit operations from one place.
+
+    Operations are kept in a heap ordered by the time of their next poll, polls are
+    issued no faster than max_rps per second in total, and the caller of wait() gets
+    the result once its operation is done. Nothing is held by the caller while it waits,
+    so the number of jobs in flight isn't limited by the number of polling loops."""
+
+    def __init__(
+        self,
+        speech_service,
+        max_rps: float = 10.0,
+        interval: float = 3.0,
+        max_attempts: int = 10,
+        metrics=None,
+    ) -> None:
+        self.speech_service = speech_service
+        self.max_rps = max_rps
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self._waiting = 0
+        self._heap: list = []
+        self._counter = itertools.count()
+        self._polling: set = set()
+        self._next_slot = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        """Number of operations waiting for the result"""
+        return len(self._heap) + len(self._polling)
+
+    async def wait(self, id: str, session: aiohttp.ClientSession, delay: float = 0.0):
+        """Waits for operation to finish polling it first after delay seconds.
+        Returns the result or None if there was an error or it took too many attempts."""
+        loop = asyncio.get_running_loop()
+        operation = _Operation(id, session, loop.create_future(), loop.time())
+        self._schedule(operation, loop.time() + delay)
+        self._waiting += 1
+        self.metrics.set("operations_in_flight", self._waiting)
+        try:
+            return await operation.future
+        finally:
+            self._waiting -= 1
+            self.metrics.set("operations_in_flight", self._waiting)
+
+    def _schedule(self, operation: _Operation, deadline: float) -> None:
+        if self._task is not None and self._task.get_loop() is not asyncio.get_running_loop():
+            # Operations left by a closed event loop will never be polled
+            self._heap, self._polling, self._task = [], set(), None
+        heapq.heappush(self._heap, (deadline, next(self._counter), operation))
+        # The loop stops when there's nothing to poll, start it again on demand
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        else:
+            self._wakeup.set()  # type: ignore
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        wakeup = self._wakeup
+        assert wakeup is not None
+        while self._heap or self._polling:
+            now = loop.time()
+            timeout = None
+            if self._heap:
+                # Respect both the deadline of the earliest operation and the rate budget
+                timeout = max(self._heap[0][0], self._next_slot) - now
+            if timeout is None or timeout > 0:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, operation = heapq.heappop(self._heap)
+            # Caller is gone, don't waste a request
+            if operation.future.done():
+                continue
+            self._next_slot = max(now, self._next_slot) + 1.0 / self.max_rps
+            task = asyncio.ensure_future(self._poll(operation))
+            self._polling.add(task)
+            task.add_done_callback(self._polled)
+
+    def _polled(self, task: asyncio.Task) -> None:
+        self._polling.discard(task)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _poll(self, operation: _Operation) -> None:
+        try:
+            result = await self.speech_service.get_yandex_result_async(
+                operation.id, operation.session
+            )
+        except CircuitOpenError as e:
+            # Operation keeps running, poll it again once the endpoint may be back
+            loop = asyncio.get_running_loop()
+            operation.attempts += 1
+            if operation.attempts >= self.max_attempts and not operation.future.done():
+                operation.future.set_exception(e)
+            else:
+                heapq.heappush(
+                    self._heap, (loop.time() + e.retry_in, next(self._counter), operation)
+                )
+            return
+        except Exception as e:
+            if not operation.future.done():
+                operation.future.set_exception(e)
+            return
+        if operation.future.done():
+            return
+        loop = asyncio.get_running_loop()
+        if operation.attempts == 0:
+            self.metrics.observe(
+                "stage_seconds", loop.time() - operation.created, stage="first_poll"
+            )
+        # If there's an error, stop trying
+        if result is None or result.get("done", False):
+            self._resolve(operation, result)
+            return
+        operation.attempts += 1
+        if operation.attempts >= self.max_attempts:
+            self._resolve(operation, None)
+            return
+        self.metrics.inc("retries_total", stage="poll")
+        heapq.heappush(self._heap, (loop.time() + self.interval, next(self._counter), operation))
+
+    def _resolve(self, operation: _Operation, result) -> None:
+        loop = asyncio.get_running_loop()
+        self.metrics.observe("stage_seconds", loop.time() - operation.created, stage="poll")
+        if result is None:
+            self.metrics.inc("errors_total", stage="poll")
+        operation.future.set_result(result)
@@ -0,0 +1,297 @@
+from __future__ import annotations
+import asyncio
+import os
+import traceback
+import warnings
+import aiohttp
+
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from .audio_probe import AudioInfo
+from .retry import TransientError
+from .transcriber import Transcriber
+from .vad import OffsetMap
+
+STAGES = ["probe", "convert", "upload", "submit", "poll", "persist"]
+
+
+class Job:
+    __slots__ = (
+        "wav_path",
+        "info",
+        "key",
+        "cached",
+        "ogg_path",
+        "ogg_link",
+        "object_key",
+        "id",
+        "delay",
+        "result",
+        "deferred",
+        "speech",
+    )
+
+    def __init__(self, wav_path: str) -> None:
+        self.wav_path = wav_path
+        self.info: Optional[AudioInfo] = None
+        self.key = ""
+        self.cached = False
+        self.ogg_path = ""
+        self.ogg_link: Optional[str] = None
+        self.object_key = ""
+        self.id = ""
+        self.delay = 0.0
+        self.result = None
+        self.deferred = False
+        self.speech: Optional[OffsetMap] = None
+
+
+class Pipeline:
+    """Transcribes files passing them through stages connected by bounded queues:
+    probe -> convert -> upload -> submit -> poll -> persist.
+
+    Every stage has its own number of workers, so ffmpeg can be given as many workers as
+    there are CPUs while uploads and API calls run with their own limits, and the next file
+    is converted while the current one is being uploaded. A full queue blocks the stage
+    feeding it, which in turn stops reading new files. Probe, convert and upload run in the
+    default executor of the event loop, see executor_workers.
+
+    on_result is awaited in the persist stage with the path and the result, which is None
+    if the file wasn't transcribed. Counts of files with and without result are kept in
+    transcribed and failed.
+
+    Files are deferred instead when an endpoint they need is failing, that is its circuit
+    is open or a call to it kept failing with a transient error through all retries
+    (TransientError): they are counted in deferred, not passed to on_result, and left for
+    the next run."""
+
+    def __init__(
+        self,
+        transcriber: Transcriber,
+        on_result: Optional[Callable[[str, Optional[dict]], Awaitable[None]]] = None,
+        probe_workers: int = 2,
+        convert_workers: int = 0,
+        upload_workers: int = 4,
+        submit_workers: int = 4,
+        poll_workers: int = 256,
+        persist_workers: int = 2,
+        queue_size: int = 0,
+    ) -> None:
+        self.transcriber = transcriber
+        self.on_result = on_result
+        self.workers = {
+            "probe": probe_workers,
+            "convert": convert_workers or os.cpu_count() or 1,
+            "upload": upload_workers,
+            "submit": submit_workers,
+            "poll": poll_workers,
+            "persist": persist_workers,
+        }
+        # By default every stage may have one job waiting per worker
+        self.queue_size = queue_size
+        self.processed = dict.fromkeys(STAGES, 0)
+        self.transcribed = 0
+        self.failed = 0
+        self.deferred = 0
+
+    @property
+    def executor_workers(self) -> int:
+        """Number of threads needed for the blocking stages not to wait for each other"""
+        return self.workers["probe"] + self.workers["convert"] + self.workers["upload"]
+
+    async def run(
+        self, paths: Iterable[str], session: aiohttp.ClientSession, s3_client=None
+    ) -> None:
+        self.session = session
+        self.s3_client = s3_client
+        self.queues: Dict[str, asyncio.Queue] = {
+            stage: asyncio.Queue(self.queue_size or self.workers[stage]) for stage in STAGES
+        }
+        workers: List[asyncio.Task] = []
+        for stage in STAGES:
+            handler = getattr(self, f"_{stage}")
+            for _ in range(self.workers[stage]):
+                workers.append(asyncio.create_task(self._work(stage, handler)))
+        try:
+            for path in paths:
+                await self._put("probe", Job(path))
+            # Jobs only move forward, so once a queue is drained nothing enters it again
+            for stage in STAGES:
+                await self.queues[stage].join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _work(self, stage: str, handler) -> None:
+        queue = self.queues[stage]
+        while True:
+            job = await queue.get()
+            self.transcriber.metrics.set("queue_depth", queue.qsize(), stage=stage)
+            try:
+                try:
+                    next_stage = await handler(job)
+                except TransientError:
+                    job.deferred = True
+                    next_stage = "persist" if stage != "persist" else None
+                except Exception:
+                    warnings.warn(
+                        f"Pipeline error: {stage} {job.wav_path} {traceback.format_exc()}"
+                    )
+                    # Submitted operation stays in the journal to be polled by the next run
+                    if stage not in ("poll", "persist"):
+                        await self.transcriber.record_state_async(
+                            job.wav_path, "failed", error=stage
+                        )
+                    next_stage = "persist" if stage != "persist" else None
+                self.processed[stage] += 1
+                if next_stage:
+                    await self._put(next_stage, job)
+            finally:
+                queue.task_done()
+
+    async def _put(self, stage: str, job: Job) -> None:
+        queue = self.queues[stage]
+        await queue.put(job)
+        self.transcriber.metrics.set("queue_depth", queue.qsize(), stage=stage)
+
+    async def _failed(self, job: Job, stage: str) -> str:
+        await self.transcriber.record_state_async(job.wav_path, "failed", error=stage)
+        return "persist"
+
+    async def _probe(self, job: Job) -> Optional[str]:
+        transcriber = self.transcriber
+        if transcriber.cache is not None:
+            job.key, job.result = await transcriber.cache.lookup_async(
+                job.wav_path,
+                transcriber.cache.recognition_params(
+                    transcriber.speech_service, transcriber.vad, transcriber.chunk_seconds
+                ),
+            )
+            if job.result is not None:
+                job.cached = True
+                return "persist"
+        # Continue from the last stage completed by the previous run
+        resumed = await transcriber.resumable_state_async(job.wav_path)
+        if resumed["state"] != "submitted":
+            # Don't spend conversions and uploads while the API is failing
+            transcriber.check_circuits()
+        if resumed["state"]:
+            job.delay = resumed["delay"]
+            job.ogg_path = resumed["ogg_path"]
+            job.ogg_link = resumed["ogg_link"]
+            job.object_key = resumed["object_key"]
+            job.id = resumed["operation_id"]
+            return {"converted": "upload", "uploaded": "submit", "submitted": "poll"}[
+                resumed["state"]
+            ]
+        job.info = await transcriber.probe_async(job.wav_path)
+        if job.info.duration_seconds < 1.0:
+            return "persist"
+        if transcriber.vad is not None:
+            loop = asyncio.get_running_loop()
+            job.speech = await loop.run_in_executor(None, transcriber.detect_speech, job.wav_path)
+            # Nothing to recognize, skipped the same as records too short
+            if job.speech is not None and job.speech.duration < 1.0:
+                return "persist"
+        duration = job.speech.duration if job.speech is not None else job.info.duration_seconds
+        # 10 seconds per 1 minute * 1 channel, same as Transcriber
+        job.delay = duration * job.info.channels / 6
+        await transcriber.record_state_async(job.wav_path, "probed", delay=job.delay)
+        # whisperX takes the file as is
+        if transcriber.api == "whisperx":
+            return "submit"
+        return "convert"
+
+    async def _convert(self, job: Job) -> Optional[str]:
+        transcriber = self.transcriber
+        if transcriber.stream_upload:
+            job.ogg_path = transcriber.audio_converter.ogg_name(job.wav_path)
+            job.ogg_link = await transcriber.convert_and_upload_async(
+                job.wav_path, job.info, self.s3_client, job.speech
+            )
+            if not job.ogg_link:
+                return await self._failed(job, "convert_upload")
+            job.object_key = job.ogg_path
+            await transcriber.record_state_async(
+                job.wav_path, "uploaded", ogg_link=job.ogg_link, object_key=job.object_key
+            )
+            return "submit"
+        job.ogg_path = await transcriber.to_ogg_async(job.wav_path, job.info, job.speech)
+        if not job.ogg_path:
+            return await self._failed(job, "convert")
+        await transcriber.record_state_async(job.wav_path, "converted", ogg_path=job.ogg_path)
+        return "upload"
+
+    async def _upload(self, job: Job) -> Optional[str]:
+        job.ogg_link = await self.transcriber.upload_ogg_async(job.ogg_path, self.s3_client)
+        if not job.ogg_link:
+            return await self._failed(job, "upload")
+        job.object_key = os.path.basename(job.ogg_path)
+        await self.transcriber.record_state_async(
+            job.wav_path, "uploaded", ogg_link=job.ogg_link, object_key=job.object_key
+        )
+        return "submit"
+
+    async def _submit(self, job: Job) -> Optional[str]:
+        transcriber = self.transcriber
+        if transcriber.api == "whisperx":
+            job.result = await transcriber.transcribe_speech_async(
+                job.wav_path, self.session, job.speech
+            )
+            await transcriber.record_state_async(job.wav_path, "done" if job.result else "failed")
+            return "persist"
+        job.id = await transcriber.submit_task_async(job.ogg_link, self.session)  # type: ignore
+        if not job.id:
+            return await self._failed(job, "submit")
+        await transcriber.record_state_async(job.wav_path, "submitted", operation_id=job.id)
+        return "poll"
+
+    async def _poll(self, job: Job) -> Optional[str]:
+        job.result = await self.transcriber.poller.wait(job.id, self.session, job.delay)
+        return "persist"
+
+    async def _persist(self, job: Job) -> None:
+        transcriber = self.transcriber
+        # Operation may still finish, audio is kept for the next run to poll it again
+        resumable = (
+            (bool(job.id) and not job.result) or job.deferred
+        ) and transcriber.journal is not None
+        try:
+            if job.ogg_link and not resumable:
+                await transcriber.delete_ogg_async(job.ogg_path, self.s3_client, job.object_key)
+            # Converted file of a deferred job is uploaded by the next run from where it is
+            elif (
+                job.ogg_path
+                and not transcriber.stream_upload
+                and not (job.deferred and resumable)
+                and os.path.exists(job.ogg_path)
+            ):
+                os.unlink(job.ogg_path)
+            if job.result and not job.cached:
+                if job.id:
+                    await transcriber.record_state_async(job.wav_path, "done")
+                    if job.speech is None and transcriber.vad is not None:
+                        # Resumed from the journal, regions are found again
+                        loop = asyncio.get_running_loop()
+                        job.speech = await loop.run_in_executor(
+                            None, transcriber.detect_speech, job.wav_path
+                        )
+                    if job.speech is not None:
+                        job.speech.attach(job.result)
+                if job.key:
+                    await transcriber.cache.put_async(job.key, job.result)  # type: ignore
+                # Same as Transcriber, webhook is sent for SpeechKit results
+                if transcriber.api != "whisperx":
+                    file_name = os.path.basename(job.wav_path)
+                    await transcriber.send_webhook_async(job.result, self.session, file_name)
+        finally:
+            if job.deferred:
+                self.deferred += 1
+            else:
+                if job.result:
+                    self.transcribed += 1
+                else:
+                    self.failed += 1
+                if self.on_result is not None:
+                    await self.on_result(job.wav_path, job.result)
@@ -0,0 +1,47 @@
+import sqlite3
+from typing import Dict, Iterable, Tuple
+
+
+class RenderManifest:
+    """Record of the json every html file was rendered from, kept in SQLite.
+
+    For each json it keeps size, mtime and digest of the content, version of the template
+    and path of the html, so a file is rendered again only when one of them changes. Json
+    rewritten with the same content is recognised by its digest without rendering."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS renders (
+                json_path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                version TEXT NOT NULL,
+                html_path TEXT NOT NULL
+            ) WITHOUT ROWID
+            """)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "RenderManifest":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def load(self) -> Dict[str, Tuple[int, int, str, str, str]]:
+        """Returns (size, mtime_ns, digest, version, html_path) by path of the json"""
+        rows = self.connection.execute(
+            "SELECT json_path, size, mtime_ns, digest, version, html_path FROM renders"
+        )
+        return {row[0]: row[1:] for row in rows}
+
+    def put(self, rows: Iterable[Tuple[str, int, int, str, str, str]]) -> None:
+        """Stores rows of (json_path, size, mtime_ns, digest, version, html_path)"""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO renders VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
@@ -0,0 +1,273 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import warnings
+import zlib
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+
+
+class DirectoryCacheBackend:
+    """Keeps every result in its own gzipped JSON file. Access time is tracked through
+    file mtime, so least recently used entries are evicted first.
+
+    Finding them takes a scan of the whole cache, so once it's over max_size entries are
+    evicted down to low_water of it, and the next scan waits for that much to be added."""
+
+    def __init__(
+        self, path: str, max_size: int = 1024 * 1024 * 1024, low_water: float = 0.9
+    ) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".json.gz")
+
+    def _entries(self):
+        for sub_dir in os.scandir(self.path):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(".json.gz"):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = gzip.decompress(f.read())
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = gzip.compress(data)
+        # Write under a temporary name, so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(compressed)
+        with self._lock:
+            try:
+                self.size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(temp_path, path)
+            self.size += len(compressed)
+            if self.size > self.max_size:
+                self._evict()
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.unlink(path)
+            except FileNotFoundError:
+                return
+            self.size -= size
+
+    def _evict(self) -> None:
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.size = sum(size for _, size, _ in entries)
+        if self.size <= self.max_size:
+            return
+        target = self.max_size * self.low_water
+        for path, size, _ in entries:
+            if self.size <= target:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteCacheBackend:
+    """Keeps results zlib-compressed in a single SQLite file, handy when the cache holds
+    lots of small entries. Least recently used entries are evicted first."""
+
+    def __init__(self, path: str, max_size: int = 1024 * 1024 * 1024) -> None:
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Used from executor threads, access is serialized by the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, "
+            "accessed REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results(accessed)")
+        self.connection.commit()
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            row = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        return row[0]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT data FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self.connection.commit()
+        return zlib.decompress(row[0])
+
+    def put(self, key: str, data: bytes) -> None:
+        compressed = zlib.compress(data)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, data, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, compressed, len(compressed), time.time()),
+            )
+            self._evict()
+            self.connection.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self.connection.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.connection.commit()
+
+    def _evict(self) -> None:
+        size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, entry_size in self.connection.execute(
+            "SELECT key, size FROM results ORDER BY accessed"
+        ):
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+    def close(self) -> None:
+        with self._lock:
+            self.connection.close()
+
+
+class ResultCache:
+    """Transcription results keyed by hash of the audio content and recognition parameters,
+    so the same record under another name or path isn't sent for recognition again."""
+
+    def __init__(self, backend, raise_exceptions: bool = False) -> None:
+        self.backend = backend
+        self.raise_exceptions = raise_exceptions
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def directory(cls, path: str, max_size: int = 1024 * 1024 * 1024, **kwargs):
+        return cls(DirectoryCacheBackend(path, max_size), **kwargs)
+
+    @classmethod
+    def sqlite(cls, path: str, max_size: int = 1024 * 1024 * 1024, **kwargs):
+        return cls(SQLiteCacheBackend(path, max_size), **kwargs)
+
+    @staticmethod
+    def recognition_params(speech_service, vad=None, chunk_seconds: float = 0.0) -> dict:
+        """Parameters of the speech service, of the voice detector trimming records if
+        there's one, and length of chunks whisperX gets, that affect the result"""
+        params: dict = {"api": speech_service.api_type}
+        if speech_service.api_type == "whisperx":
+            # Model, language and diarization settings are passed in the query string,
+            # host and token may change without affecting the result
+            query = urlsplit(speech_service.whisper_endpoint).query
+            params["whisper"] = sorted(
+                (name, value)
+                for name, value in parse_qsl(query, keep_blank_values=True)
+                if name != "hf_token"
+            )
+            if chunk_seconds:
+                params["chunk_seconds"] = chunk_seconds
+        else:
+            params["language_code"] = speech_service.language_code
+            params["mode"] = speech_service.transcribe_endpoint.rsplit("/", 1)[-1]
+        if vad is not None:
+            # Every setting but block size changes which parts of the record are sent
+            params["vad"] = {
+                name: value for name, value in vars(vad).items() if name != "block_frames"
+            }
+        return params
+
+    def key(self, file_path: str, params: dict, chunk_size: int = 1024 * 1024) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                digest.update(chunk)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            data = self.backend.get(key)
+            result = None if data is None else json.loads(data)
+        except Exception as e:
+            if self.raise_exceptions:
+                raise e
+            warnings.warn(f"Cache error: {traceback.format_exc()}")
+            result = None
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: dict) -> None:
+        try:
+            self.backend.put(key, json.dumps(result, ensure_ascii=False).encode())
+        except Exception as e:
+            if self.raise_exceptions:
+                raise e
+            warnings.warn(f"Cache error: {traceback.format_exc()}")
+
+    def lookup(self, file_path: str, params: dict) -> tuple:
+        """Returns (key, cached result or None)"""
+        try:
+            key = self.key(file_path, params)
+        except Exception as e:
+            if self.raise_exceptions:
+                raise e
+            warnings.warn(f"Cache error: {traceback.format_exc()}")
+            return "", None
+        return key, self.get(key)
+
+    async def lookup_async(self, file_path: str, params: dict) -> tuple:
+        # Hashing reads the whole file, run in executor
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.lookup, file_path, params)
+
+    async def put_async(self, key: str, result: dict) -> None:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.put, key, result)
+
+    def close(self) -> None:
+        self.backend.close()
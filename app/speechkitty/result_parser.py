@@ -1,8 +1,54 @@
 from __future__ import annotations
+import copy
 import hashlib
+import html
+import io
+import json
 import os
+import sys
+import textwrap
+import traceback
 import warnings
-import pandas as pd
+from typing import IO, TYPE_CHECKING, Dict, Iterable, List, Optional, Union, cast
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+from .directory import Directory
+from .metrics import NullMetrics
+from .render_manifest import RenderManifest
+from .vad import OffsetMap
+
+# Change when the table is rendered differently, so that render_directory renders every
+# file again. Changes of header, footer and stylesheet are noticed without it.
+RENDER_VERSION = 1
+# Name of the manifest render_directory keeps in the rendered directory
+MANIFEST_NAME = ".render_manifest.sqlite"
+
+
+class Segment:
+    """Transcribed phrase of a single channel"""
+
+    __slots__ = ("start", "end", "channel", "text")
+
+    def __init__(self, start: float, end: float, channel: Union[int, str], text: str) -> None:
+        self.start = start
+        self.end = end
+        self.channel = channel
+        self.text = text
+
+    def __repr__(self) -> str:
+        return f"Segment({self.start!r}, {self.end!r}, {self.channel!r}, {self.text!r})"
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Segment):
+            return NotImplemented
+        return (self.start, self.end, self.channel, self.text) == (
+            other.start,
+            other.end,
+            other.channel,
+            other.text,
+        )
 
 
 class Parser:
@@ -31,58 +77,128 @@ class Parser:
 </html>
 """
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, metrics=None, stylesheet: str = "") -> None:
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        # URL of the stylesheet pages link to instead of repeating the styles, see css()
+        self.stylesheet = stylesheet
 
-    def parse_result(self, result, channel_tag: int = 1) -> pd.DataFrame:
-        """Parses resulting json into a dataframe"""
-        df = pd.DataFrame()
+    def _collect(self, result, channel_tag: int = 1) -> Optional[tuple]:
+        """Collects columns of the result in one pass. Times of SpeechKit are left as strings"""
+        start, end, channel, text = [], [], [], []
         # whisperX API
         if "segments" in result:
-            if len(result["segments"]) == 0:
-                return df
             for chunk in result["segments"]:
-                row = dict()
-                row["startTime"] = [chunk["start"]]
-                row["endTime"] = [chunk["end"]]
-                row["channelTag"] = [chunk["speaker"]] if "speaker" in chunk else [channel_tag]
-                row["text"] = [chunk["text"]]
-                df = pd.concat([df, pd.DataFrame(row)], ignore_index=True)
-            df["startTime"] = pd.to_numeric(df["startTime"])
-            df["endTime"] = pd.to_numeric(df["endTime"])
-            df = df.sort_values("startTime")
-            return df.reset_index(drop=True)
+                start.append(chunk["start"])
+                end.append(chunk["end"])
+                channel.append(chunk["speaker"] if "speaker" in chunk else channel_tag)
+                text.append(chunk["text"])
+            return start, end, channel, text
 
         if "chunks" not in result["response"]:
-            return df
+            return None
 
         # SpeechKit API
         for chunk in result["response"]["chunks"]:
-            row = dict()
-            row["startTime"] = [chunk["alternatives"][0]["words"][0]["startTime"].replace("s", "")]
-            row["endTime"] = [chunk["alternatives"][0]["words"][-1]["endTime"].replace("s", "")]
-            row["channelTag"] = [chunk["channelTag"]]
-            row["text"] = [chunk["alternatives"][0]["text"]]
-            df = pd.concat([df, pd.DataFrame(row)], ignore_index=True)
-
-        df["startTime"] = pd.to_numeric(df["startTime"])
-        df["endTime"] = pd.to_numeric(df["endTime"])
-        df = df.sort_values("startTime")
-
-        return df.reset_index(drop=True)
-
-    def create_html(self, df: pd.DataFrame) -> str:
-        if df.empty:
-            return ""
-        df = df.pivot_table(
-            index=["startTime", "endTime"],
-            values="text",
-            columns=["channelTag"],
-            aggfunc="first",
-            fill_value="",
-        )
-        table = df.to_html(index=True)
-        return self.header + table + self.footer
+            alternative = chunk["alternatives"][0]
+            start.append(alternative["words"][0]["startTime"])
+            end.append(alternative["words"][-1]["endTime"])
+            channel.append(chunk["channelTag"])
+            text.append(alternative["text"])
+        return start, end, channel, text
+
+    def parse_result(self, result, channel_tag: int = 1) -> pd.DataFrame:
+        """Parses resulting json into a dataframe"""
+        import pandas as pd
+
+        with self.metrics.timer("stage_seconds", stage="parse"):
+            columns = self._collect(result, channel_tag)
+            if columns is None or not columns[0]:
+                self.metrics.inc("empty_results_total")
+                return pd.DataFrame()
+            start, end, channel, text = columns
+            start, end = self._to_seconds(start), self._to_seconds(end)
+            if OffsetMap.from_result(result) is not None:
+                start, end = self._restore(result, start.tolist(), end.tolist())
+            df = pd.DataFrame(
+                {
+                    "startTime": start,
+                    "endTime": end,
+                    "channelTag": pd.Categorical(channel),
+                    "text": text,
+                }
+            )
+            df = df.sort_values("startTime")
+            return df.reset_index(drop=True)
+
+    @staticmethod
+    def _to_seconds(values: list) -> pd.Series:
+        import pandas as pd
+
+        times = pd.Series(values)
+        # SpeechKit returns times as strings like "1.230s"
+        if not pd.api.types.is_numeric_dtype(times):
+            times = times.str.rstrip("s")
+        return pd.to_numeric(times)
+
+    @staticmethod
+    def _restore(result, start: list, end: list) -> tuple:
+        """Maps times of a result recognized from the speech of a record only back to
+        times of the record"""
+        speech = OffsetMap.from_result(result)
+        if speech is None:
+            return start, end
+        return [speech.to_original(t) for t in start], [speech.to_original(t, True) for t in end]
+
+    def parse_segments(self, result, channel_tag: int = 1) -> List[Segment]:
+        """Parses resulting json into a list of segments sorted by start time,
+        a lighter alternative to parse_result for callers that don't need pandas"""
+        with self.metrics.timer("stage_seconds", stage="parse"):
+            columns = self._collect(result, channel_tag)
+            if columns is None or not columns[0]:
+                self.metrics.inc("empty_results_total")
+                return []
+            start, end, channel, text = columns
+            # SpeechKit returns times as strings like "1.230s"
+            if isinstance(start[0], str):
+                start = [float(s.rstrip("s")) for s in start]
+                end = [float(e.rstrip("s")) for e in end]
+            start, end = self._restore(result, start, end)
+            segments = [Segment(*row) for row in zip(start, end, channel, text)]
+            segments.sort(key=lambda segment: segment.start)
+            return segments
+
+    def create_html(self, data: Union[pd.DataFrame, List[Segment]]) -> str:
+        """Renders the transcript as an html page with a column per channel"""
+        buffer = io.StringIO()
+        self.write_html(data, buffer)
+        return buffer.getvalue()
+
+    def write_html(self, data: Union[pd.DataFrame, List[Segment]], out: IO[str]) -> None:
+        """Writes the html page into a text file or buffer. Takes a dataframe returned by
+        parse_result or segments returned by parse_segments. The table is the same pandas
+        makes with pivot_table and to_html, but it's written walking the segments once.
+        Of segments with the same times and channel the first is shown. Nothing is
+        written for an empty transcript."""
+        with self.metrics.timer("stage_seconds", stage="render"):
+            rows, channels = _table_rows(data)
+            if not rows:
+                return
+            out.write(self.html_header())
+            _write_table(rows, channels, out)
+            out.write(self.footer)
+
+    def html_header(self) -> str:
+        if not self.stylesheet:
+            return self.header
+        start = self.header.index("<style>")
+        end = self.header.index("</style>") + len("</style>")
+        link = f'<link rel="stylesheet" type="text/css" href="{html.escape(self.stylesheet)}"/>'
+        return self.header[:start] + link + self.header[end:]
+
+    def css(self) -> str:
+        """Styles of the page, to be saved where stylesheet points to"""
+        start = self.header.index("<style>") + len("<style>")
+        return textwrap.dedent(self.header[start : self.header.index("</style>")]).strip() + "\n"
 
     def name_html(self, wav_path: str, hash_func: str = "") -> str:
         wav_name = os.path.basename(wav_path)
@@ -98,3 +214,237 @@ class Parser:
                 warnings.warn("Hash_func is not supported. Filename won't change.")
             html_name = wav_name[:-4] + ".html"
         return os.path.dirname(wav_path) + "/" + html_name
+
+    def template_version(self) -> str:
+        """Digest of everything besides the result that html pages depend on"""
+        template = f"{RENDER_VERSION}\0{self.html_header()}\0{self.footer}"
+        return hashlib.sha256(template.encode()).hexdigest()[:16]
+
+    def render_directory(
+        self,
+        path: str,
+        hash_func: str = "",
+        manifest_path: str = "",
+        workers: Optional[int] = None,
+        force: bool = False,
+        chunksize: int = 64,
+    ) -> Dict[str, int]:
+        """Renders html page of every json result in a directory and its subdirectories,
+        named by name_html. Pages are parsed and rendered by a pool of worker processes,
+        or in this process if workers is 1, and replaced atomically.
+
+        The manifest, by default in the directory itself, remembers what every page was
+        rendered from, and pages whose json and template haven't changed are skipped
+        without reading the json. Pass force to render all of them anyway. Empty json files,
+        which mark records without result as processed, have no page and are counted as
+        unchanged. Returns numbers of rendered, unchanged and failed files."""
+        version = self.template_version()
+        counts = {"rendered": 0, "unchanged": 0, "failed": 0}
+        with RenderManifest(manifest_path or os.path.join(path, MANIFEST_NAME)) as manifest:
+            known = manifest.load()
+            tasks = []
+            for entry in Directory(path).iter_records(".+\\.json$", extensions=(".json",)):
+                html_path = self.name_html(entry.path[:-5] + ".wav", hash_func=hash_func)
+                row = known.get(entry.path)
+                digest = ""
+                if row is not None and not force and row[3:] == (version, html_path):
+                    stat = entry.stat()
+                    if row[:2] == (stat.st_size, stat.st_mtime_ns) and (
+                        not stat.st_size or os.path.exists(html_path)
+                    ):
+                        counts["unchanged"] += 1
+                        continue
+                    # Json was touched, the worker compares digests of the content
+                    digest = row[2]
+                tasks.append((entry.path, html_path, digest))
+
+            if workers == 1 or len(tasks) <= 1:
+                results: Iterable[tuple] = (_render_file(self, task) for task in tasks)
+                executor = None
+            else:
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Metrics may hold locks, which can't be sent to other processes
+                worker_parser = copy.copy(self)
+                worker_parser.metrics = NullMetrics()
+                executor = ProcessPoolExecutor(
+                    workers, initializer=_init_render_worker, initargs=(worker_parser,)
+                )
+                # Futures are kept to cancel the rest if the run is interrupted, shutdown
+                # can't do it on Python 3.8
+                futures = [
+                    executor.submit(_render_in_worker, tasks[i : i + chunksize])
+                    for i in range(0, len(tasks), chunksize)
+                ]
+                results = (result for future in futures for result in future.result())
+            rows = []
+            try:
+                for json_path, html_path, size, mtime_ns, digest, status, error in results:
+                    counts[status] += 1
+                    self.metrics.inc("renders_total", status=status)
+                    if status == "failed":
+                        warnings.warn(f"Render error: {json_path}\n{error}")
+                        continue
+                    rows.append((json_path, size, mtime_ns, digest, version, html_path))
+                    # Files rendered so far are kept if the run is interrupted
+                    if len(rows) >= 1000:
+                        manifest.put(rows)
+                        rows = []
+            finally:
+                manifest.put(rows)
+                if executor is not None:
+                    for future in futures:
+                        future.cancel()
+                    executor.shutdown()
+        return counts
+
+
+# Parser of a worker process of render_directory
+_worker_parser: Optional[Parser] = None
+
+
+def _init_render_worker(parser: Parser) -> None:
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _render_in_worker(tasks: List[tuple]) -> List[tuple]:
+    return [_render_file(_worker_parser, task) for task in tasks]  # type: ignore
+
+
+def _render_file(parser: Parser, task: tuple) -> tuple:
+    """Renders html page of a json result, unless the content has the known digest and the
+    page exists. Returns the task with size, mtime, digest of the json and status."""
+    json_path, html_path, known_digest = task
+    try:
+        with open(json_path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+        status = "unchanged"
+        # Empty json marks a record without result, there's nothing to render
+        if data and (digest != known_digest or not os.path.exists(html_path)):
+            segments = parser.parse_segments(json.loads(data))
+            # Other processes never see a partially written page
+            temp_path = f"{html_path}.{os.getpid()}.tmp"
+            try:
+                with open(temp_path, "w") as f:
+                    parser.write_html(segments, f)
+                os.replace(temp_path, html_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+                raise
+            status = "rendered"
+        return json_path, html_path, stat.st_size, stat.st_mtime_ns, digest, status, ""
+    except Exception:
+        return json_path, html_path, 0, 0, "", "failed", traceback.format_exc()
+
+
+def _table_rows(data: Union[pd.DataFrame, List[Segment]]) -> tuple:
+    """Returns rows of the table as ((start, end), {channel: text}) sorted by time,
+    and channels in the order of columns"""
+    # Without pandas imported data can't be a dataframe, and segments don't need it
+    pd = sys.modules.get("pandas")
+    if pd is not None and isinstance(data, pd.DataFrame):
+        if data.empty:
+            return [], []
+        start = data["startTime"].tolist()
+        end = data["endTime"].tolist()
+        channel = data["channelTag"].tolist()
+        text = data["text"].tolist()
+        if isinstance(data["channelTag"].dtype, pd.CategoricalDtype):
+            observed = set(channel)
+            channels = [c for c in data["channelTag"].cat.categories if c in observed]
+        else:
+            channels = _sorted_channels(channel)
+    else:
+        # mypy can't narrow the type by the module looked up at runtime
+        segments = cast(List[Segment], data)
+        start = [segment.start for segment in segments]
+        end = [segment.end for segment in segments]
+        channel = [segment.channel for segment in segments]
+        text = [segment.text for segment in segments]
+        channels = _sorted_channels(channel)
+
+    rows: list = []
+    # Segments come sorted by start, so this sort has little to do
+    for i in sorted(range(len(start)), key=lambda i: (start[i], end[i])):
+        key = (start[i], end[i])
+        if rows and rows[-1][0] == key:
+            cells = rows[-1][1]
+        else:
+            cells = {}
+            rows.append((key, cells))
+        # Same as aggfunc="first"
+        cells.setdefault(channel[i], text[i])
+    return rows, channels
+
+
+def _sorted_channels(channel: list) -> list:
+    channels = list(dict.fromkeys(channel))
+    try:
+        return sorted(channels)
+    except TypeError:
+        return channels
+
+
+def _format_times(values: list) -> List[str]:
+    """Formats one level of the index the way pandas does: integers as they are, floats
+    with 6 digits and as many trailing zeros cut as all of them have, or in scientific
+    notation if some are tiny or too long"""
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+        return [str(value) for value in values]
+    formatted = _trim_zeros([f"{value: .6f}" for value in values])
+    too_long = max(len(value) for value in formatted) > 12
+    large = any(abs(value) > 1e6 for value in values)
+    small = any(0 < abs(value) < 1e-6 for value in values)
+    if small or (too_long and large):
+        formatted = [f"{value: .6e}" for value in values]
+    return [value.strip() for value in formatted]
+
+
+def _trim_zeros(values: List[str]) -> List[str]:
+    while all(value.endswith("0") for value in values):
+        values = [value[:-1] for value in values]
+    return [value + "0" if value.endswith(".") else value for value in values]
+
+
+_CONTROL_ESCAPES = str.maketrans({"\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _cell(value) -> str:
+    # Control characters are shown escaped and the text is stripped, as pandas does
+    return html.escape(str(value).translate(_CONTROL_ESCAPES), quote=False).strip()
+
+
+def _write_table(rows: list, channels: list, out: IO[str]) -> None:
+    out.write('<table border="1" class="dataframe">\n  <thead>\n')
+    out.write('    <tr style="text-align: right;">\n      <th></th>\n      <th>channelTag</th>\n')
+    for channel in channels:
+        out.write(f"      <th>{_cell(channel)}</th>\n")
+    out.write("    </tr>\n    <tr>\n      <th>startTime</th>\n      <th>endTime</th>\n")
+    out.write("      <th></th>\n" * len(channels))
+    out.write("    </tr>\n  </thead>\n  <tbody>\n")
+
+    starts = _format_times([key[0] for key, _ in rows])
+    ends = _format_times([key[1] for key, _ in rows])
+    i = 0
+    while i < len(rows):
+        # Rows starting at the same time share the cell of the start, as in pandas
+        span = 1
+        while i + span < len(rows) and rows[i + span][0][0] == rows[i][0][0]:
+            span += 1
+        for j in range(i, i + span):
+            out.write("    <tr>\n")
+            if j == i and span > 1:
+                out.write(f'      <th rowspan="{span}" valign="top">{starts[i]}</th>\n')
+            elif j == i:
+                out.write(f"      <th>{starts[i]}</th>\n")
+            out.write(f"      <th>{ends[j]}</th>\n")
+            cells = rows[j][1]
+            for channel in channels:
+                out.write(f"      <td>{_cell(cells.get(channel, ''))}</td>\n")
+            out.write("    </tr>\n")
+        i += span
+    out.write("  </tbody>\n</table>")
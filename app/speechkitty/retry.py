@@ -0,0 +1,327 @@
+import asyncio
+import functools
+import random
+import sys
+import threading
+import time
+from typing import Mapping, Optional
+
+import aiohttp
+import requests
+import urllib3
+
+from .adaptive_limiter import parse_retry_after
+from .metrics import NullMetrics
+
+# Statuses worth repeating the request for
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+# Statuses meaning the request was turned down without being processed
+REJECTED_STATUSES = (429, 503)
+# Object storage reports throttling and its own failures by error code
+_STORAGE_CODES = {
+    "RequestTimeout": 408,
+    "Throttling": 429,
+    "InternalError": 500,
+    "ServiceUnavailable": 503,
+    "SlowDown": 503,
+}
+_TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    ConnectionError,
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    requests.ConnectionError,
+    requests.Timeout,
+)
+_NOT_SENT_ERRORS = (
+    aiohttp.ClientConnectorError,
+    requests.ConnectTimeout,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_storage_errors() -> dict:
+    from boto3.exceptions import S3UploadFailedError
+    from botocore import exceptions
+
+    return {
+        "upload": S3UploadFailedError,
+        "client": exceptions.ClientError,
+        "transient": (
+            exceptions.EndpointConnectionError,
+            exceptions.ConnectTimeoutError,
+            exceptions.ReadTimeoutError,
+            exceptions.ConnectionClosedError,
+        ),
+        "not_sent": (exceptions.EndpointConnectionError, exceptions.ConnectTimeoutError),
+    }
+
+
+def _storage_errors(kind: str):
+    """Returns error classes of boto3. Until it's imported by the storage client no error
+    can come from it, so workers that don't upload never import it."""
+    if "botocore" not in sys.modules:
+        return ()
+    return _load_storage_errors()[kind]
+
+
+class TransientError(Exception):
+    """Raised when a call still fails with an error worth repeating it for after all the
+    attempts its retry policy allows, the error of the last attempt is its cause. Nothing
+    is wrong with the file being processed, it should be left for a later run."""
+
+
+class CircuitOpenError(TransientError):
+    """Raised instead of calling an endpoint that keeps failing. Nothing is wrong with
+    the file being processed, it should be left for a later run."""
+
+    def __init__(self, endpoint: str, retry_in: float) -> None:
+        super().__init__(f"Circuit of {endpoint} is open, retry in {retry_in:.1f} s")
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+def _unwrap(error: BaseException) -> BaseException:
+    # boto3 transfers hide the error of the storage behind their own
+    if isinstance(error, _storage_errors("upload")) and error.__context__ is not None:
+        return error.__context__
+    return error
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """Returns HTTP status of the failed request, None if there was no response"""
+    error = _unwrap(error)
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code
+    if isinstance(error, _storage_errors("client")):
+        code = error.response.get("Error", {}).get("Code", "")
+        return _STORAGE_CODES.get(code) or error.response.get("ResponseMetadata", {}).get(
+            "HTTPStatusCode"
+        )
+    return None
+
+
+def error_header(error: BaseException, name: str) -> Optional[str]:
+    """Returns header of the failed response"""
+    error = _unwrap(error)
+    headers: Optional[Mapping[str, str]] = None
+    if isinstance(error, aiohttp.ClientResponseError):
+        headers = error.headers
+    elif isinstance(error, requests.HTTPError) and error.response is not None:
+        headers = error.response.headers
+    elif isinstance(error, _storage_errors("client")):
+        headers = error.response.get("ResponseMetadata", {}).get("HTTPHeaders")
+    if not headers:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether the error may go away if the request is repeated"""
+    status = error_status(error)
+    if status is not None:
+        return status in RETRY_STATUSES
+    return isinstance(_unwrap(error), _TRANSIENT_ERRORS + _storage_errors("transient"))
+
+
+def is_not_sent(error: BaseException) -> bool:
+    """Whether the connection failed before the request was sent, so it wasn't processed"""
+    error = _unwrap(error)
+    if isinstance(error, _NOT_SENT_ERRORS + _storage_errors("not_sent")):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(
+            getattr(error.args[0], "reason", None), urllib3.exceptions.NewConnectionError
+        )
+    return False
+
+
+class CircuitBreaker:
+    """Stops calls to an endpoint after failure_threshold transient failures in a row.
+    When reset_timeout passes, one trial call is let through: success closes the circuit,
+    failure opens it for another reset_timeout. Safe to use from executor threads.
+
+    State is published as the circuit_open{endpoint} gauge."""
+
+    def __init__(
+        self,
+        name: str = "",
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        metrics=None,
+    ) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial or self._remaining() > 0:
+                return "open"
+            return "half_open"
+
+    def _remaining(self) -> float:
+        return self._opened_at + self.reset_timeout - time.monotonic()  # type: ignore
+
+    def check(self, trial: bool = True) -> None:
+        """Raises CircuitOpenError if the endpoint shouldn't be called. Once reset_timeout
+        has passed the caller becomes the trial call, unless trial is False."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._remaining()
+            if self._trial or remaining > 0:
+                # Trial in progress may close the circuit soon
+                raise CircuitOpenError(self.name, max(remaining, min(1.0, self.reset_timeout)))
+            if trial:
+                self._trial = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            opened = self._opened_at is not None
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+        if opened:
+            self.metrics.set("circuit_open", 0, endpoint=self.name)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            opened = self._trial or (
+                self._opened_at is None and self.failures >= self.failure_threshold
+            )
+            if opened:
+                self._opened_at = time.monotonic()
+                self._trial = False
+        if opened:
+            self.metrics.set("circuit_open", 1, endpoint=self.name)
+
+    def record(self, error: Optional[BaseException]) -> None:
+        """Endpoint that answered, even with an error of the request, is healthy"""
+        if error is not None and is_transient(error):
+            self.record_failure()
+        else:
+            self.record_success()
+
+    def release(self) -> None:
+        """Lets another call be the trial, when the trial call was cancelled"""
+        with self._lock:
+            self._trial = False
+
+
+class RetryPolicy:
+    """Repeats failed calls up to attempts times in total, waiting a random time between
+    0 and base_delay * 2 ** attempt (at most max_delay) before the next one, or as long
+    as Retry-After asks. Idempotent calls are repeated on any transient error; the rest
+    only when the request surely wasn't processed, that is the connection couldn't be
+    made or the endpoint turned it down with 429 or 503. When attempts run out on such an
+    error, TransientError is raised from it."""
+
+    def __init__(
+        self,
+        attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        idempotent: bool = True,
+        retry_statuses=RETRY_STATUSES,
+    ) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.idempotent = idempotent
+        self.retry_statuses = tuple(retry_statuses)
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        return attempt + 1 < self.attempts and self.is_retryable(error)
+
+    def is_retryable(self, error: BaseException) -> bool:
+        """Whether the call is worth repeating after the error"""
+        if isinstance(error, TransientError):
+            return False
+        status = error_status(error)
+        if not self.idempotent:
+            # Repeating a request that may have been processed would duplicate its effect
+            return status in REJECTED_STATUSES or is_not_sent(error)
+        if status is not None:
+            return status in self.retry_statuses
+        return is_transient(error)
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        # Full jitter spreads retries of requests that failed at the same moment
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        retry_after = parse_retry_after(error_header(error, "Retry-After")) if error else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def call(self, func, *args, breaker: Optional[CircuitBreaker] = None, **kwargs):
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.check()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record(e)
+                if not self.should_retry(e, attempt):
+                    raise self._give_up(e)
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            except BaseException as e:
+                if breaker is not None:
+                    breaker.release()
+                raise e
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    async def call_async(self, func, *args, breaker: Optional[CircuitBreaker] = None, **kwargs):
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.check()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if breaker is not None:
+                    breaker.record(e)
+                if not self.should_retry(e, attempt):
+                    raise self._give_up(e)
+                await asyncio.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            except BaseException as e:
+                # Cancelled call tells nothing about the endpoint
+                if breaker is not None:
+                    breaker.release()
+                raise e
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    def _give_up(self, error: Exception) -> Exception:
+        if not self.is_retryable(error):
+            return error
+        transient = TransientError(f"Failed after {self.attempts} attempts: {error!r}")
+        transient.__cause__ = error
+        return transient
+
+
+# Single attempt, for calls with no policy and bodies that can't be sent twice
+NO_RETRY = RetryPolicy(attempts=1)
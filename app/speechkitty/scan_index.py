@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Tuple
+
+# Directories modified this close to the start of a scan may change again within the same
+# tick of coarse timestamps (1 s on ext3, 2 s on FAT, NFS servers vary) unnoticed
+RACY_MARGIN_NS = 2_000_000_000
+# Stored instead of mtime of such directories, so the next scan lists them again
+RACY_MTIME_NS = -1
+
+
+class ScanIndex:
+    """Persistent listing of a directory tree kept in SQLite.
+
+    Adding, removing or renaming a file changes mtime of its directory, so a directory
+    is listed again only if its mtime differs from the one stored during the previous
+    scan. Unchanged directories cost a single stat call, their files come from the index.
+    Files rewritten in place keep stored size and mtime until their directory changes.
+
+    A directory modified right before the scan may get another file within the same tick
+    of its mtime, so, like git does for racily clean entries, it isn't stored as clean
+    until a later scan sees its mtime well in the past."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS entries (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                is_dir INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                PRIMARY KEY (directory, name)
+            ) WITHOUT ROWID;
+            """)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "ScanIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def walk(self, root: str) -> Iterator[Tuple[str, List[Tuple[str, int, int]]]]:
+        """Yields (directory, files) for the tree in top-down order like os.walk does,
+        files are tuples of (name, size, mtime_ns)"""
+        known: Dict[str, int] = dict(
+            self.connection.execute("SELECT path, mtime_ns FROM directories")
+        )
+        racy_after = time.time_ns() - RACY_MARGIN_NS
+        visited = set()
+        stack = [root]
+        try:
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime_ns = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                visited.add(directory)
+                if known.get(directory) == mtime_ns:
+                    subdirs, files = self._load(directory)
+                else:
+                    clean = mtime_ns < racy_after
+                    subdirs, files = self._list(directory, mtime_ns if clean else RACY_MTIME_NS)
+                yield directory, files
+                stack.extend(os.path.join(directory, name) for name in reversed(subdirs))
+
+            # Forget directories which don't exist anymore
+            prefix = os.path.join(root, "")
+            removed = [
+                (path,)
+                for path in known
+                if path not in visited and (path == root or path.startswith(prefix))
+            ]
+            self.connection.executemany("DELETE FROM directories WHERE path = ?", removed)
+            self.connection.executemany("DELETE FROM entries WHERE directory = ?", removed)
+        finally:
+            # Directories listed so far are consistent even if the scan was interrupted
+            self.connection.commit()
+
+    def _load(self, directory: str) -> Tuple[List[str], List[Tuple[str, int, int]]]:
+        subdirs, files = [], []
+        rows = self.connection.execute(
+            "SELECT name, is_dir, size, mtime_ns FROM entries WHERE directory = ?", (directory,)
+        )
+        for name, is_dir, size, mtime_ns in rows:
+            if is_dir:
+                subdirs.append(name)
+            else:
+                files.append((name, size, mtime_ns))
+        return subdirs, files
+
+    def _list(self, directory: str, mtime_ns: int) -> Tuple[List[str], List[Tuple[str, int, int]]]:
+        subdirs, files = [], []
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        # Same as os.walk, symlinks to directories aren't followed
+                        if entry.is_dir():
+                            if not entry.is_symlink():
+                                subdirs.append(entry.name)
+                            continue
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            return subdirs, files
+
+        rows = [(directory, name, 1, 0, 0) for name in subdirs]
+        rows += [(directory, name, 0, size, mtime) for name, size, mtime in files]
+        self.connection.execute("DELETE FROM entries WHERE directory = ?", (directory,))
+        self.connection.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?)", (directory, mtime_ns)
+        )
+        return subdirs, files
@@ -0,0 +1,172 @@
+import json
+import sqlite3
+import time
+import traceback
+import warnings
+from dataclasses import dataclass
+from typing import List, Optional
+
+from .directory import Directory
+from .metrics import NullMetrics
+from .result_parser import Parser
+
+# Results written this long before an update started are checked again by the next one,
+# in case the scan passed their directory before they appeared
+CHECKPOINT_MARGIN_NS = 5 * 10**9
+
+
+@dataclass
+class Hit:
+    """Segment matching a search query"""
+
+    json_path: str
+    channel: str
+    start: float
+    end: float
+    text: str
+    rank: float
+
+
+class SearchIndex:
+    """Full-text index of transcribed segments kept in SQLite FTS5.
+
+    Segments are stored once in a regular table, FTS5 indexes their text as an external
+    content table, so a result rewritten since it was indexed is replaced without scanning
+    the whole index. Every update remembers when it started, the next one parses only
+    results modified after that."""
+
+    def __init__(self, path: str, parser: Optional[Parser] = None, metrics=None) -> None:
+        self.path = path
+        self.parser = parser if parser is not None else Parser()
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                id INTEGER PRIMARY KEY,
+                json_path TEXT NOT NULL UNIQUE,
+                mtime_ns INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS segments (
+                id INTEGER PRIMARY KEY,
+                call_id INTEGER NOT NULL,
+                channel TEXT NOT NULL,
+                start_time REAL NOT NULL,
+                end_time REAL NOT NULL,
+                text TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS segments_call ON segments(call_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS segments_fts USING fts5(
+                text, content='segments', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            );
+            CREATE TRIGGER IF NOT EXISTS segments_insert AFTER INSERT ON segments BEGIN
+                INSERT INTO segments_fts(rowid, text) VALUES (new.id, new.text);
+            END;
+            CREATE TRIGGER IF NOT EXISTS segments_delete AFTER DELETE ON segments BEGIN
+                INSERT INTO segments_fts(segments_fts, rowid, text)
+                VALUES ('delete', old.id, old.text);
+            END;
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                root TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            """)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "SearchIndex":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def checkpoint(self, path: str) -> int:
+        """Results of the directory modified before this time in ns are already indexed"""
+        row = self.connection.execute(
+            "SELECT mtime_ns FROM checkpoints WHERE root = ?", (path,)
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def update(self, path: str, full: bool = False, batch_size: int = 1000) -> int:
+        """Indexes results of a directory and its subdirectories modified since the last
+        update, or all of them that changed if full is set, for instance after copying
+        results with their mtime preserved. Returns number of results indexed."""
+        started = time.time_ns()
+        checkpoint = 0 if full else self.checkpoint(path)
+        indexed = 0
+        try:
+            for entry in Directory(path).iter_records(".+\\.json$", extensions=(".json",)):
+                mtime_ns = entry.stat().st_mtime_ns
+                if mtime_ns < checkpoint:
+                    continue
+                if self._index(entry.path, mtime_ns):
+                    indexed += 1
+                    if indexed % batch_size == 0:
+                        self.connection.commit()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?)",
+                (path, started - CHECKPOINT_MARGIN_NS),
+            )
+        finally:
+            # Results indexed so far are kept if the update is interrupted
+            self.connection.commit()
+        self.metrics.inc("indexed_results_total", indexed)
+        return indexed
+
+    def _index(self, json_path: str, mtime_ns: int) -> bool:
+        row = self.connection.execute(
+            "SELECT id, mtime_ns FROM calls WHERE json_path = ?", (json_path,)
+        ).fetchone()
+        if row is not None and row[1] == mtime_ns:
+            return False
+        try:
+            with open(json_path, "r") as f:
+                segments = self.parser.parse_segments(json.load(f))
+        except Exception:
+            self.metrics.inc("errors_total", stage="index")
+            warnings.warn(f"Index error: {json_path}\n{traceback.format_exc()}")
+            return False
+        if row is None:
+            call_id = self.connection.execute(
+                "INSERT INTO calls (json_path, mtime_ns) VALUES (?, ?)", (json_path, mtime_ns)
+            ).lastrowid
+        else:
+            call_id = row[0]
+            self.connection.execute("DELETE FROM segments WHERE call_id = ?", (call_id,))
+            self.connection.execute(
+                "UPDATE calls SET mtime_ns = ? WHERE id = ?", (mtime_ns, call_id)
+            )
+        self.connection.executemany(
+            "INSERT INTO segments (call_id, channel, start_time, end_time, text) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(call_id, str(s.channel), s.start, s.end, s.text) for s in segments],
+        )
+        return True
+
+    def search(
+        self, query: str, limit: int = 20, channel: Optional[str] = None, raw: bool = False
+    ) -> List[Hit]:
+        """Returns segments containing the phrase, best matches first. With raw the query
+        is passed to FTS5 as it is, allowing its syntax like OR, NEAR and prefixes."""
+        if not raw:
+            # Quoted, the query is a phrase and punctuation in it isn't syntax
+            query = '"' + query.replace('"', '""') + '"'
+        sql = (
+            "SELECT calls.json_path, segments.channel, segments.start_time, "
+            "segments.end_time, segments.text, segments_fts.rank "
+            "FROM segments_fts "
+            "JOIN segments ON segments.id = segments_fts.rowid "
+            "JOIN calls ON calls.id = segments.call_id "
+            "WHERE segments_fts MATCH ?"
+        )
+        params: list = [query]
+        if channel is not None:
+            sql += " AND segments.channel = ?"
+            params.append(str(channel))
+        sql += " ORDER BY segments_fts.rank LIMIT ?"
+        params.append(limit)
+        with self.metrics.timer("stage_seconds", stage="search"):
+            rows = self.connection.execute(sql, params).fetchall()
+        return [Hit(*row) for row in rows]
@@ -1,8 +1,16 @@
-import os
 import requests
 import aiohttp
 import traceback
 import warnings
+from typing import Dict, Optional
+
+from .adaptive_limiter import NullLimiter
+from .multipart import MultipartFileBody
+from .retry import NO_RETRY, CircuitBreaker, RetryPolicy, TransientError
+
+# Endpoints limits, retry policies and circuit breakers are set for
+ENDPOINTS = ("submit", "operation", "whisper")
+_NULL_LIMITER = NullLimiter()
 
 
 class SpeechService:
@@ -17,6 +25,10 @@ class SpeechService:
         whisper_endpoint: str = "",
         mode: str = "longRunningRecognize",
         raise_exceptions: bool = False,
+        upload_chunk_size: int = 64 * 1024,
+        limiters: Optional[Dict[str, object]] = None,
+        retries: Optional[Dict[str, RetryPolicy]] = None,
+        breakers: Optional[Dict[str, CircuitBreaker]] = None,
     ) -> None:
         self.api_type = api_type.lower()
         self.transcribe_api_key = transcribe_api_key
@@ -24,99 +36,178 @@ class SpeechService:
         self.whisper_endpoint = whisper_endpoint
         self.transcribe_endpoint = f"{self.transcribe_endpoint}/{mode}"
         self.raise_exceptions = raise_exceptions
+        # Size of pieces the audio is read in when sending it to whisperX
+        self.upload_chunk_size = upload_chunk_size
+        # Adaptive concurrency limits of async calls by endpoint: submit, operation, whisper
+        self.limiters = limiters if limiters is not None else {}
+        # Submitting twice starts two paid operations, so it's only repeated when rejected
+        self.retries = {
+            "submit": RetryPolicy(idempotent=False),
+            "operation": RetryPolicy(),
+            "whisper": RetryPolicy(),
+        }
+        self.retries.update(retries or {})
+        # Endpoint that keeps failing isn't called until it's back
+        self.breakers = (
+            breakers
+            if breakers is not None
+            else {endpoint: CircuitBreaker(endpoint) for endpoint in ENDPOINTS}
+        )
 
-    def submit_yandex_task(self, file_link: str) -> str:
-        body = {
+    def limiter(self, endpoint: str):
+        return self.limiters.get(endpoint, _NULL_LIMITER)
+
+    def _retry(self, endpoint: str, func, *args):
+        policy = self.retries.get(endpoint, NO_RETRY)
+        return policy.call(func, *args, breaker=self.breakers.get(endpoint))
+
+    async def _retry_async(self, endpoint: str, func, *args):
+        policy = self.retries.get(endpoint, NO_RETRY)
+        return await policy.call_async(func, *args, breaker=self.breakers.get(endpoint))
+
+    def _submit_body(self, file_link: str) -> dict:
+        return {
             "config": {"specification": {"languageCode": self.language_code}},
             "audio": {"uri": file_link},
         }
-        header = {"Authorization": f"Api-Key {self.transcribe_api_key}"}
+
+    def submit_yandex_task(self, file_link: str) -> str:
         try:
-            response = requests.post(self.transcribe_endpoint, headers=header, json=body)
-            response.raise_for_status()
-            data = response.json()
-            return data["id"]
+            return self._retry("submit", self._submit_yandex_task, file_link)
+        except TransientError:
+            raise
         except Exception as e:
             if self.raise_exceptions:
                 raise e
             warnings.warn(f"Submit task error: {traceback.format_exc()}")
             return ""
 
-    def get_yandex_result(self, task_id: str):
+    def _submit_yandex_task(self, file_link: str) -> str:
         header = {"Authorization": f"Api-Key {self.transcribe_api_key}"}
+        body = self._submit_body(file_link)
+        response = requests.post(self.transcribe_endpoint, headers=header, json=body)
+        response.raise_for_status()
+        data = response.json()
+        return data["id"]
+
+    def get_yandex_result(self, task_id: str):
         try:
-            response = requests.get(f"{self.operation_endpoint}/{task_id}", headers=header)
-            response.raise_for_status()
-            return response.json()
+            return self._retry("operation", self._get_yandex_result, task_id)
+        except TransientError:
+            raise
         except Exception as e:
             if self.raise_exceptions:
                 raise e
             warnings.warn(f"Result error: {traceback.format_exc()}")
             return None
 
+    def _get_yandex_result(self, task_id: str):
+        header = {"Authorization": f"Api-Key {self.transcribe_api_key}"}
+        response = requests.get(f"{self.operation_endpoint}/{task_id}", headers=header)
+        response.raise_for_status()
+        return response.json()
+
     def transcribe_start_whisper(self, wav_path: str):
         try:
-            with open(wav_path, "rb") as f:
-                headers = {"accept": "application/json"}
-                files = {"audio": f}
-                response = requests.post(self.whisper_endpoint, headers=headers, files=files)
-                response.raise_for_status()
-            return response.json()
+            return self._retry("whisper", self._transcribe_start_whisper, wav_path)
+        except TransientError:
+            raise
         except Exception as e:
             if self.raise_exceptions:
                 raise e
             warnings.warn(f"Transcribe error: {traceback.format_exc()}")
             return None
 
+    def _transcribe_start_whisper(self, wav_path: str):
+        # Body is streamed from disk instead of being built in memory
+        with MultipartFileBody(wav_path, chunk_size=self.upload_chunk_size) as body:
+            headers = {"accept": "application/json", "Content-Type": body.content_type}
+            response = requests.post(self.whisper_endpoint, headers=headers, data=body.chunks())
+            response.raise_for_status()
+        return response.json()
+
     async def submit_yandex_task_async(
         self, file_link: str, session: aiohttp.ClientSession
     ) -> str:
-        body = {
-            "config": {"specification": {"languageCode": self.language_code}},
-            "audio": {"uri": file_link},
-        }
-        header = {"Authorization": f"Api-Key {self.transcribe_api_key}"}
         try:
-            async with session.post(
-                self.transcribe_endpoint, headers=header, json=body
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return data["id"]
+            return await self._retry_async(
+                "submit", self._submit_yandex_task_async, file_link, session
+            )
+        except TransientError:
+            raise
         except Exception as e:
             if self.raise_exceptions:
                 raise e
             warnings.warn(f"Submit task error: {traceback.format_exc()}")
             return ""
 
-    async def get_yandex_result_async(self, task_id: str, session: aiohttp.ClientSession):
+    async def _submit_yandex_task_async(
+        self, file_link: str, session: aiohttp.ClientSession
+    ) -> str:
         header = {"Authorization": f"Api-Key {self.transcribe_api_key}"}
+        body = self._submit_body(file_link)
+        async with self.limiter("submit").slot() as slot, session.post(
+            self.transcribe_endpoint, headers=header, json=body
+        ) as response:
+            slot.observe(response)
+            response.raise_for_status()
+            data = await response.json()
+            return data["id"]
+
+    async def get_yandex_result_async(self, task_id: str, session: aiohttp.ClientSession):
         try:
-            async with session.get(
-                f"{self.operation_endpoint}/{task_id}", headers=header
-            ) as response:
-                response.raise_for_status()
-                return await response.json()
+            return await self._retry_async(
+                "operation", self._get_yandex_result_async, task_id, session
+            )
+        except TransientError:
+            raise
         except Exception as e:
             if self.raise_exceptions:
                 raise e
             warnings.warn(f"Result error: {traceback.format_exc()}")
             return None
 
+    async def _get_yandex_result_async(self, task_id: str, session: aiohttp.ClientSession):
+        header = {"Authorization": f"Api-Key {self.transcribe_api_key}"}
+        async with self.limiter("operation").slot() as slot, session.get(
+            f"{self.operation_endpoint}/{task_id}", headers=header
+        ) as response:
+            slot.observe(response)
+            response.raise_for_status()
+            return await response.json()
+
     async def transcribe_start_whisper_async(self, wav_path: str, session: aiohttp.ClientSession):
+        try:
+            return await self._retry_async(
+                "whisper", self._transcribe_start_whisper_async, wav_path, session
+            )
+        except TransientError:
+            raise
+        except Exception as e:
+            if self.raise_exceptions:
+                raise e
+            warnings.warn(f"Transcribe error: {traceback.format_exc()}")
+            return None
+
+    async def _transcribe_start_whisper_async(
+        self, wav_path: str, session: aiohttp.ClientSession
+    ):
         import json
 
+        body = MultipartFileBody(wav_path, chunk_size=self.upload_chunk_size)
+        # File is read chunk by chunk and closed along with the generator, a new one is
+        # made for every attempt
+        chunks = body.iter_chunks_async()
         try:
-            data = aiohttp.FormData()
-            # Use specific content_type for the file if possible, but pydub output is usually handled.
-            # aiohttp infers from filename usually.
-            data.add_field("audio", open(wav_path, "rb"), filename=os.path.basename(wav_path))
-
-            headers = {"accept": "application/json"}
-            async with session.post(self.whisper_endpoint, headers=headers, data=data) as response:
-                # Read text first if debugging is needed, or relies on exception.
-                # But aiohttp raise_for_status reads the body to msg if not careful?
-                # No, it just checks status.
+            headers = {
+                "accept": "application/json",
+                "Content-Type": body.content_type,
+                "Content-Length": str(len(body)),
+            }
+            async with self.limiter("whisper").slot() as slot, session.post(
+                self.whisper_endpoint, headers=headers, data=chunks
+            ) as response:
+                slot.observe(response)
                 response.raise_for_status()
 
                 if response.content_type == "application/json":
@@ -130,8 +221,5 @@ class SpeechService:
                             f"WhisperX response content-type is {response.content_type}, expected application/json. Response body: {text[:500]}"
                         )
                         return None
-        except Exception as e:
-            if self.raise_exceptions:
-                raise e
-            warnings.warn(f"Transcribe error: {traceback.format_exc()}")
-            return None
+        finally:
+            await chunks.aclose()
@@ -1,16 +1,38 @@
 from __future__ import annotations
+import asyncio
+import copy
+import functools
+import heapq
+import json
 import os
 import time
 import warnings
 import traceback
 import aiohttp
-from pydub import AudioSegment
 
-from typing import Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 
+from .adaptive_limiter import AdaptiveLimiter
 from .cloud_storage import CloudStorage
 from .audio_converter import AudioConverter
-from .speech_service import SpeechService
+from .audio_probe import AudioInfo, AudioProbe
+from .journal import RESUMABLE_STATES, JobJournal
+from .metrics import NullMetrics
+from .operation_poller import OperationPoller
+from .result_cache import ResultCache
+from .retry import CircuitBreaker, CircuitOpenError, RetryPolicy, TransientError
+from .speech_service import ENDPOINTS, SpeechService
+from .vad import OffsetMap, VoiceDetector
+
+# Journal entry of a file that is transcribed from the start
+NEW_JOB = {
+    "state": "",
+    "delay": 0.0,
+    "ogg_path": "",
+    "ogg_link": "",
+    "object_key": "",
+    "operation_id": "",
+}
 
 
 class Transcriber:
@@ -26,10 +48,42 @@ class Transcriber:
         webhook_url: str = "",
         mode: str = "longRunningRecognize",
         raise_exceptions: bool = False,
+        max_poll_rps: float = 10.0,
+        stream_upload: bool = False,
+        cache: Optional[ResultCache] = None,
+        metrics=None,
+        journal: Optional[JobJournal] = None,
+        adaptive_limits: bool = False,
+        retries: Optional[Dict[str, RetryPolicy]] = None,
+        vad: Optional[VoiceDetector] = None,
+        chunk_seconds: float = 0.0,
+        chunk_workers: int = 4,
     ) -> None:
         self.api = str(api).lower()
+        # Pipe converted audio straight into object storage without temp files
+        self.stream_upload = stream_upload
         self.webhook_url = webhook_url
         self.raise_exceptions = raise_exceptions
+        # Results of already transcribed audio, looked up by content
+        self.cache = cache
+        # Durations of stages and errors, nothing is recorded by default
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self._in_flight = 0
+        # Stages completed by files, lets a restarted run continue where it stopped
+        self.journal = journal
+        # Silence found by the detector isn't uploaded and recognized, times of the result
+        # are mapped back to the record by Parser. Keep its settings while files are in the
+        # journal, resumed files get the map found again.
+        self.vad = vad
+        # whisperX gets records longer than chunk_seconds in chunks cut at pauses, at most
+        # chunk_workers of a record at once, so a timeout costs one chunk only
+        self.chunk_seconds = chunk_seconds
+        self.chunk_workers = chunk_workers
+        # Retry policies by operation: upload, delete, submit, operation, whisper, webhook.
+        # Every chunk is a whisper request of its own, retried alone.
+        retries = retries or {}
+        # Receiver may act on every copy of the result it gets
+        self.webhook_retry = retries.get("webhook", RetryPolicy(idempotent=False))
 
         # Initialize services
         self.cloud_storage = CloudStorage(
@@ -47,10 +101,14 @@ class Transcriber:
                 else os.environ.get("STORAGE_BUCKET_NAME", "")
             ),
             raise_exceptions=raise_exceptions,
+            retries={name: retries[name] for name in ("upload", "delete") if name in retries},
+            breaker=CircuitBreaker("storage", metrics=self.metrics),
         )
 
         self.audio_converter = AudioConverter(raise_exceptions=raise_exceptions)
 
+        self.audio_probe = AudioProbe()
+
         self.speech_service = SpeechService(
             api_type=self.api,
             transcribe_api_key=(
@@ -64,6 +122,24 @@ class Transcriber:
             ),
             mode=mode,
             raise_exceptions=raise_exceptions,
+            # Concurrency of remote calls follows 429s and latency instead of fixed numbers
+            limiters=(
+                {
+                    endpoint: AdaptiveLimiter(endpoint, metrics=self.metrics)
+                    for endpoint in ENDPOINTS
+                }
+                if adaptive_limits
+                else None
+            ),
+            retries={name: retries[name] for name in ENDPOINTS if name in retries},
+            breakers={
+                endpoint: CircuitBreaker(endpoint, metrics=self.metrics) for endpoint in ENDPOINTS
+            },
+        )
+
+        # Shared by all files transcribed asynchronously
+        self.poller = OperationPoller(
+            self.speech_service, max_rps=max_poll_rps, metrics=self.metrics
         )
 
         self.validate_config()
@@ -94,47 +170,303 @@ class Transcriber:
         self.cloud_storage.raise_exceptions = raise_exceptions
         self.audio_converter.raise_exceptions = raise_exceptions
         self.speech_service.raise_exceptions = raise_exceptions
+        if self.cache is not None:
+            self.cache.raise_exceptions = raise_exceptions
 
-    def to_ogg(self, file_path: str) -> str:
-        return self.audio_converter.to_ogg(file_path)
+    def _measure(self, stage: str, func, *args):
+        """Runs the stage recording its duration, empty return value counts as an error"""
+        try:
+            with self.metrics.timer("stage_seconds", stage=stage):
+                result = func(*args)
+        except Exception as e:
+            self.metrics.inc("errors_total", stage=stage)
+            raise e
+        if not result:
+            self.metrics.inc("errors_total", stage=stage)
+        return result
 
-    async def to_ogg_async(self, file_path: str) -> str:
-        return await self.audio_converter.to_ogg_async(file_path)
+    async def _measure_async(self, stage: str, coroutine):
+        try:
+            with self.metrics.timer("stage_seconds", stage=stage):
+                result = await coroutine
+        except Exception as e:
+            self.metrics.inc("errors_total", stage=stage)
+            raise e
+        if not result:
+            self.metrics.inc("errors_total", stage=stage)
+        return result
+
+    def probe(self, file_path: str) -> AudioInfo:
+        return self._measure("probe", self.audio_probe.probe, file_path)
+
+    async def probe_async(self, file_path: str) -> AudioInfo:
+        return await self._measure_async("probe", self.audio_probe.probe_async(file_path))
+
+    def detect_speech(self, wav_path: str) -> Optional[OffsetMap]:
+        """Returns regions of the record with speech, None if there's no detector or the
+        record isn't PCM and is sent as it is"""
+        if self.vad is None:
+            return None
+        with self.metrics.timer("stage_seconds", stage="vad"):
+            return self.audio_converter.detect_speech(wav_path, self.vad)
+
+    def to_ogg(
+        self, file_path: str, info: Optional[AudioInfo] = None, speech: Optional[OffsetMap] = None
+    ) -> str:
+        # Without regions the converter is called the same as before there was a detector
+        args = (file_path, info) if speech is None else (file_path, info, speech)
+        return self._measure("convert", self.audio_converter.to_ogg, *args)
+
+    async def to_ogg_async(
+        self, file_path: str, info: Optional[AudioInfo] = None, speech: Optional[OffsetMap] = None
+    ) -> str:
+        args = (file_path, info) if speech is None else (file_path, info, speech)
+        return await self._measure_async("convert", self.audio_converter.to_ogg_async(*args))
 
     def upload_ogg(self, file_path: str, s3_client=None) -> Optional[str]:
-        return self.cloud_storage.upload_file(file_path, s3_client)
+        return self._measure("upload", self.cloud_storage.upload_file, file_path, s3_client)
 
     async def upload_ogg_async(self, file_path: str, s3_client=None) -> Optional[str]:
-        return await self.cloud_storage.upload_file_async(file_path, s3_client)
+        return await self._measure_async(
+            "upload", self.cloud_storage.upload_file_async(file_path, s3_client)
+        )
+
+    def convert_and_upload(
+        self,
+        wav_path: str,
+        info: Optional[AudioInfo] = None,
+        s3_client=None,
+        speech: Optional[OffsetMap] = None,
+    ) -> Optional[str]:
+        """Converts the record and uploads the result reading it from ffmpeg through a pipe,
+        so nothing is written to the temp directory. Returns link to the uploaded file."""
+        return self._stream_upload(
+            wav_path,
+            lambda upload: self.audio_converter.to_ogg_stream(wav_path, upload, info, speech),
+            s3_client,
+        )
+
+    def convert_pair_and_upload(
+        self, left_path: str, right_path: str, record_path: str, s3_client=None
+    ) -> Optional[str]:
+        """Interleaves two legs of a call into a stereo record, converts and uploads it
+        the same way as convert_and_upload. Returns link to the uploaded file."""
+        return self._stream_upload(
+            record_path,
+            lambda upload: self.audio_converter.pair_to_ogg_stream(left_path, right_path, upload),
+            s3_client,
+        )
+
+    def _stream_upload(self, wav_path: str, convert, s3_client=None) -> Optional[str]:
+        ogg_name = self.audio_converter.ogg_name(wav_path)
+        uploaded = []
+        transient_errors = []
+
+        def upload(fileobj) -> Optional[str]:
+            try:
+                link = self.cloud_storage.upload_stream(fileobj, ogg_name, s3_client)
+            except TransientError as e:
+                # Converter takes it for a failure of the file, pass it by
+                transient_errors.append(e)
+                return None
+            if link:
+                uploaded.append(link)
+            return link
 
-    def delete_ogg(self, ogg_path: str, s3_client=None) -> None:
         try:
-            os.unlink(ogg_path)
-            self.cloud_storage.delete_file(ogg_path, s3_client)
+            ogg_link = convert(upload)
         except Exception as e:
-            if self.raise_exceptions:
+            ogg_link = None
+            if not uploaded:
                 raise e
-            else:
-                warnings.warn(f"Delete error: {ogg_path} {traceback.format_exc()}")
-
-    async def delete_ogg_async(self, ogg_path: str, s3_client=None) -> None:
-        import asyncio
+        if transient_errors:
+            raise transient_errors[0]
+        # Conversion failed after the upload, don't leave a broken file in the bucket
+        if ogg_link is None and uploaded:
+            self.cloud_storage.delete_file(ogg_name, s3_client)
+            if self.raise_exceptions:
+                raise RuntimeError(f"Convert error: {wav_path}")
+        return ogg_link
 
+    async def convert_and_upload_async(
+        self,
+        wav_path: str,
+        info: Optional[AudioInfo] = None,
+        s3_client=None,
+        speech: Optional[OffsetMap] = None,
+    ) -> Optional[str]:
+        # Both ffmpeg and boto3 are blocking, run in executor
         loop = asyncio.get_running_loop()
+        return await self._measure_async(
+            "convert_upload",
+            loop.run_in_executor(None, self.convert_and_upload, wav_path, info, s3_client, speech),
+        )
+
+    def delete_ogg(self, ogg_path: str, s3_client=None, object_key: str = "") -> None:
+        """Deletes the ogg from temp_dir and object storage. The object is deleted by
+        object_key if it's given, a file resumed from the journal after it was uploaded on
+        the fly has no ogg_path."""
         try:
-            await loop.run_in_executor(None, os.unlink, ogg_path)
-            await self.cloud_storage.delete_file_async(ogg_path, s3_client)
+            if object_key or ogg_path:
+                self.cloud_storage.delete_file(object_key or ogg_path, s3_client)
         except Exception as e:
-            if self.raise_exceptions:
-                raise e
-            else:
-                warnings.warn(f"Delete error: {ogg_path} {traceback.format_exc()}")
+            self._delete_error(object_key or ogg_path, e)
+        if ogg_path and not self.stream_upload:
+            self._unlink_ogg(ogg_path)
+
+    async def delete_ogg_async(self, ogg_path: str, s3_client=None, object_key: str = "") -> None:
+        try:
+            if object_key or ogg_path:
+                await self.cloud_storage.delete_file_async(object_key or ogg_path, s3_client)
+        except Exception as e:
+            self._delete_error(object_key or ogg_path, e)
+        if ogg_path and not self.stream_upload:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._unlink_ogg, ogg_path)
+
+    def _unlink_ogg(self, ogg_path: str) -> None:
+        try:
+            os.unlink(ogg_path)
+        except FileNotFoundError:
+            # Temp directory may have been cleaned since the run that converted the file
+            pass
+        except Exception as e:
+            self._delete_error(ogg_path, e)
+
+    def _delete_error(self, name: str, e: Exception) -> None:
+        if self.raise_exceptions:
+            raise e
+        else:
+            warnings.warn(f"Delete error: {name} {traceback.format_exc()}")
 
     def submit_task(self, file_link: str) -> str:
-        return self.speech_service.submit_yandex_task(file_link)
+        return self._measure("submit", self.speech_service.submit_yandex_task, file_link)
 
     async def submit_task_async(self, file_link: str, session: aiohttp.ClientSession) -> str:
-        return await self.speech_service.submit_yandex_task_async(file_link, session)
+        return await self._measure_async(
+            "submit", self.speech_service.submit_yandex_task_async(file_link, session)
+        )
+
+    def transcribe_whisper(self, wav_path: str):
+        return self._measure("transcribe", self.speech_service.transcribe_start_whisper, wav_path)
+
+    async def transcribe_whisper_async(self, wav_path: str, session: aiohttp.ClientSession):
+        return await self._measure_async(
+            "transcribe", self.speech_service.transcribe_start_whisper_async(wav_path, session)
+        )
+
+    def transcribe_speech(self, wav_path: str, speech: Optional[OffsetMap] = None):
+        """Sends regions of the record with speech to whisperX, the whole record if there
+        are none. Result keeps the regions for Parser to restore times of the record.
+        Records longer than chunk_seconds are split at pauses and their chunks are
+        transcribed one after another."""
+        if self.chunk_seconds:
+            chunks = self.split(wav_path, speech)
+            if chunks:
+                return self.transcribe_chunks(wav_path, chunks)
+        if speech is None:
+            return self.transcribe_whisper(wav_path)
+        trimmed = self.audio_converter.trim(wav_path, speech)
+        if not trimmed:
+            return None
+        try:
+            return _with_speech(self.transcribe_whisper(trimmed), speech)
+        finally:
+            os.unlink(trimmed)
+
+    async def transcribe_speech_async(
+        self,
+        wav_path: str,
+        session: aiohttp.ClientSession,
+        speech: Optional[OffsetMap] = None,
+    ):
+        """Same as transcribe_speech, but chunks of records longer than chunk_seconds are
+        transcribed at the same time"""
+        loop = asyncio.get_running_loop()
+        if self.chunk_seconds:
+            chunks = await loop.run_in_executor(None, self.split, wav_path, speech)
+            if chunks:
+                return await self.transcribe_chunks_async(wav_path, session, chunks)
+        if speech is None:
+            return await self.transcribe_whisper_async(wav_path, session)
+        trimmed = await loop.run_in_executor(None, self.audio_converter.trim, wav_path, speech)
+        if not trimmed:
+            return None
+        try:
+            return _with_speech(await self.transcribe_whisper_async(trimmed, session), speech)
+        finally:
+            await loop.run_in_executor(None, os.unlink, trimmed)
+
+    def split(self, wav_path: str, speech: Optional[OffsetMap] = None) -> Optional[List[OffsetMap]]:
+        """Returns maps of chunks the record is transcribed in, None if it's sent whole"""
+        with self.metrics.timer("stage_seconds", stage="split"):
+            return self.audio_converter.chunks(
+                wav_path, self.vad or VoiceDetector(), self.chunk_seconds, speech
+            )
+
+    def transcribe_chunks(self, wav_path: str, chunks: List[OffsetMap]) -> Optional[dict]:
+        """Transcribes chunks of the record one by one and stitches their results into one
+        in times of the record. Returns None if a chunk failed."""
+        results = []
+        for i, chunk in enumerate(chunks):
+            chunk_path = self.audio_converter.trim(wav_path, chunk, f".chunk{i}")
+            if not chunk_path:
+                return None
+            try:
+                result = self.transcribe_whisper(chunk_path)
+            finally:
+                os.unlink(chunk_path)
+            # Result of the record would be incomplete without the chunk
+            if result is None:
+                return None
+            results.append(result)
+        return stitch_chunks(results, chunks)
+
+    async def transcribe_chunks_async(
+        self, wav_path: str, session: aiohttp.ClientSession, chunks: List[OffsetMap]
+    ) -> Optional[dict]:
+        """Transcribes chunks of the record at the same time, at most chunk_workers of
+        them, and stitches their results into one in times of the record. Returns None
+        if a chunk failed after its retries."""
+        semaphore = asyncio.Semaphore(self.chunk_workers)
+        tasks = [
+            asyncio.ensure_future(
+                self._transcribe_chunk_async(wav_path, session, chunk, i, semaphore)
+            )
+            for i, chunk in enumerate(chunks)
+        ]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Result of the record would be incomplete without the chunk
+            for task in tasks:
+                task.cancel()
+            raise
+        done = [result for result in results if result is not None]
+        if len(done) < len(results):
+            return None
+        return stitch_chunks(done, chunks)
+
+    async def _transcribe_chunk_async(
+        self,
+        wav_path: str,
+        session: aiohttp.ClientSession,
+        chunk: OffsetMap,
+        index: int,
+        semaphore: asyncio.Semaphore,
+    ) -> Optional[dict]:
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            chunk_path = await loop.run_in_executor(
+                None, self.audio_converter.trim, wav_path, chunk, f".chunk{index}"
+            )
+            if not chunk_path:
+                return None
+            try:
+                # Retried by the whisper policy, chunk by chunk
+                return await self.transcribe_whisper_async(chunk_path, session)
+            finally:
+                await loop.run_in_executor(None, os.unlink, chunk_path)
 
     def get_result(self, id: str):
         return self.speech_service.get_yandex_result(id)
@@ -145,143 +477,600 @@ class Transcriber:
     async def send_webhook_async(
         self, data: dict, session: aiohttp.ClientSession, file_name: Optional[str] = None
     ):
+        """Posts the result to webhook_url. Times of a result recognized from the regions
+        of speech are in times of the record, the same as Parser gives."""
         if not self.webhook_url:
             return
         try:
-            payload = data.copy()
+            speech = OffsetMap.from_result(data)
+            # Result itself keeps the regions, it's cached and saved as it is
+            payload = speech.restore(copy.deepcopy(data)) if speech is not None else data.copy()
             if file_name:
                 payload["file_name"] = file_name
-            async with session.post(self.webhook_url, json=payload) as response:
-                response.raise_for_status()
+            with self.metrics.timer("stage_seconds", stage="webhook"):
+                await self.webhook_retry.call_async(self._post_webhook, payload, session)
         except Exception as e:
+            self.metrics.inc("errors_total", stage="webhook")
             if self.raise_exceptions:
                 raise e
             else:
                 warnings.warn(f"Webhook error: {traceback.format_exc()}")
 
-    def transcribe_file(self, wav_path: str, s3_client=None) -> Optional[str]:
-        # Check duration of the audio record
-        try:
-            audio = AudioSegment.from_file(wav_path)
-            audio_duration = audio.duration_seconds
-            audio_channels = audio.channels
-            if audio_duration < 1.0:
-                return
-        except Exception as e:
-            if self.raise_exceptions:
-                raise e
-            else:
-                warnings.warn(f"Transcribe error: {e}")
-                return
+    async def _post_webhook(self, payload: dict, session: aiohttp.ClientSession) -> None:
+        async with session.post(self.webhook_url, json=payload) as response:
+            response.raise_for_status()
 
-        # If using Whisper API, send a request and we're done
+    def check_circuits(self) -> None:
+        """Raises CircuitOpenError if an endpoint a new file needs keeps failing, so no
+        work is spent on the file until the endpoint is back"""
         if self.api == "whisperx":
-            return self.speech_service.transcribe_start_whisper(wav_path)
+            breakers = [self.speech_service.breakers.get("whisper")]
+        else:
+            breakers = [
+                self.cloud_storage.breaker,
+                self.speech_service.breakers.get("submit"),
+                self.speech_service.breakers.get("operation"),
+            ]
+        for breaker in breakers:
+            if breaker is not None:
+                breaker.check(trial=False)
 
-        ogg_path = self.to_ogg(wav_path)
+    def _abandon(self, job: dict, s3_client=None) -> None:
+        """Cleans up after a file left for a later run because an endpoint is failing. With
+        a journal the next run continues from the last completed stage, so all is kept."""
+        if self.journal is not None or not job["ogg_path"]:
+            return
+        if job["ogg_link"]:
+            self.delete_ogg(job["ogg_path"], s3_client)
+        elif not self.stream_upload and os.path.exists(job["ogg_path"]):
+            os.unlink(job["ogg_path"])
 
-        # Upload ogg to object storage
-        ogg_link = self.upload_ogg(ogg_path, s3_client)
+    def record_state(self, wav_path: str, state: str, **fields) -> None:
+        if self.journal is not None:
+            self.journal.record(wav_path, state, **fields)
 
-        # If upload ended with error
-        if ogg_link is None:
-            return
+    async def record_state_async(self, wav_path: str, state: str, **fields) -> None:
+        if self.journal is not None:
+            # Every state is a SQLite commit, keep it off the event loop
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                None, functools.partial(self.journal.record, wav_path, state, **fields)
+            )
+
+    async def resumable_state_async(self, wav_path: str) -> dict:
+        if self.journal is None:
+            return dict(NEW_JOB)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.resumable_state, wav_path)
+
+    def resumable_state(self, wav_path: str) -> dict:
+        """Returns journal entry of the file if its previous run can be continued, otherwise
+        an entry of a new run with empty state"""
+        entry = self.journal.get(wav_path) if self.journal is not None else None
+        if entry is None or entry["state"] not in RESUMABLE_STATES:
+            return dict(NEW_JOB)
+        # Temp directory may have been cleaned since
+        if entry["state"] == "converted" and not os.path.exists(entry["ogg_path"]):
+            return dict(NEW_JOB)
+        if entry["state"] == "submitted":
+            # Part of the pause before the first poll may have already passed
+            entry["delay"] = max(0.0, entry["submitted_at"] + entry["delay"] - time.time())
+        return entry
+
+    async def _start_file_async(
+        self, wav_path: str, session: aiohttp.ClientSession, s3_client=None
+    ) -> Optional[tuple]:
+        """Runs stages up to submitting the task, returns (result, id, ogg_path, object_key,
+        delay, speech)"""
+        job = await self.resumable_state_async(wav_path)
+        if job["state"] == "submitted":
+            return (
+                None,
+                job["operation_id"],
+                job["ogg_path"],
+                job["object_key"],
+                job["delay"],
+                None,
+            )
+        try:
+            return await self._advance_file_async(wav_path, job, session, s3_client)
+        except TransientError as e:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._abandon, job, s3_client)
+            raise e
+
+    async def _advance_file_async(
+        self, wav_path: str, job: dict, session: aiohttp.ClientSession, s3_client=None
+    ) -> Optional[tuple]:
+        state = job["state"]
+        if not state:
+            self.check_circuits()
+            loop = asyncio.get_running_loop()
+            # Check duration of the audio record reading its header only
+            try:
+                info = await self.probe_async(wav_path)
+                if info.duration_seconds < 1.0:
+                    return None
+                job["speech"] = await loop.run_in_executor(None, self.detect_speech, wav_path)
+            except Exception as e:
+                await self.record_state_async(wav_path, "failed", error="probe")
+                if self.raise_exceptions:
+                    raise e
+                else:
+                    warnings.warn(f"Transcribe error: {e}")
+                    return None
+            speech = job["speech"]
+            # Nothing to recognize, skipped the same as records too short
+            if speech is not None and speech.duration < 1.0:
+                return None
+            # Calculate pause before first request of result
+            # using length of the audio (10 seconds per 1 minute * 1 channel)
+            duration = speech.duration if speech is not None else info.duration_seconds
+            job["delay"] = duration * info.channels / 6
+            await self.record_state_async(wav_path, "probed", delay=job["delay"])
+
+            # If using Whisper API, send a request and we're done
+            if self.api == "whisperx":
+                # Note: session is passed from caller
+                result = await self.transcribe_speech_async(wav_path, session, speech)
+                await self.record_state_async(wav_path, "done" if result else "failed")
+                return result, "", "", "", 0.0, speech
+
+            if self.stream_upload:
+                job["ogg_path"] = self.audio_converter.ogg_name(wav_path)
+                job["ogg_link"] = await self.convert_and_upload_async(
+                    wav_path, info, s3_client, speech
+                )
+                if not job["ogg_link"]:
+                    await self.record_state_async(wav_path, "failed", error="convert_upload")
+                    return None
+                state = "uploaded"
+                job["object_key"] = job["ogg_path"]
+                await self.record_state_async(
+                    wav_path, state, ogg_link=job["ogg_link"], object_key=job["object_key"]
+                )
+            else:
+                # Convert to OGG reusing metadata from the duration check
+                job["ogg_path"] = await self.to_ogg_async(wav_path, info, speech)
+                if not job["ogg_path"]:
+                    await self.record_state_async(wav_path, "failed", error="convert")
+                    return None
+                state = "converted"
+                await self.record_state_async(wav_path, state, ogg_path=job["ogg_path"])
+
+        if state == "converted":
+            # Upload ogg to object storage
+            job["ogg_link"] = await self.upload_ogg_async(job["ogg_path"], s3_client)
+            if not job["ogg_link"]:
+                await self.record_state_async(wav_path, "failed", error="upload")
+                return None
+            job["object_key"] = os.path.basename(job["ogg_path"])
+            await self.record_state_async(
+                wav_path, "uploaded", ogg_link=job["ogg_link"], object_key=job["object_key"]
+            )
 
         # Start transcribing task
-        id = self.submit_task(ogg_link)
+        id = await self.submit_task_async(job["ogg_link"], session)
+        if not id:
+            await self.record_state_async(wav_path, "failed", error="submit")
+            return None
+        await self.record_state_async(wav_path, "submitted", operation_id=id)
+
+        return None, id, job["ogg_path"], job["object_key"], job["delay"], job.get("speech")
+
+    def transcribe_file(self, wav_path: str, s3_client=None) -> Optional[dict]:
+        if self.cache is None:
+            return self._transcribe_file(wav_path, s3_client)
+
+        # Same audio with the same parameters needs no remote calls at all
+        key, result = self.cache.lookup(
+            wav_path,
+            self.cache.recognition_params(self.speech_service, self.vad, self.chunk_seconds),
+        )
+        if result is not None:
+            return result
+
+        result = self._transcribe_file(wav_path, s3_client)
+        if result and key:
+            self.cache.put(key, result)
+        return result
+
+    def _transcribe_file(self, wav_path: str, s3_client=None) -> Optional[dict]:
+        job = self.resumable_state(wav_path)
+        try:
+            return self._advance_file(wav_path, job, s3_client)
+        except TransientError as e:
+            self._abandon(job, s3_client)
+            raise e
+
+    def _advance_file(self, wav_path: str, job: dict, s3_client=None) -> Optional[dict]:
+        state = job["state"]
+        if not state:
+            self.check_circuits()
+            # Check duration of the audio record reading its header only
+            try:
+                info = self.probe(wav_path)
+                if info.duration_seconds < 1.0:
+                    return None
+                job["speech"] = self.detect_speech(wav_path)
+            except Exception as e:
+                self.record_state(wav_path, "failed", error="probe")
+                if self.raise_exceptions:
+                    raise e
+                else:
+                    warnings.warn(f"Transcribe error: {e}")
+                    return None
+            speech = job["speech"]
+            # Nothing to recognize, skipped the same as records too short
+            if speech is not None and speech.duration < 1.0:
+                return None
+            # Calculate pause before first request of result
+            # using length of the audio (10 seconds per 1 minute * 1 channel)
+            duration = speech.duration if speech is not None else info.duration_seconds
+            job["delay"] = duration * info.channels / 6
+            self.record_state(wav_path, "probed", delay=job["delay"])
+
+            # If using Whisper API, send a request and we're done
+            if self.api == "whisperx":
+                result = self.transcribe_speech(wav_path, speech)
+                self.record_state(wav_path, "done" if result else "failed")
+                return result
+
+            # Reuse metadata from the duration check, conversion is a single ffmpeg run
+            if self.stream_upload:
+                job["ogg_path"] = self.audio_converter.ogg_name(wav_path)
+                job["ogg_link"] = self.convert_and_upload(wav_path, info, s3_client, speech)
+                if not job["ogg_link"]:
+                    self.record_state(wav_path, "failed", error="convert_upload")
+                    return None
+                state = "uploaded"
+                job["object_key"] = job["ogg_path"]
+                self.record_state(
+                    wav_path, state, ogg_link=job["ogg_link"], object_key=job["object_key"]
+                )
+            else:
+                job["ogg_path"] = self.to_ogg(wav_path, info, speech)
+                if not job["ogg_path"]:
+                    self.record_state(wav_path, "failed", error="convert")
+                    return None
+                state = "converted"
+                self.record_state(wav_path, state, ogg_path=job["ogg_path"])
+
+        if state == "converted":
+            # Upload ogg to object storage
+            job["ogg_link"] = self.upload_ogg(job["ogg_path"], s3_client)
+            # If upload ended with error
+            if job["ogg_link"] is None:
+                self.record_state(wav_path, "failed", error="upload")
+                return None
+            job["object_key"] = os.path.basename(job["ogg_path"])
+            self.record_state(
+                wav_path, "uploaded", ogg_link=job["ogg_link"], object_key=job["object_key"]
+            )
+
+        if state != "submitted":
+            # Start transcribing task
+            job["operation_id"] = self.submit_task(job["ogg_link"])
+            if not job["operation_id"]:
+                self.record_state(wav_path, "failed", error="submit")
+                return None
+            self.record_state(wav_path, "submitted", operation_id=job["operation_id"])
 
         result = ""
-        # Calculate pause before first request of result
-        # using length of the audio (10 seconds per 1 minute * 1 channel)
-        time.sleep(audio_duration * audio_channels / 6)
+        submitted = time.perf_counter()
+        time.sleep(job["delay"])
         # Limit number of attempts to get result
-        for _ in range(10):
-            result = self.get_result(id)
+        for attempt in range(10):
+            try:
+                result = self.get_result(job["operation_id"])
+            except CircuitOpenError as e:
+                # Operation keeps running, ask again once the endpoint may be back
+                if attempt == 9:
+                    raise e
+                time.sleep(e.retry_in)
+                continue
+            if attempt == 0:
+                self.metrics.observe(
+                    "stage_seconds", time.perf_counter() - submitted, stage="first_poll"
+                )
             # If there's an error, stop trying
             if result is None or result.get("done", False):
                 break
+            self.metrics.inc("retries_total", stage="poll")
             time.sleep(3)
+        self.metrics.observe("stage_seconds", time.perf_counter() - submitted, stage="poll")
+
+        # Operation stays in the journal as submitted, next run will poll it again
+        if not result or not result.get("done", False):
+            self.metrics.inc("errors_total", stage="poll")
+            return None
+
+        # Delete ogg from temp_dir and object storage
+        self.delete_ogg(job["ogg_path"], s3_client, job["object_key"])
+        self.record_state(wav_path, "done")
+
+        speech = job.get("speech")
+        if speech is None:
+            # Resumed from the journal, regions are found again
+            speech = self.detect_speech(wav_path)
+        return _with_speech(result, speech)
+
+    async def transcribe_file_async(
+        self,
+        wav_path: str,
+        session: aiohttp.ClientSession,
+        s3_client=None,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        webhook: bool = True,
+    ) -> Optional[dict]:
+        """Transcribes the record. If semaphore is given, it's held while the file is being
+        probed, converted, uploaded and submitted, and released while waiting for the result,
+        so that files waiting for SpeechKit don't occupy concurrency slots. Result of
+        SpeechKit is sent to webhook_url unless webhook is False."""
+        self._in_flight += 1
+        self.metrics.set("files_in_flight", self._in_flight)
+        try:
+            return await self._transcribe_file_async(
+                wav_path, session, s3_client, semaphore, webhook
+            )
+        finally:
+            self._in_flight -= 1
+            self.metrics.set("files_in_flight", self._in_flight)
+
+    async def _transcribe_file_async(
+        self,
+        wav_path: str,
+        session: aiohttp.ClientSession,
+        s3_client=None,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        webhook: bool = True,
+    ) -> Optional[dict]:
+        key = ""
+        if self.cache is not None:
+            # Same audio with the same parameters needs no remote calls at all
+            key, result = await self.cache.lookup_async(
+                wav_path,
+                self.cache.recognition_params(self.speech_service, self.vad, self.chunk_seconds),
+            )
+            if result is not None:
+                return result
+
+        if semaphore is None:
+            started = await self._start_file_async(wav_path, session, s3_client)
+        else:
+            async with semaphore:
+                started = await self._start_file_async(wav_path, session, s3_client)
+        if started is None:
+            return None
+
+        result, id, ogg_path, object_key, delay, speech = started
+        # If using Whisper API, result is already there
+        if self.api == "whisperx":
+            if result and key:
+                await self.cache.put_async(key, result)  # type: ignore
+            return result
 
+        # Wait for the result along with all other operations in flight
+        result = await self.poller.wait(id, session, delay)
+
+        # Operation stays in the journal as submitted, next run will poll it again
         if not result:
-            return
+            return None
+        if speech is None and self.vad is not None:
+            # Resumed from the journal, regions are found again
+            loop = asyncio.get_running_loop()
+            speech = await loop.run_in_executor(None, self.detect_speech, wav_path)
+        result = _with_speech(result, speech)
+
+        if key:
+            await self.cache.put_async(key, result)  # type: ignore
 
         # Delete ogg from temp_dir and object storage
-        self.delete_ogg(ogg_path, s3_client)
+        await self.delete_ogg_async(ogg_path, s3_client, object_key)
+        await self.record_state_async(wav_path, "done")
+
+        # Extract file name and send webhook
+        if webhook:
+            file_name = os.path.basename(wav_path)
+            await self.send_webhook_async(result, session, file_name=file_name)
 
         return result
 
-    async def transcribe_file_async(
-        self, wav_path: str, session: aiohttp.ClientSession, s3_client=None
-    ) -> Optional[str]:
-        import asyncio
+    async def transcribe_pair_async(
+        self,
+        left_path: Optional[str],
+        right_path: Optional[str],
+        session: aiohttp.ClientSession,
+        s3_client=None,
+        record_path: str = "",
+        speakers: Tuple[str, str] = ("1", "2"),
+    ) -> Optional[dict]:
+        """Transcribes two legs of a call recorded into separate files, both at the same time,
+        and merges their results with merge_legs. Either leg may be None.
 
-        # Check duration of the audio record
-        # Running pydub check in executor as it is blocking
-        loop = asyncio.get_running_loop()
+        If record_path is given, result of every leg is saved as json next to it, empty if
+        there's none so that the leg is skipped as processed, and the merged result is saved
+        next to record_path. Returns the merged result, None if neither leg has one.
+
+        SpeechKit transcribes channels separately, so when record_path is given, legs in
+        the same PCM format are interleaved into a stereo record, which is encoded and
+        uploaded on the fly and transcribed as a single operation. Channel tags of the
+        result are replaced with the speakers then, and only the result of the call is
+        saved.
 
-        def check_duration():
+        Only the result of the call is sent to webhook_url, named after record_path, or
+        the first leg without it."""
+        loop = asyncio.get_running_loop()
+        if self.api != "whisperx" and left_path and right_path and record_path:
             try:
-                audio = AudioSegment.from_file(wav_path)
-                return audio.duration_seconds, audio.channels
-            except Exception as e:
-                # If checking fails, we might want to log/warn and return None
-                # But here we just return exceptions to be handled by caller or wrapped
-                raise e
+                info = await loop.run_in_executor(
+                    None, self.audio_converter.pair_info, left_path, right_path
+                )
+            except (OSError, ValueError):
+                # Legs that can't be interleaved are transcribed one by one
+                pass
+            else:
+                result = await self._transcribe_stereo_async(
+                    left_path, right_path, record_path, info, session, s3_client, speakers
+                )
+                if result:
+                    file_name = os.path.basename(record_path)
+                    await self.send_webhook_async(result, session, file_name=file_name)
+                return result
 
+        legs = [(path, speaker) for path, speaker in zip((left_path, right_path), speakers) if path]
+        tasks = [
+            asyncio.ensure_future(
+                self.transcribe_file_async(path, session, s3_client, webhook=False)
+            )
+            for path, _ in legs
+        ]
         try:
-            audio_duration, audio_channels = await loop.run_in_executor(None, check_duration)
-            if audio_duration < 1.0:
-                return None
-        except Exception as e:
-            if self.raise_exceptions:
-                raise e
-            else:
-                warnings.warn(f"Transcribe error: {e}")
-                return None
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # Other leg would be of no use without this one
+            for task in tasks:
+                task.cancel()
+            raise
 
-        # If using Whisper API, send a request and we're done
-        if self.api == "whisperx":
-            # Note: session is passed from caller
-            return await self.speech_service.transcribe_start_whisper_async(wav_path, session)
+        transcribed = [(result, speaker) for result, (_, speaker) in zip(results, legs) if result]
+        merged = merge_legs(*zip(*transcribed)) if transcribed else None
+        if record_path:
+            outputs = [(path[:-4] + ".json", result) for (path, _), result in zip(legs, results)]
+            outputs.append((record_path[:-4] + ".json", merged))
+            await loop.run_in_executor(None, _save_results, outputs)
+        # Same as transcribe_file_async, webhook is sent for SpeechKit results
+        if merged and self.api != "whisperx":
+            file_name = os.path.basename(record_path or legs[0][0])
+            await self.send_webhook_async(merged, session, file_name=file_name)
+        return merged
+
+    async def _transcribe_stereo_async(
+        self,
+        left_path: str,
+        right_path: str,
+        record_path: str,
+        info: AudioInfo,
+        session: aiohttp.ClientSession,
+        s3_client=None,
+        speakers: Tuple[str, str] = ("1", "2"),
+    ) -> Optional[dict]:
+        """Transcribes legs of a call as one stereo record of the format in info, journaled
+        by record_path"""
+        loop = asyncio.get_running_loop()
+        job = await self.resumable_state_async(record_path)
+        # Name of the object is derived from the record, so it's known when resuming too
+        ogg_path = self.audio_converter.ogg_name(record_path)
+        try:
+            if job["state"] not in ("uploaded", "submitted"):
+                self.check_circuits()
+                job["delay"] = info.duration_seconds * info.channels / 6
+                await self.record_state_async(record_path, "probed", delay=job["delay"])
+                job["ogg_link"] = await self._measure_async(
+                    "convert_upload",
+                    loop.run_in_executor(
+                        None,
+                        self.convert_pair_and_upload,
+                        left_path,
+                        right_path,
+                        record_path,
+                        s3_client,
+                    ),
+                )
+                if not job["ogg_link"]:
+                    await self.record_state_async(record_path, "failed", error="convert_upload")
+                    return None
+                job["state"] = "uploaded"
+                await self.record_state_async(
+                    record_path, "uploaded", ogg_link=job["ogg_link"], object_key=ogg_path
+                )
+            if job["state"] == "uploaded":
+                job["operation_id"] = await self.submit_task_async(job["ogg_link"], session)
+                if not job["operation_id"]:
+                    await self.record_state_async(record_path, "failed", error="submit")
+                    return None
+                await self.record_state_async(
+                    record_path, "submitted", operation_id=job["operation_id"]
+                )
+        except TransientError as e:
+            # Nothing is kept locally, only the uploaded record is left behind
+            if self.journal is None and job["ogg_link"]:
+                await self.cloud_storage.delete_file_async(ogg_path, s3_client)
+            raise e
 
-        # Convert to OGG
-        ogg_path = await self.to_ogg_async(wav_path)
-        if not ogg_path:
+        result = await self.poller.wait(job["operation_id"], session, job["delay"])
+        # Operation stays in the journal as submitted, next run will poll it again
+        if not result:
             return None
+        await self.cloud_storage.delete_file_async(ogg_path, s3_client)
+        await self.record_state_async(record_path, "done")
 
-        # Upload ogg to object storage
-        ogg_link = await self.upload_ogg_async(ogg_path, s3_client)
+        # SpeechKit numbers channels from 1
+        tags = {str(channel): speaker for channel, speaker in enumerate(speakers, start=1)}
+        for chunk in result.get("response", {}).get("chunks", []):
+            chunk["channelTag"] = tags.get(str(chunk["channelTag"]), chunk["channelTag"])
+        await loop.run_in_executor(None, _save_results, [(record_path[:-4] + ".json", result)])
+        return result
 
-        # If upload ended with error
-        if ogg_link is None:
-            return None
 
-        # Start transcribing task
-        id = await self.submit_task_async(ogg_link, session)
-        if not id:
-            return None
+def merge_legs(results: Sequence[dict], speakers: Sequence[str]) -> dict:
+    """Tags segments of every result with the speaker of its leg and merges them by start
+    time. Segments of each leg come sorted, so they are merged in linear time. Times of
+    legs trimmed by the voice detector are restored first."""
+    for result in results:
+        speech = OffsetMap.from_result(result)
+        if speech is not None:
+            speech.restore(result)
+    if any("response" in result for result in results):
+        # SpeechKit
+        legs: List[list] = []
+        for result, speaker in zip(results, speakers):
+            chunks = result["response"].get("chunks", []) if "response" in result else []
+            for chunk in chunks:
+                chunk["channelTag"] = speaker
+            legs.append(chunks)
+        return {"response": {"chunks": list(heapq.merge(*legs, key=_chunk_start))}}
+    legs = []
+    for result, speaker in zip(results, speakers):
+        segments = result.get("segments", [])
+        for segment in segments:
+            segment["speaker"] = speaker
+            for word in segment.get("words", []):
+                word["speaker"] = speaker
+        legs.append(segments)
+    return {"segments": list(heapq.merge(*legs, key=lambda segment: segment["start"]))}
 
-        result = None
-        # Calculate pause before first request of result
-        await asyncio.sleep(audio_duration * audio_channels / 6)
 
-        # Limit number of attempts to get result
-        for _ in range(10):
-            result_data = await self.get_result_async(id, session)
-            # If there's an error, stop trying
-            if result_data is None or result_data.get("done", False):
-                result = result_data
-                break
-            await asyncio.sleep(3)
+def stitch_chunks(results: Sequence[dict], chunks: Sequence[OffsetMap]) -> dict:
+    """Shifts times of results of chunks to times of the record and joins them into one
+    result of whisperX. Chunks follow each other, so their segments stay in order."""
+    stitched = {
+        key: value for key, value in results[0].items() if key not in ("segments", "word_segments")
+    }
+    segments: list = []
+    words: list = []
+    for result, chunk in zip(results, chunks):
+        chunk.restore(result)
+        segments.extend(result.get("segments", []))
+        words.extend(result.get("word_segments", []))
+    stitched["segments"] = segments
+    if words:
+        stitched["word_segments"] = words
+    return stitched
 
-        if not result:
-            return None
 
-        # Delete ogg from temp_dir and object storage
-        await self.delete_ogg_async(ogg_path, s3_client)
+def _with_speech(result, speech: Optional[OffsetMap]):
+    """Keeps regions of the record the result was recognized from in it"""
+    if result and speech is not None:
+        speech.attach(result)
+    return result
 
-        # Extract file name and send webhook
-        file_name = os.path.basename(wav_path)
-        await self.send_webhook_async(result, session, file_name=file_name)
 
-        return result
+def _chunk_start(chunk: dict) -> float:
+    return float(chunk["alternatives"][0]["words"][0]["startTime"].rstrip("s"))
+
+
+def _save_results(outputs: List[Tuple[str, Optional[dict]]]) -> None:
+    for path, result in outputs:
+        with open(path, "w") as f:
+            f.write(json.dumps(result, ensure_ascii=False) if result else "")
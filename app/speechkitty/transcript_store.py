@@ -0,0 +1,304 @@
+import datetime
+import json
+import os
+import time
+import traceback
+import uuid
+import warnings
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+except ImportError:  # pragma: no cover
+    pa = None
+
+from .directory import Directory
+from .metrics import NullMetrics
+from .result_parser import Parser
+
+SEGMENT_FIELDS = [
+    ("call_id", "string"),
+    ("channel", "string"),
+    ("start", "float64"),
+    ("end", "float64"),
+    ("text", "string"),
+]
+CALL_FIELDS = [
+    ("call_id", "string"),
+    ("json_path", "string"),
+    ("api", "string"),
+    ("segments", "int64"),
+    ("channels", "int64"),
+    ("duration", "float64"),
+    ("mtime", "float64"),
+    ("ingested_at", "float64"),
+]
+
+
+def _schema(fields: list) -> "pa.Schema":
+    return pa.schema([(name, pa.type_for_alias(alias)) for name, alias in fields])
+
+
+class TranscriptStore:
+    """Transcripts of all calls in a single Parquet dataset, so that analytics and replays
+    read a few columnar files instead of opening a json per call.
+
+    Two tables are kept under path, both partitioned by date of the call in the hive
+    layout (date=2023-10-21): segments with a row per phrase, sorted by call and start,
+    and calls with a row of metadata per call. Results are added with ingest, every
+    batch of them is written as new files, so it's safe to ingest while others read.
+    Files of a date are merged into one by compact.
+
+    Needs pyarrow, which is an optional dependency."""
+
+    def __init__(self, path: str, parser: Optional[Parser] = None, metrics=None) -> None:
+        if pa is None:
+            raise ImportError("TranscriptStore requires pyarrow: pip install speechkitty[parquet]")
+        self.path = path
+        self.parser = parser if parser is not None else Parser()
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.partitioning = ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive")
+        # Reads are memory mapped, pages of the files are shared with the page cache
+        self.filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+
+    @staticmethod
+    def call_id(json_path: str) -> str:
+        """Name of the result without the extension, same as transcript_id of webhooks"""
+        return os.path.basename(json_path)[: -len(".json")]
+
+    @staticmethod
+    def date_of(json_path: str) -> datetime.date:
+        """Date of the call the result belongs to, by default when the result was written"""
+        return datetime.date.fromtimestamp(os.path.getmtime(json_path))
+
+    def _dataset(self, table: str) -> Optional["ds.Dataset"]:
+        path = os.path.join(self.path, table)
+        if not os.path.isdir(path):
+            return None
+        schema = _schema(SEGMENT_FIELDS if table == "segments" else CALL_FIELDS)
+        return ds.dataset(
+            path,
+            schema=schema.append(pa.field("date", pa.string())),
+            format="parquet",
+            partitioning=self.partitioning,
+            filesystem=self.filesystem,
+        )
+
+    def ingested(self) -> set:
+        """Paths of the results in the store"""
+        dataset = self._dataset("calls")
+        if dataset is None:
+            return set()
+        return set(dataset.to_table(columns=["json_path"]).column("json_path").to_pylist())
+
+    def ingest(
+        self,
+        paths: Iterable[str],
+        date_of: Optional[Callable[[str], datetime.date]] = None,
+        batch_size: int = 10000,
+    ) -> int:
+        """Adds results that aren't in the store yet, parsing them with parse_result.
+        Results are identified by path, a result rewritten after ingesting isn't added
+        again. Empty json files, which mark records without result as processed, are added
+        as calls without segments and api. Returns number of calls added."""
+        date_of = date_of or self.date_of
+        known = self.ingested()
+        added = 0
+        batch: List[Tuple[dict, list]] = []
+        for json_path in paths:
+            if json_path in known:
+                continue
+            known.add(json_path)
+            try:
+                batch.append(self._read(json_path, date_of))
+            except Exception:
+                self.metrics.inc("errors_total", stage="ingest")
+                warnings.warn(f"Ingest error: {json_path}\n{traceback.format_exc()}")
+                continue
+            if len(batch) >= batch_size:
+                added += self._write(batch)
+                batch = []
+        if batch:
+            added += self._write(batch)
+        return added
+
+    def ingest_directory(
+        self,
+        path: str,
+        date_of: Optional[Callable[[str], datetime.date]] = None,
+        batch_size: int = 10000,
+    ) -> int:
+        """Adds results found in a directory and its subdirectories"""
+        entries = Directory(path).iter_records(".+\\.json$", extensions=(".json",))
+        return self.ingest((entry.path for entry in entries), date_of, batch_size)
+
+    def _read(self, json_path: str, date_of: Callable[[str], datetime.date]) -> Tuple[dict, list]:
+        with open(json_path, "r") as f:
+            data = f.read()
+        call_id = self.call_id(json_path)
+        api = ""
+        segments: list = []
+        # Empty json marks a record without result
+        if data:
+            result = json.loads(data)
+            api = "whisperX" if "segments" in result else "SpeechKit"
+            df = self.parser.parse_result(result)
+            if not df.empty:
+                segments = [
+                    (call_id, str(channel), start, end, text)
+                    for start, end, channel, text in zip(
+                        df["startTime"].tolist(),
+                        df["endTime"].tolist(),
+                        df["channelTag"].tolist(),
+                        df["text"].tolist(),
+                    )
+                ]
+        call = {
+            "call_id": call_id,
+            "json_path": json_path,
+            "api": api,
+            "segments": len(segments),
+            "channels": len({segment[1] for segment in segments}),
+            "duration": max((segment[3] for segment in segments), default=0.0),
+            "mtime": os.path.getmtime(json_path),
+            "ingested_at": time.time(),
+            "date": date_of(json_path).isoformat(),
+        }
+        return call, [segment + (call["date"],) for segment in segments]
+
+    def _write(self, batch: List[Tuple[dict, list]]) -> int:
+        with self.metrics.timer("stage_seconds", stage="ingest"):
+            calls = sorted((call for call, _ in batch), key=lambda call: call["call_id"])
+            segments = [segment for _, rows in batch for segment in rows]
+            # Sorted rows make min/max statistics of row groups selective for call_id
+            segments.sort(key=lambda segment: (segment[0], segment[2]))
+            if segments:
+                schema = _schema(SEGMENT_FIELDS + [("date", "string")])
+                columns = [
+                    pa.array(column, type=field.type)
+                    for column, field in zip(zip(*segments), schema)
+                ]
+                self._write_table("segments", pa.Table.from_arrays(columns, schema=schema))
+            # Calls are written last, a call is in the store once its segments are
+            names = [name for name, _ in CALL_FIELDS] + ["date"]
+            self._write_table(
+                "calls",
+                pa.Table.from_pylist(
+                    [{name: call[name] for name in names} for call in calls],
+                    schema=_schema(CALL_FIELDS + [("date", "string")]),
+                ),
+            )
+        self.metrics.inc("ingested_calls_total", len(calls))
+        return len(calls)
+
+    def _write_table(self, table: str, data: "pa.Table") -> None:
+        # Unique names let writers append without touching files of others
+        ds.write_dataset(
+            data,
+            os.path.join(self.path, table),
+            format="parquet",
+            partitioning=self.partitioning,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_rows_per_group=64 * 1024,
+            min_rows_per_group=0,
+        )
+
+    def _filter(
+        self,
+        call_ids: Optional[Iterable[str]],
+        start_date: Optional[datetime.date],
+        end_date: Optional[datetime.date],
+    ):
+        """Dates limit the partitions read, call ids are checked against statistics of row
+        groups before reading them"""
+        expression = None
+        conditions = []
+        if start_date is not None:
+            conditions.append(ds.field("date") >= start_date.isoformat())
+        if end_date is not None:
+            conditions.append(ds.field("date") <= end_date.isoformat())
+        if call_ids is not None:
+            conditions.append(pc.is_in(ds.field("call_id"), pa.array(list(call_ids), pa.string())))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def _read_table(self, table: str, columns, call_ids, start_date, end_date) -> "pa.Table":
+        dataset = self._dataset(table)
+        fields = SEGMENT_FIELDS if table == "segments" else CALL_FIELDS
+        if dataset is None:
+            empty = _schema(fields + [("date", "string")]).empty_table()
+            return empty.select(columns or empty.column_names)
+        return dataset.to_table(
+            columns=columns, filter=self._filter(call_ids, start_date, end_date)
+        )
+
+    def segments(
+        self,
+        call_ids: Optional[Iterable[str]] = None,
+        start_date: Optional[datetime.date] = None,
+        end_date: Optional[datetime.date] = None,
+        columns: Optional[List[str]] = None,
+    ) -> "pa.Table":
+        """Returns segments of the calls given, of the dates from start_date to end_date
+        inclusive, or of all calls. Call to_pandas() on the table to get a dataframe."""
+        return self._read_table("segments", columns, call_ids, start_date, end_date)
+
+    def calls(
+        self,
+        call_ids: Optional[Iterable[str]] = None,
+        start_date: Optional[datetime.date] = None,
+        end_date: Optional[datetime.date] = None,
+        columns: Optional[List[str]] = None,
+    ) -> "pa.Table":
+        """Returns metadata of the calls, filtered the same way as segments"""
+        return self._read_table("calls", columns, call_ids, start_date, end_date)
+
+    def iter_results(
+        self,
+        call_ids: Optional[Iterable[str]] = None,
+        start_date: Optional[datetime.date] = None,
+        end_date: Optional[datetime.date] = None,
+    ) -> Iterator[Tuple[str, dict]]:
+        """Yields (call_id, result) in the format of whisperX, with channels as speakers,
+        for replaying results without their json files"""
+        table = self.segments(call_ids, start_date, end_date)
+        grouped: Dict[str, list] = {}
+        for call_id, channel, start, end, text in zip(
+            *[table.column(name).to_pylist() for name, _ in SEGMENT_FIELDS]
+        ):
+            grouped.setdefault(call_id, []).append(
+                {"start": start, "end": end, "text": text, "speaker": channel}
+            )
+        for call_id in sorted(grouped):
+            yield call_id, {"segments": sorted(grouped[call_id], key=lambda s: s["start"])}
+
+    def compact(self) -> int:
+        """Merges files of every date with more than one into a single file. Readers may
+        see rows twice while it runs, so run it when nothing reads the store. Returns
+        number of dates compacted."""
+        compacted = set()
+        for table in ("segments", "calls"):
+            dataset = self._dataset(table)
+            if dataset is None:
+                continue
+            files: Dict[str, List[str]] = {}
+            for path in dataset.files:
+                files.setdefault(os.path.dirname(path), []).append(path)
+            for directory, paths in files.items():
+                if len(paths) < 2:
+                    continue
+                date = os.path.basename(directory).split("=", 1)[1]
+                data = dataset.to_table(filter=ds.field("date") == date)
+                keys = [("call_id", "ascending")]
+                if table == "segments":
+                    keys.append(("start", "ascending"))
+                self._write_table(table, data.sort_by(keys))
+                for path in paths:
+                    os.unlink(path)
+                compacted.add(date)
+        return len(compacted)
@@ -0,0 +1,209 @@
+import bisect
+from typing import List, Optional, Sequence, Tuple
+
+# Key of the result that keeps regions of the record the audio sent for recognition
+# was made of, in seconds
+RESULT_KEY = "speech_regions"
+
+
+class VoiceDetector:
+    """Finds speech in PCM samples by energy and zero-crossing rate of short frames.
+
+    A frame louder than the noise floor of the record by margin_db, and than min_db, is
+    speech. A quieter one still is if it's within unvoiced_db of that threshold and
+    crosses zero often, as unvoiced consonants do. Speech shorter than min_speech is
+    dropped, the rest is padded by padding seconds on both sides.
+
+    Silence is trimmed at the start and the end of the record only, unless max_silence
+    is set: then pauses longer than that are cut out too, leaving padding around speech."""
+
+    def __init__(
+        self,
+        frame_ms: int = 30,
+        margin_db: float = 12.0,
+        min_db: float = -50.0,
+        unvoiced_db: float = 6.0,
+        min_zcr: float = 0.3,
+        min_speech: float = 0.2,
+        padding: float = 0.3,
+        max_silence: Optional[float] = None,
+        block_frames: int = 4096,
+    ) -> None:
+        self.frame_ms = frame_ms
+        self.margin_db = margin_db
+        self.min_db = min_db
+        self.unvoiced_db = unvoiced_db
+        self.min_zcr = min_zcr
+        self.min_speech = min_speech
+        self.padding = padding
+        self.max_silence = max_silence
+        # Frames analysed at a time, bounds memory used for long records
+        self.block_frames = block_frames
+
+    def frame_stats(self, samples, sample_rate: int) -> Tuple:
+        """Returns level in dBFS and zero-crossing rate of every frame, taken from the
+        loudest channel of the frame. Samples are an array of (frames, channels)."""
+        import numpy as np
+
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        size = max(1, sample_rate * self.frame_ms // 1000)
+        count = len(samples) // size
+        levels = np.empty(count)
+        zcr = np.empty(count)
+        center, scale = _sample_range(samples.dtype)
+        for start in range(0, count, self.block_frames):
+            stop = min(count, start + self.block_frames)
+            block = samples[start * size : stop * size].astype(np.float64)
+            block = ((block - center) / scale).reshape(stop - start, size, -1)
+            rms = np.sqrt(np.mean(block**2, axis=1))
+            crossings = np.mean(np.signbit(block[:, 1:]) != np.signbit(block[:, :-1]), axis=1)
+            loudest = rms.argmax(axis=1)
+            rows = np.arange(stop - start)
+            levels[start:stop] = 20 * np.log10(np.maximum(rms[rows, loudest], 1e-10))
+            zcr[start:stop] = crossings[rows, loudest]
+        return levels, zcr
+
+    def detect(self, samples, sample_rate: int) -> List[Tuple[int, int]]:
+        """Returns regions of the samples to keep as (start, stop) sample frames, empty
+        if there's no speech"""
+        import numpy as np
+
+        levels, zcr = self.frame_stats(samples, sample_rate)
+        if not len(levels):
+            return []
+        threshold = max(float(np.percentile(levels, 10)) + self.margin_db, self.min_db)
+        speech = (levels > threshold) | (
+            (levels > threshold - self.unvoiced_db) & (zcr > self.min_zcr)
+        )
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], speech.astype(np.int8), [0]))))
+        size = max(1, sample_rate * self.frame_ms // 1000)
+        pad = int(self.padding * sample_rate)
+        regions: List[Tuple[int, int]] = []
+        for start, stop in zip(edges[0::2] * size, edges[1::2] * size):
+            if stop - start < self.min_speech * sample_rate:
+                continue
+            start, stop = max(0, int(start) - pad), min(len(samples), int(stop) + pad)
+            gap = start - regions[-1][1] if regions else 0
+            if regions and (self.max_silence is None or gap <= self.max_silence * sample_rate):
+                regions[-1] = (regions[-1][0], stop)
+            else:
+                regions.append((start, stop))
+        return regions
+
+    def cut_points(
+        self,
+        samples,
+        sample_rate: int,
+        chunk_seconds: float,
+        search_seconds: Optional[float] = None,
+    ) -> List[int]:
+        """Returns sample frames to cut the samples at into chunks of about chunk_seconds.
+        Every cut is made in the quietest stretch within search_seconds of the length,
+        a fifth of it by default, so words aren't cut in half. No cuts are made if the
+        samples are shorter than that."""
+        import numpy as np
+
+        levels, _ = self.frame_stats(samples, sample_rate)
+        size = max(1, sample_rate * self.frame_ms // 1000)
+        chunk = max(1, int(chunk_seconds * 1000 / self.frame_ms))
+        search = int((chunk_seconds / 5 if search_seconds is None else search_seconds) * 1000)
+        search = min(search // self.frame_ms, chunk - 1)
+        # Level averaged over 300 ms finds a pause rather than a gap between syllables
+        width = max(1, 300 // self.frame_ms)
+        smoothed = np.convolve(levels, np.ones(width) / width, mode="same")
+        cuts: List[int] = []
+        start = 0
+        while len(levels) - start > chunk + search:
+            low = start + chunk - search
+            quietest = low + int(np.argmin(smoothed[low : start + chunk + search + 1]))
+            cuts.append(quietest * size + size // 2)
+            start = quietest
+        return cuts
+
+
+def _sample_range(dtype) -> Tuple[float, float]:
+    """Returns value of silence and full scale of PCM samples of the type"""
+    if dtype.kind == "f":
+        return 0.0, 1.0
+    if dtype.kind == "u":
+        half = float(1 << (dtype.itemsize * 8 - 1))
+        return half, half
+    return 0.0, float(1 << (dtype.itemsize * 8 - 1))
+
+
+class OffsetMap:
+    """Maps times in audio made of regions of a record back to times in the record.
+    Regions are (start, end) in seconds of the record, in order."""
+
+    def __init__(self, regions: Sequence[Sequence[float]]) -> None:
+        self.regions = [(float(start), float(end)) for start, end in regions]
+        # Where every region starts in the audio made of them
+        self.starts: List[float] = []
+        position = 0.0
+        for start, end in self.regions:
+            self.starts.append(position)
+            position += end - start
+        self.duration = position
+
+    @classmethod
+    def from_frames(cls, regions: Sequence[Tuple[int, int]], sample_rate: int) -> "OffsetMap":
+        return cls([(start / sample_rate, stop / sample_rate) for start, stop in regions])
+
+    @classmethod
+    def from_result(cls, result: dict) -> Optional["OffsetMap"]:
+        """Returns the map kept in the result, None if its times are those of the record"""
+        regions = result.get(RESULT_KEY) if isinstance(result, dict) else None
+        return cls(regions) if regions else None
+
+    def frames(self, sample_rate: int) -> List[Tuple[int, int]]:
+        return [(round(start * sample_rate), round(end * sample_rate)) for start, end in self]
+
+    def slice(self, start: float, end: float) -> "OffsetMap":
+        """Returns map of the parts of the regions between start and end of the record"""
+        return OffsetMap(
+            [(max(s, start), min(e, end)) for s, e in self.regions if s < end and e > start]
+        )
+
+    def __iter__(self):
+        return iter(self.regions)
+
+    def __len__(self) -> int:
+        return len(self.regions)
+
+    def to_original(self, time: float, end: bool = False) -> float:
+        """Returns time in the record. A time on the border of two regions is taken as
+        the start of the later one, or the end of the earlier one if end is set."""
+        if not self.regions:
+            return time
+        find = bisect.bisect_left if end else bisect.bisect_right
+        i = max(0, find(self.starts, time) - 1)
+        return self.regions[i][0] + time - self.starts[i]
+
+    def attach(self, result: dict) -> dict:
+        """Keeps the map in the result, so times of the record can be restored later"""
+        result[RESULT_KEY] = [list(region) for region in self.regions]
+        return result
+
+    def restore(self, result: dict) -> dict:
+        """Rewrites times of the result in place to times of the record and removes the
+        map from it"""
+        result.pop(RESULT_KEY, None)
+        # whisperX API, words are also listed apart from segments in word_segments
+        items = list(result.get("word_segments", []))
+        for segment in result.get("segments", []):
+            items.append(segment)
+            items.extend(segment.get("words", []))
+        for item in items:
+            if "start" in item:
+                item["start"] = self.to_original(item["start"])
+            if "end" in item:
+                item["end"] = self.to_original(item["end"], end=True)
+        # SpeechKit API, times are strings like "1.230s"
+        for chunk in result.get("response", {}).get("chunks", []):
+            for alternative in chunk["alternatives"]:
+                for word in alternative.get("words", []):
+                    start = self.to_original(float(word["startTime"].rstrip("s")))
+                    end = self.to_original(float(word["endTime"].rstrip("s")), end=True)
+                    word["startTime"], word["endTime"] = f"{start:.3f}s", f"{end:.3f}s"
+        return result
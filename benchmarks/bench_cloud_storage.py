@@ -0,0 +1,81 @@
+# Compares uploads per second to a local moto S3 server when every upload builds its own
+# session and client (previous behavior) and when uploads share the pooled client.
+# Requires moto[server] (included in the dev extra).
+# Usage: python benchmarks/bench_cloud_storage.py --files 200 --concurrency 16
+
+import asyncio
+import logging
+import os
+import tempfile
+import time
+import boto3
+import click
+from moto.server import ThreadedMotoServer
+from speechkitty.cloud_storage import CloudStorage
+
+BUCKET_NAME = "bench"
+
+
+async def upload_all(storage: CloudStorage, paths: list, concurrency: int, fresh: bool) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def upload(path):
+        async with semaphore:
+            if fresh:
+                # Same as before: new session and client per call
+                return await loop.run_in_executor(
+                    None, storage.upload_file, path, storage.new_client()
+                )
+            return await storage.upload_file_async(path)
+
+    started = time.perf_counter()
+    links = await asyncio.gather(*[upload(path) for path in paths])
+    elapsed = time.perf_counter() - started
+    assert all(links), "Some uploads failed"
+    return len(paths) / elapsed
+
+
+@click.command()
+@click.option("--files", default=200, show_default=True, help="Number of uploads per run.")
+@click.option("--size", default=64 * 1024, show_default=True, help="File size in bytes.")
+@click.option("--concurrency", default=16, show_default=True, help="Uploads in flight.")
+@click.option("--port", default=5123, show_default=True, help="Port of moto server.")
+def main(files, size, concurrency, port):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+    server.start()
+    temp_dir = tempfile.mkdtemp()
+    try:
+        endpoint = f"http://127.0.0.1:{port}"
+        storage = CloudStorage("key", "secret", BUCKET_NAME)
+        storage.region_name = "us-east-1"
+        storage.storage_endpoint = endpoint
+        boto3.client(
+            "s3",
+            endpoint_url=endpoint,
+            region_name="us-east-1",
+            aws_access_key_id="key",
+            aws_secret_access_key="secret",
+        ).create_bucket(Bucket=BUCKET_NAME)
+
+        paths = []
+        for i in range(files):
+            path = os.path.join(temp_dir, f"{i}.ogg")
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            paths.append(path)
+
+        fresh = asyncio.run(upload_all(storage, paths, concurrency, fresh=True))
+        pooled = asyncio.run(upload_all(storage, paths, concurrency, fresh=False))
+        print(f"client per upload: {fresh:8.1f} uploads/s")
+        print(f"pooled client:     {pooled:8.1f} uploads/s ({pooled / fresh:.1f}x)")
+    finally:
+        server.stop()
+        for name in os.listdir(temp_dir):
+            os.unlink(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# End-to-end throughput of transcribing a synthetic corpus against local stand-ins for
+# SpeechKit, whisperX-REST and Object Storage (see e2e_stubs.py). Prints a JSON report with
+# files per minute, per-file latency percentiles, peak RSS and CPU time, so runs can be
+# compared across versions. Requires moto[server] (included in the dev extra).
+# Usage:
+#   python benchmarks/bench_e2e.py --path async --files 100 --latency-submit exp:0.05
+#   python benchmarks/bench_e2e.py --api whisperx --path sync --error-whisper 0.05 -o r.json
+
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import boto3
+import click
+from e2e_stubs import ENDPOINTS, StandIns
+from speechkitty import Pipeline, Transcriber
+
+BUCKET_NAME = "bench"
+
+
+def make_corpus(path, files, min_duration, max_duration, channels, sample_rate, seed):
+    """Writes WAV files of random duration filled with noise, returns their paths"""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(files):
+        duration = rng.uniform(min_duration, max_duration)
+        frames = int(duration * sample_rate)
+        wav_path = os.path.join(path, f"record-{i:05d}.wav")
+        with wave.open(wav_path, "wb") as f:
+            f.setnchannels(channels)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            # Quiet noise, so that opus has something to encode
+            samples = bytes(rng.getrandbits(4) for _ in range(frames * channels * 2))
+            f.writeframes(samples)
+        paths.append(wav_path)
+    return paths
+
+
+def percentile(values, q):
+    """Nearest-rank percentile"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def peak_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return ""
+
+
+def make_transcriber(api, stand_ins, poll_interval, stream_upload):
+    transcriber = Transcriber(
+        api=api,
+        aws_access_key_id="key",
+        aws_secret_access_key="secret",
+        storage_bucket_name=BUCKET_NAME,
+        transcribe_api_key="key",
+        whisper_endpoint=stand_ins.whisper_endpoint,
+        stream_upload=stream_upload,
+    )
+    transcriber.cloud_storage.region_name = "us-east-1"
+    transcriber.cloud_storage.storage_endpoint = stand_ins.storage_endpoint
+    transcriber.speech_service.transcribe_endpoint = stand_ins.transcribe_endpoint
+    transcriber.speech_service.operation_endpoint = stand_ins.operation_endpoint
+    transcriber.poller.interval = poll_interval
+    return transcriber
+
+
+def run_sync(transcriber, paths, concurrency):
+    def transcribe(path):
+        started = time.perf_counter()
+        result = transcriber.transcribe_file(path)
+        return bool(result), time.perf_counter() - started
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(transcribe, paths))
+
+
+async def run_async(transcriber, paths, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def transcribe(path, session):
+        started = time.perf_counter()
+        result = await transcriber.transcribe_file_async(path, session, semaphore=semaphore)
+        return bool(result), time.perf_counter() - started
+
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[transcribe(path, session) for path in paths])
+
+
+async def run_pipeline(transcriber, paths, concurrency):
+    started = {}
+    outcomes = []
+
+    def admitted():
+        # Latency is counted from the moment the file enters the pipeline
+        for path in paths:
+            started[path] = time.perf_counter()
+            yield path
+
+    async def on_result(path, result):
+        outcomes.append((bool(result), time.perf_counter() - started[path]))
+
+    pipeline = Pipeline(
+        transcriber,
+        on_result=on_result,
+        upload_workers=concurrency,
+        submit_workers=concurrency,
+    )
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(pipeline.executor_workers))
+    async with aiohttp.ClientSession() as session:
+        await pipeline.run(admitted(), session)
+    return outcomes
+
+
+@click.command()
+@click.option("--api", type=click.Choice(["speechkit", "whisperx"]), default="speechkit")
+@click.option("--path", "mode", type=click.Choice(["sync", "async", "pipeline"]), default="async")
+@click.option("--files", default=50, show_default=True, help="Number of files in the corpus.")
+@click.option("--min-duration", default=2.0, show_default=True, help="Seconds.")
+@click.option("--max-duration", default=10.0, show_default=True, help="Seconds.")
+@click.option("--channels", default=1, show_default=True)
+@click.option("--sample-rate", default=8000, show_default=True)
+@click.option("--concurrency", default=10, show_default=True, help="Files in flight.")
+@click.option("--stream-upload", is_flag=True, help="Convert and upload without temp files.")
+@click.option("--poll-interval", default=0.5, show_default=True, help="Seconds between polls.")
+@click.option(
+    "--operation-time",
+    default="fixed:0.5",
+    show_default=True,
+    help="Time SpeechKit takes to finish an operation.",
+)
+@click.option("--latency-submit", default="fixed:0.02", show_default=True)
+@click.option("--latency-operation", default="fixed:0.01", show_default=True)
+@click.option("--latency-whisper", default="fixed:0.2", show_default=True)
+@click.option("--latency-storage", default="fixed:0.01", show_default=True)
+@click.option("--error-submit", default=0.0, show_default=True)
+@click.option("--error-operation", default=0.0, show_default=True)
+@click.option("--error-whisper", default=0.0, show_default=True)
+@click.option("--error-storage", default=0.0, show_default=True)
+@click.option("--seed", default=0, show_default=True)
+@click.option("--output", "-o", default="", help="Write JSON report to file, stdout if empty.")
+def main(
+    api,
+    mode,
+    files,
+    min_duration,
+    max_duration,
+    channels,
+    sample_rate,
+    concurrency,
+    stream_upload,
+    poll_interval,
+    operation_time,
+    seed,
+    output,
+    **kwargs,
+):
+    latency = {name: kwargs[f"latency_{name}"] for name in ENDPOINTS}
+    errors = {name: kwargs[f"error_{name}"] for name in ENDPOINTS}
+    # Failures are expected with error rates set, they are counted in the report
+    warnings.simplefilter("ignore")
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        paths = make_corpus(
+            temp_dir, files, min_duration, max_duration, channels, sample_rate, seed
+        )
+        with StandIns(latency, errors, operation_time, seed) as stand_ins:
+            boto3.client(
+                "s3",
+                endpoint_url=stand_ins.moto_endpoint,
+                region_name="us-east-1",
+                aws_access_key_id="key",
+                aws_secret_access_key="secret",
+            ).create_bucket(Bucket=BUCKET_NAME)
+            transcriber = make_transcriber(api, stand_ins, poll_interval, stream_upload)
+
+            cpu_started = cpu_seconds(resource.RUSAGE_SELF)
+            children_started = cpu_seconds(resource.RUSAGE_CHILDREN)
+            started = time.perf_counter()
+            if mode == "sync":
+                outcomes = run_sync(transcriber, paths, concurrency)
+            elif mode == "async":
+                outcomes = asyncio.run(run_async(transcriber, paths, concurrency))
+            else:
+                outcomes = asyncio.run(run_pipeline(transcriber, paths, concurrency))
+            wall = time.perf_counter() - started
+            cpu = cpu_seconds(resource.RUSAGE_SELF) - cpu_started
+            # ffmpeg processes, stand-ins are still running and not counted
+            children = cpu_seconds(resource.RUSAGE_CHILDREN) - children_started
+            requests = stand_ins.stats()
+    finally:
+        shutil.rmtree(temp_dir)
+
+    latencies = [round(latency, 4) for ok, latency in outcomes if ok]
+    transcribed = len(latencies)
+    report = {
+        "version": {
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "config": {
+            "api": api,
+            "path": mode,
+            "files": files,
+            "duration": [min_duration, max_duration],
+            "channels": channels,
+            "sample_rate": sample_rate,
+            "concurrency": concurrency,
+            "stream_upload": stream_upload,
+            "poll_interval": poll_interval,
+            "operation_time": operation_time,
+            "latency": latency,
+            "errors": errors,
+            "seed": seed,
+        },
+        "transcribed": transcribed,
+        "failed": len(outcomes) - transcribed,
+        "wall_seconds": round(wall, 3),
+        "files_per_minute": round(transcribed / wall * 60, 2),
+        "latency_seconds": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=None),
+        },
+        "peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_SELF), 1),
+        "cpu_seconds": {"process": round(cpu, 3), "ffmpeg": round(children, 3)},
+        "requests": requests,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
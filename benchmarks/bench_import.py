@@ -0,0 +1,78 @@
+# Measures import time of the package entry points with python -X importtime and checks
+# them against a budget, exiting with an error if one is exceeded.
+# Usage: python benchmarks/bench_import.py --budget directory=30 --budget parser=30
+
+import subprocess
+import sys
+import click
+
+ENTRY_POINTS = {
+    "package": "import speechkitty",
+    "directory": "from speechkitty import Directory",
+    "parser": "from speechkitty import Parser",
+    "transcriber": "from speechkitty import Transcriber",
+    "pipeline": "from speechkitty import Pipeline",
+}
+# Milliseconds, for the entry points cron workers start with
+BUDGETS = {"package": 20, "directory": 30, "parser": 30}
+
+
+def import_times(statement: str) -> dict:
+    """Returns cumulative import time of each top level module in microseconds"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # Nested imports are indented
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def measure(statement: str, repeat: int) -> tuple:
+    """Returns import time in milliseconds, the best of repeat runs, not counting modules
+    imported at interpreter startup, and the heaviest modules"""
+    best = None
+    for _ in range(repeat):
+        baseline = import_times("pass")
+        times = {k: v for k, v in import_times(statement).items() if k not in baseline}
+        if best is None or sum(times.values()) < sum(best.values()):
+            best = times
+    heaviest = sorted(best, key=best.get, reverse=True)[:3]
+    return sum(best.values()) / 1000, [f"{name} {best[name] / 1000:.1f}" for name in heaviest]
+
+
+@click.command()
+@click.option("--repeat", default=5, show_default=True, help="Runs per entry point, best taken.")
+@click.option(
+    "--budget",
+    multiple=True,
+    help="NAME=MS, import time allowed for an entry point. Overrides the defaults.",
+)
+def main(repeat, budget):
+    budgets = dict(BUDGETS)
+    for item in budget:
+        name, ms = item.split("=")
+        budgets[name] = float(ms)
+    exceeded = []
+    print(f"{'entry point':<14}{'ms':>9}{'budget':>9}  heaviest modules, ms")
+    for name, statement in ENTRY_POINTS.items():
+        ms, heaviest = measure(statement, repeat)
+        limit = budgets.get(name)
+        if limit is not None and ms > limit:
+            exceeded.append(name)
+        limit_text = "" if limit is None else f"{limit:g}"
+        print(f"{name:<14}{ms:>9.1f}{limit_text:>9}  {', '.join(heaviest)}")
+    if exceeded:
+        raise click.ClickException(f"Over the import time budget: {', '.join(exceeded)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Measures how Parser.parse_result and Parser.parse_segments scale with the number of segments.
+# The legacy implementation (pd.concat per segment) is included for comparison.
+# Usage: python benchmarks/bench_parser.py --sizes 10,1000,50000
+
+import random
+import time
+import click
+import pandas as pd
+from speechkitty import Parser
+
+
+def whisper_result(n: int) -> dict:
+    segments = []
+    start = 0.0
+    for i in range(n):
+        end = start + random.uniform(0.5, 5.0)
+        segments.append({"start": round(start, 3), "end": round(end, 3), "text": f" phrase {i}"})
+        start = end + random.uniform(0.0, 1.0)
+    return {"segments": segments}
+
+
+def speechkit_result(n: int) -> dict:
+    chunks = []
+    start = 0.0
+    for i in range(n):
+        end = start + random.uniform(0.5, 5.0)
+        words = [
+            {"startTime": f"{start:.3f}s", "endTime": f"{start + 0.2:.3f}s", "word": "phrase"},
+            {"startTime": f"{end - 0.2:.3f}s", "endTime": f"{end:.3f}s", "word": str(i)},
+        ]
+        chunks.append(
+            {
+                "alternatives": [{"words": words, "text": f"phrase {i}"}],
+                "channelTag": str(i % 2 + 1),
+            }
+        )
+        start = end + random.uniform(0.0, 1.0)
+    return {"done": True, "response": {"chunks": chunks}}
+
+
+def legacy_parse_result(result) -> pd.DataFrame:
+    df = pd.DataFrame()
+    if "segments" in result:
+        for chunk in result["segments"]:
+            row = dict()
+            row["startTime"] = [chunk["start"]]
+            row["endTime"] = [chunk["end"]]
+            row["channelTag"] = [chunk["speaker"]] if "speaker" in chunk else [1]
+            row["text"] = [chunk["text"]]
+            df = pd.concat([df, pd.DataFrame(row)], ignore_index=True)
+    else:
+        for chunk in result["response"]["chunks"]:
+            row = dict()
+            row["startTime"] = [chunk["alternatives"][0]["words"][0]["startTime"].replace("s", "")]
+            row["endTime"] = [chunk["alternatives"][0]["words"][-1]["endTime"].replace("s", "")]
+            row["channelTag"] = [chunk["channelTag"]]
+            row["text"] = [chunk["alternatives"][0]["text"]]
+            df = pd.concat([df, pd.DataFrame(row)], ignore_index=True)
+    df["startTime"] = pd.to_numeric(df["startTime"])
+    df["endTime"] = pd.to_numeric(df["endTime"])
+    return df.sort_values("startTime").reset_index(drop=True)
+
+
+def measure(func, result, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(result)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+@click.command()
+@click.option("--sizes", default="10,1000,50000", show_default=True, help="Segment counts.")
+@click.option("--repeat", default=3, show_default=True, help="Runs per measurement, best taken.")
+@click.option(
+    "--legacy-max",
+    default=5000,
+    show_default=True,
+    help="Largest size to run the quadratic legacy implementation on.",
+)
+def main(sizes, repeat, legacy_max):
+    parser = Parser()
+    print(f"{'api':<10}{'segments':>10}{'legacy, s':>14}{'parse_result, s':>18}{'segments, s':>14}")
+    for n in [int(size) for size in sizes.split(",")]:
+        for api, result in (("whisperX", whisper_result(n)), ("SpeechKit", speechkit_result(n))):
+            legacy = measure(legacy_parse_result, result, repeat) if n <= legacy_max else None
+            frame = measure(parser.parse_result, result, repeat)
+            segments = measure(parser.parse_segments, result, repeat)
+            legacy_str = f"{legacy:.4f}" if legacy is not None else "skipped"
+            print(f"{api:<10}{n:>10}{legacy_str:>14}{frame:>18.4f}{segments:>14.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Measures Parser.create_html against the previous rendering with pivot_table and to_html.
+# Usage: python benchmarks/bench_render.py --sizes 10,1000,20000
+
+import io
+import click
+import pandas as pd
+from bench_parser import measure, speechkit_result, whisper_result
+from speechkitty import Parser
+
+
+def pandas_html(parser: Parser, df: pd.DataFrame) -> str:
+    df = df.pivot_table(
+        index=["startTime", "endTime"],
+        values="text",
+        columns=["channelTag"],
+        aggfunc="first",
+        fill_value="",
+        observed=True,
+    )
+    return parser.header + df.to_html(index=True) + parser.footer
+
+
+@click.command()
+@click.option("--sizes", default="10,1000,20000", show_default=True, help="Segment counts.")
+@click.option("--repeat", default=3, show_default=True, help="Runs per measurement, best taken.")
+def main(sizes, repeat):
+    parser = Parser()
+    print(f"{'api':<10}{'segments':>10}{'pandas, s':>12}{'dataframe, s':>15}{'segments, s':>14}")
+    for n in [int(size) for size in sizes.split(",")]:
+        for api, result in (("whisperX", whisper_result(n)), ("SpeechKit", speechkit_result(n))):
+            df = parser.parse_result(result)
+            segments = parser.parse_segments(result)
+            assert parser.create_html(df) == pandas_html(parser, df)
+            legacy = measure(lambda df: pandas_html(parser, df), df, repeat)
+            frame = measure(parser.create_html, df, repeat)
+            # Written to a file handle as it would be when saving
+            streamed = measure(lambda s: parser.write_html(s, io.StringIO()), segments, repeat)
+            print(f"{api:<10}{n:>10}{legacy:>12.4f}{frame:>15.4f}{streamed:>14.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+# Measures Parser.render_directory on a generated directory of results: rendering every
+# file in one process and in a pool, and a run with nothing changed.
+# Usage: python benchmarks/bench_render_directory.py --files 10000 --segments 200
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import click
+from bench_parser import whisper_result
+from speechkitty import Parser
+
+
+def timed(func, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+@click.command()
+@click.option("--files", default=2000, show_default=True, help="Number of results.")
+@click.option("--segments", default=200, show_default=True, help="Segments per result.")
+@click.option("--workers", default=None, type=int, help="Processes, CPU count by default.")
+def main(files, segments, workers):
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for i in range(files):
+            sub_dir = os.path.join(temp_dir, f"{i // 1000:03d}")
+            os.makedirs(sub_dir, exist_ok=True)
+            with open(os.path.join(sub_dir, f"{i}.json"), "w") as f:
+                json.dump(whisper_result(segments), f)
+        parser = Parser()
+        single, _ = timed(parser.render_directory, temp_dir, workers=1, force=True)
+        pool, counts = timed(parser.render_directory, temp_dir, workers=workers, force=True)
+        assert counts["rendered"] == files
+        noop, counts = timed(parser.render_directory, temp_dir, workers=workers)
+        assert counts["unchanged"] == files
+        print(f"{'run':<16}{'s':>9}{'files/s':>10}")
+        for run, seconds in (("one process", single), ("pool", pool), ("nothing changed", noop)):
+            print(f"{run:<16}{seconds:>9.3f}{files / seconds:>10.0f}")
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# Local stand-ins for SpeechKit, whisperX-REST and Object Storage used by bench_e2e.py.
+# Every endpoint delays its response by a value drawn from a latency distribution and fails
+# with the given probability. Object Storage is moto behind a proxy that adds latency and
+# errors the same way. Stand-ins run in a separate process, so that their CPU time and
+# memory don't count towards the measured client.
+
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import time
+import uuid
+from typing import Callable, Dict
+
+RECORDS_DIR = os.path.join(os.path.dirname(__file__), "..", "sample", "records")
+SPEECHKIT_RESULT = "rg-170-74994043564-20231021-171101-1697897360.54.json"
+WHISPER_RESULT = "rg-170-74994043564-20231021-171101-1697897360.54.whisper.json"
+ENDPOINTS = ["submit", "operation", "whisper", "storage"]
+# Headers that aiohttp sets itself when passing the response on
+HOP_HEADERS = {"connection", "content-length", "content-encoding", "transfer-encoding"}
+
+
+def parse_distribution(spec: str) -> Callable[[random.Random], float]:
+    """Parses distribution spec into a sampler of seconds. Supported specs:
+    fixed:S, uniform:A:B, exp:MEAN and lognormal:MEDIAN:SIGMA"""
+    name, *args = spec.split(":")
+    values = [float(arg) for arg in args]
+    if name == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if name == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if name == "exp" and len(values) == 1:
+        return lambda rng: rng.expovariate(1 / values[0]) if values[0] > 0 else 0.0
+    if name == "lognormal" and len(values) == 2:
+        import math
+
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Unknown distribution: {spec}")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class StandIns:
+    def __init__(
+        self,
+        latency: Dict[str, str],
+        errors: Dict[str, float],
+        operation_time: str = "fixed:0.5",
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.errors = errors
+        self.operation_time = operation_time
+        self.seed = seed
+        self.port = free_port()
+        self.storage_port = free_port()
+        self.moto_port = free_port()
+        self._process = None
+
+    @property
+    def transcribe_endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}/speech/stt/v2/longRunningRecognize"
+
+    @property
+    def operation_endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}/operations"
+
+    @property
+    def whisper_endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.port}/whisperx?output=json"
+
+    @property
+    def storage_endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.storage_port}"
+
+    @property
+    def moto_endpoint(self) -> str:
+        return f"http://127.0.0.1:{self.moto_port}"
+
+    def __getstate__(self) -> dict:
+        # Sent to the child process, which doesn't need the handle of itself
+        state = self.__dict__.copy()
+        state["_process"] = None
+        return state
+
+    def start(self, timeout: float = 30.0) -> None:
+        context = multiprocessing.get_context("spawn")
+        self._process = context.Process(target=self._serve, daemon=True)
+        self._process.start()
+        deadline = time.monotonic() + timeout
+        for port in (self.port, self.storage_port, self.moto_port):
+            while True:
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline or not self._process.is_alive():
+                        self.stop()
+                        raise RuntimeError("Stand-ins didn't start")
+                    time.sleep(0.05)
+
+    def stats(self) -> dict:
+        import requests
+
+        return requests.get(f"http://127.0.0.1:{self.port}/_stats").json()
+
+    def stop(self) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self) -> "StandIns":
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def _serve(self) -> None:
+        from moto.server import ThreadedMotoServer
+
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        moto = ThreadedMotoServer(ip_address="127.0.0.1", port=self.moto_port, verbose=False)
+        moto.start()
+        asyncio.run(self._serve_async())
+
+    async def _serve_async(self) -> None:
+        import aiohttp
+        from aiohttp import web
+
+        rng = random.Random(self.seed)
+        latency = {
+            name: parse_distribution(self.latency.get(name, "fixed:0")) for name in ENDPOINTS
+        }
+        operation_time = parse_distribution(self.operation_time)
+        with open(os.path.join(RECORDS_DIR, SPEECHKIT_RESULT), "rb") as f:
+            speechkit_result = json.loads(f.read())
+        with open(os.path.join(RECORDS_DIR, WHISPER_RESULT), "rb") as f:
+            whisper_result = json.loads(f.read())
+        operations: Dict[str, float] = {}
+        counts = {name: {"requests": 0, "errors": 0} for name in ENDPOINTS}
+
+        async def respond(name: str) -> bool:
+            """Waits for the latency of the endpoint, returns False if request should fail"""
+            counts[name]["requests"] += 1
+            await asyncio.sleep(latency[name](rng))
+            if rng.random() < self.errors.get(name, 0.0):
+                counts[name]["errors"] += 1
+                return False
+            return True
+
+        async def submit(request):
+            await request.json()
+            if not await respond("submit"):
+                return web.json_response({"message": "Internal"}, status=500)
+            id = uuid.uuid4().hex
+            operations[id] = time.monotonic() + operation_time(rng)
+            return web.json_response({"id": id, "done": False})
+
+        async def operation(request):
+            if not await respond("operation"):
+                return web.json_response({"message": "Internal"}, status=500)
+            id = request.match_info["id"]
+            if id not in operations:
+                return web.json_response({"message": "Not found"}, status=404)
+            if time.monotonic() < operations[id]:
+                return web.json_response({"id": id, "done": False})
+            del operations[id]
+            return web.json_response(dict(speechkit_result, id=id))
+
+        async def whisper(request):
+            await request.read()
+            if not await respond("whisper"):
+                return web.json_response({"message": "Internal"}, status=500)
+            return web.json_response(whisper_result)
+
+        async def stats(request):
+            return web.json_response(counts)
+
+        session = aiohttp.ClientSession(auto_decompress=False)
+
+        async def storage(request):
+            body = await request.read()
+            if not await respond("storage"):
+                error = "<Error><Code>InternalError</Code><Message>Injected</Message></Error>"
+                return web.Response(status=500, text=error, content_type="application/xml")
+            async with session.request(
+                request.method,
+                self.moto_endpoint + request.path_qs,
+                headers={k: v for k, v in request.headers.items() if k.lower() != "host"},
+                data=body,
+            ) as response:
+                data = await response.read()
+                headers = {
+                    k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS
+                }
+                return web.Response(status=response.status, headers=headers, body=data)
+
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_post("/speech/stt/v2/{mode}", submit)
+        app.router.add_get("/operations/{id}", operation)
+        app.router.add_post("/whisperx", whisper)
+        app.router.add_get("/_stats", stats)
+        storage_app = web.Application(client_max_size=1024**3)
+        storage_app.router.add_route("*", "/{tail:.*}", storage)
+
+        runners = []
+        for application, port in ((app, self.port), (storage_app, self.storage_port)):
+            runner = web.AppRunner(application, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            runners.append(runner)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await session.close()
+            for runner in runners:
+                await runner.cleanup()
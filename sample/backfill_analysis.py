@@ -5,7 +5,12 @@ from dotenv import find_dotenv, load_dotenv
 import click
 import logging
 import requests
-from speechkitty import Directory
+from speechkitty import Directory, TranscriptStore
+
+
+def read_json(filename: str) -> dict:
+    with open(filename, "r") as f:
+        return json.load(f)
 
 
 @click.command()
@@ -67,6 +72,14 @@ from speechkitty import Directory
     type=bool,
     help="Enable dry run mode.",
 )
+@click.option(
+    "store_path",
+    "--store",
+    default="",
+    show_default=True,
+    type=click.Path(),
+    help="Read results from a transcript store instead of json files, ingesting new ones.",
+)
 def main(
     rec_dir,
     extension,
@@ -75,31 +88,42 @@ def main(
     right_suffix,
     webhook_url,
     dry_run,
+    store_path,
 ):
     logger = logging.getLogger(__name__)
 
     load_dotenv(find_dotenv())
 
-    dir = Directory(rec_dir)
-    regexp_include = ".+\\.json"
-    json_files = dir.get_records(
-        regexp_include=regexp_include, regexp_exclude=f"{right_suffix}|{left_suffix}"
-    )
-
-    records = pd.DataFrame(json_files, columns=["filename"]).tail(limit)
-
-    for i, row in enumerate(records.iterrows(), start=1):
-        logger.info(f"Starting processing transcription {i} of {len(records)}")
+    if store_path:
+        # One dataset is read instead of a json file per call
+        store = TranscriptStore(store_path)
+        store.ingest_directory(rec_dir)
+        calls = store.calls(columns=["call_id", "ingested_at"]).to_pandas()
+        calls = calls[~calls["call_id"].str.contains(f"{right_suffix}|{left_suffix}")]
+        call_ids = calls.sort_values("ingested_at")["call_id"].tail(limit).tolist()
+        results = (
+            (call_id + extension, result) for call_id, result in store.iter_results(call_ids)
+        )
+        total = len(call_ids)
+    else:
+        dir = Directory(rec_dir)
+        regexp_include = ".+\\.json"
+        json_files = dir.get_records(
+            regexp_include=regexp_include, regexp_exclude=f"{right_suffix}|{left_suffix}"
+        )
+        records = pd.DataFrame(json_files, columns=["filename"]).tail(limit)
+        results = ((filename, read_json(filename)) for filename in records["filename"])
+        total = len(records)
 
-        with open(row[1].filename, "r") as f:
-            result = json.load(f)
+    for i, (filename, result) in enumerate(results, start=1):
+        logger.info(f"Starting processing transcription {i} of {total}")
 
         # Send webhook if URL is provided
         if webhook_url and result.get("segments"):
             try:
                 logger.info(f"Sending webhook to {webhook_url}")
                 # Add file name to payload
-                file_name = os.path.basename(row[1].filename)
+                file_name = os.path.basename(filename)
                 result["file_name"] = file_name.replace(".json", ".wav")
                 result["transcript_id"] = ".".join(file_name.split(".")[:-1])
                 result["quiet"] = True
@@ -1,11 +1,12 @@
 # Given the phone call recording consists of two files for each part a conversation
 # and these files have suffixes .wav-in and .wav-out (inbound and outbound)
-# the script combines two records into a stereo file
+# the script combines two records into a stereo file.
+# To transcribe the calls with SpeechKit there's no need for the stereo files, see
+# transcribe_split_channels.py --api SpeechKit, which interleaves the legs on the fly.
 
 import sys
-import pandas as pd
-from pydub import AudioSegment
 from speechkitty import Directory
+from speechkitty.audio_converter import AudioConverter, _wav_header
 
 
 def main():
@@ -15,36 +16,27 @@ def main():
         print("Not enough arguments.")
         return 1
 
-    dir = Directory(rec_dir)
-
-    include = "(?:-in|-out)\\.wav"
-    wavs = dir.get_records(regexp_include=include, skip_processed=True)
-
-    df = pd.DataFrame(wavs, columns=["filename"])
-
-    df.loc[:, "recordingfile"] = df["filename"].str.replace(".wav-in", "", regex=False)
-    df.loc[:, "recordingfile"] = df["recordingfile"].str.replace(".wav-out", "", regex=False)
-    df.loc[:, "channel"] = df["filename"].apply(
-        lambda x: "inbound" if "wav-in" in x else "outbound"
-    )
-
-    if len(df) == 0:
-        return
-
-    df = df.pivot_table(
-        index=["recordingfile"],
-        values="filename",
-        columns=["channel"],
-        aggfunc="first",
-    )
-
-    for row in df.itertuples():
-        inbound = AudioSegment.from_wav(row.inbound)
-        outbound = AudioSegment.from_wav(row.outbound)
-        inbound = inbound.pan(-1)
-        outbound = outbound.pan(1)
-        mix = inbound.overlay(outbound)
-        mix.export(row.Index + "-mix.wav", format="wav")
+    converter = AudioConverter()
+    pairs = Directory(rec_dir).get_pairs(skip_processed=True)
+
+    for record_path, inbound, outbound in pairs:
+        if not inbound or not outbound:
+            continue
+        try:
+            info = converter.pair_info(inbound, outbound)
+        except ValueError as e:
+            print(f"Skipping {record_path}: {e}")
+            continue
+        # wave writes integer PCM only, the header is made for the format of the legs, float
+        # included, once the size of the data is known
+        header_size = len(_wav_header(info, 0))
+        with open(record_path + "-mix.wav", "wb") as mix:
+            mix.seek(header_size)
+            # Inbound goes to the left channel, outbound to the right one
+            converter.interleave(inbound, outbound, mix)
+            data_size = mix.tell() - header_size
+            mix.seek(0)
+            mix.write(_wav_header(info, data_size))
 
 
 if __name__ == "__main__":
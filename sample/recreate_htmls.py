@@ -1,10 +1,9 @@
 # Re-creates html files in a directory.
 # Run it after changing html template to make html files uniform.
+# Files are rendered by a pool of processes, only those whose results or template changed.
 
-import json
 import sys
-import traceback
-from speechkitty import Directory, Parser
+from speechkitty import Parser
 
 
 def main():
@@ -19,33 +18,12 @@ def main():
     except Exception:
         filename_hash_func = ""
 
-    # Set up directory
-    directory = Directory(rec_dir)
-
-    # Find files recursively
-    jsons = directory.get_records(regexp_include=".+\\.json", skip_processed=False)
-
     parser = Parser()
-
-    for filename in jsons:
-        with open(filename, "r") as f:
-            result = f.read()
-        result = json.loads(result)
-        wav_path = filename[:-5] + ".wav"
-        try:
-            df = parser.parse_result(result)
-        except Exception:
-            print("exception in parse_result():", wav_path)
-            print(traceback.format_exc())
-            continue
-
-        if df is None:
-            continue
-        html = parser.create_html(df)
-        html_path = parser.name_html(wav_path, hash_func=filename_hash_func)
-        # Write table
-        with open(html_path, "w") as f:
-            f.write(html)
+    counts = parser.render_directory(rec_dir, hash_func=filename_hash_func)
+    print(
+        f"Rendered: {counts['rendered']}, unchanged: {counts['unchanged']}, "
+        f"failed: {counts['failed']}"
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,47 @@
+# Searches transcripts by phrase using a full-text index of the results.
+# Run update from cron to index new results, then query the index:
+#   python sample/search_transcripts.py --index search.sqlite update /mnt/Records
+#   python sample/search_transcripts.py --index search.sqlite query "проверку зрения"
+
+import click
+from speechkitty import SearchIndex
+
+
+@click.group()
+@click.option(
+    "index_path",
+    "--index",
+    default="search.sqlite",
+    show_default=True,
+    type=click.Path(),
+    help="SQLite file of the index.",
+)
+@click.pass_context
+def main(ctx, index_path):
+    ctx.obj = SearchIndex(index_path)
+    ctx.call_on_close(ctx.obj.close)
+
+
+@main.command()
+@click.argument("rec_dir", type=click.Path(exists=True))
+@click.option("--full", is_flag=True, help="Check all results, not only the new ones.")
+@click.pass_obj
+def update(index, rec_dir, full):
+    """Indexes results modified since the previous update."""
+    print(f"Indexed: {index.update(rec_dir, full=full)}")
+
+
+@main.command()
+@click.argument("phrase")
+@click.option("--limit", default=20, show_default=True, help="Number of hits.")
+@click.option("--channel", default=None, help="Search only this channel.")
+@click.option("--raw", is_flag=True, help="Pass FTS5 query syntax through.")
+@click.pass_obj
+def query(index, phrase, limit, channel, raw):
+    """Prints segments containing the phrase, best matches first."""
+    for hit in index.search(phrase, limit=limit, channel=channel, raw=raw):
+        print(f"{hit.json_path}\t{hit.channel}\t{hit.start:.2f}-{hit.end:.2f}\t{hit.text.strip()}")
+
+
+if __name__ == "__main__":
+    main()
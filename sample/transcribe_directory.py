@@ -3,78 +3,158 @@ import json
 import os
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp
 import click
-from speechkitty import Directory, Transcriber, Parser
+from speechkitty import (
+    Directory,
+    JobJournal,
+    MetricsRegistry,
+    Transcriber,
+    Parser,
+    Pipeline,
+    ResultCache,
+    VoiceDetector,
+)
 from dotenv import find_dotenv, load_dotenv
 
 
-async def process_file(wav_path, transcriber, parser, session, semaphore, filename_hash_func):
-    async with semaphore:
-        try:
-            result = await transcriber.transcribe_file_async(wav_path, session)
+def save_result(wav_path, result, parser, filename_hash_func):
+    # Compose resulting json path
+    json_path = wav_path[:-4] + ".json"
 
-            # Compose resulting json path
-            json_path = wav_path[:-4] + ".json"
+    # Create empty json to skip the wav during next runs
+    if not result:
+        with open(json_path, "w") as f:
+            f.write("")
+        return
 
-            # Create empty json to skip the wav during next runs
-            if not result:
-                with open(json_path, "w") as f:
-                    f.write("")
-                return
-
-            with open(json_path, "w") as f:
-                f.write(json.dumps(result, ensure_ascii=False))
-
-            # Parse json into pandas dataframe
-            try:
-                # cpu bound, but fast enough for now, or run in executor
-                df = parser.parse_result(result)
-            except Exception:
-                print("exception in parse_result():", wav_path)
-                print(traceback.format_exc())
-                return
-
-            # Create html table
-            if df is None:
-                return
-            html = parser.create_html(df)
-            html_path = parser.name_html(wav_path, hash_func=filename_hash_func)
-            # Write table
-            with open(html_path, "w") as f:
-                f.write(html)
-        except Exception:
-            print(f"Error processing {wav_path}: {traceback.format_exc()}")
+    with open(json_path, "w") as f:
+        f.write(json.dumps(result, ensure_ascii=False))
 
+    # Parse json into segments sorted by time
+    try:
+        segments = parser.parse_segments(result)
+    except Exception:
+        print("exception in parse_segments():", wav_path)
+        print(traceback.format_exc())
+        return
 
-async def run_processing(wavs, api, language_code, filename_hash_func, limit, webhook_url):
+    # Write html table straight into the file
+    html_path = parser.name_html(wav_path, hash_func=filename_hash_func)
+    with open(html_path, "w") as f:
+        parser.write_html(segments, f)
+
+
+async def run_processing(
+    records,
+    api,
+    language_code,
+    filename_hash_func,
+    convert_workers,
+    upload_workers,
+    submit_workers,
+    webhook_url,
+    stream_upload,
+    cache_dir,
+    metrics_file,
+    journal_path,
+    adaptive_limits,
+    vad,
+    max_silence,
+    chunk_seconds,
+):
+    metrics = MetricsRegistry() if metrics_file else None
     transcriber = Transcriber(
         api=api,  # type: ignore
         language_code=language_code,  # type: ignore
         webhook_url=webhook_url,
         raise_exceptions=False,
+        stream_upload=stream_upload,
+        cache=ResultCache.directory(cache_dir) if cache_dir else None,
+        metrics=metrics,
+        # Operations submitted before a crash or restart are polled instead of resubmitted
+        journal=JobJournal(journal_path) if journal_path else None,
+        adaptive_limits=adaptive_limits,
+        # Silence at the ends of records, and long pauses if max_silence is set, isn't paid for
+        vad=VoiceDetector(max_silence=max_silence or None) if vad else None,
+        # Long records are sent to whisperX in chunks cut at pauses
+        chunk_seconds=chunk_seconds,
     )
-    parser = Parser()
+    parser = Parser(metrics=metrics)
+    loop = asyncio.get_running_loop()
 
-    semaphore = asyncio.Semaphore(limit)
+    async def on_result(wav_path, result):
+        try:
+            if not result:
+                job = await transcriber.resumable_state_async(wav_path)
+                # Operation is still running, no marker so that the next run polls it again
+                if job["state"] == "submitted":
+                    return
+            # Parsing and writing are blocking, keep the event loop free for other stages
+            await loop.run_in_executor(
+                None, save_result, wav_path, result, parser, filename_hash_func
+            )
+        except Exception:
+            print(f"Error processing {wav_path}: {traceback.format_exc()}")
+
+    pipeline = Pipeline(
+        transcriber,
+        on_result=on_result,
+        convert_workers=convert_workers,
+        upload_workers=upload_workers,
+        submit_workers=submit_workers,
+    )
+    # Blocking stages run in the default executor, give them enough threads
+    loop.set_default_executor(ThreadPoolExecutor(pipeline.executor_workers + 2))
 
     async with aiohttp.ClientSession() as session:
-        tasks = []
-        for wav_path in wavs:
-            task = process_file(
-                wav_path, transcriber, parser, session, semaphore, filename_hash_func
-            )
-            tasks.append(task)
+        # Files are read from the scan as the first stage has room for them
+        await pipeline.run((entry.path for entry in records), session)
+
+    if metrics is not None:
+        metrics.write_prometheus(metrics_file)
+
+    # Files weren't marked as processed, the next run picks them up
+    if pipeline.deferred:
+        print(f"{pipeline.deferred} files deferred while the API was failing.")
 
-        await asyncio.gather(*tasks)
+    # If there're no files found just exit silently
+    if not pipeline.transcribed + pipeline.failed + pipeline.deferred:
+        print("No files found.")
 
 
 @click.command()
 @click.argument("rec_dir", type=click.Path(exists=True))
 @click.option("--hash-func", default="", help="Hash function for filenames")
-@click.option("--limit", default=10, help="Max simultaneous API requests")
+@click.option("--convert-workers", default=0, help="Files converted at once, CPU count if 0")
+@click.option("--upload-workers", default=4, help="Files uploaded at once")
+@click.option("--submit-workers", default=4, help="Files submitted at once")
 @click.option("--webhook-url", default="", help="URL to send JSON results to")
-def main(rec_dir, hash_func, limit, webhook_url):
+@click.option("--stream-upload", is_flag=True, help="Upload ffmpeg output without temp files")
+@click.option("--cache-dir", default="", help="Reuse results of already transcribed audio")
+@click.option("--metrics-file", default="", help="Write metrics in Prometheus text format")
+@click.option("--journal", "journal_path", default="", help="Keep state of files to resume runs")
+@click.option("--adaptive-limits", is_flag=True, help="Adapt API concurrency to 429s and latency")
+@click.option("--vad", is_flag=True, help="Don't send silence at the start and end of records")
+@click.option("--max-silence", default=0.0, help="With --vad, cut pauses longer than this too")
+@click.option("--chunk-seconds", default=0.0, help="Split longer records for whisperX, 0 is off")
+def main(
+    rec_dir,
+    hash_func,
+    convert_workers,
+    upload_workers,
+    submit_workers,
+    webhook_url,
+    stream_upload,
+    cache_dir,
+    metrics_file,
+    journal_path,
+    adaptive_limits,
+    vad,
+    max_silence,
+    chunk_seconds,
+):
     load_dotenv(find_dotenv())
 
     api = os.environ.get("API")
@@ -87,22 +167,37 @@ def main(rec_dir, hash_func, limit, webhook_url):
     # Set up directory
     directory = Directory(rec_dir)
 
-    # Find files recursively
-    wavs = directory.get_records(
-        regexp_include=include, regexp_exclude=exclude, skip_processed=True
+    # Find files recursively, records are yielded as the scan goes
+    records = directory.iter_records(
+        regexp_include=include,
+        regexp_exclude=exclude,
+        skip_processed=True,
+        extensions=(".wav",),
     )
 
-    # If there're no files found just exit silently
-    if not wavs:
-        print("No files found.")
-        return
-
-    wavs = list(set(wavs))
-
     # If you want to limit number of records processed
-    # wavs = random.choices(wavs, k=min(len(wavs), 10))
-
-    asyncio.run(run_processing(wavs, api, language_code, hash_func, limit, webhook_url))
+    # records = itertools.islice(records, 10)
+
+    asyncio.run(
+        run_processing(
+            records,
+            api,
+            language_code,
+            hash_func,
+            convert_workers,
+            upload_workers,
+            submit_workers,
+            webhook_url,
+            stream_upload,
+            cache_dir,
+            metrics_file,
+            journal_path,
+            adaptive_limits,
+            vad,
+            max_silence,
+            chunk_seconds,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -1,12 +1,11 @@
+import asyncio
 import os
-import json
 from datetime import datetime
-import pandas as pd
+import aiohttp
 from dotenv import find_dotenv, load_dotenv
 import click
 import logging
-import requests
-from speechkitty import Directory, Transcriber, Parser
+from speechkitty import Directory, Transcriber, TransientError, Parser
 
 
 @click.command()
@@ -42,6 +41,14 @@ from speechkitty import Directory, Transcriber, Parser
     type=str,
     help="Right channel's filename suffix.",
 )
+@click.option(
+    "api",
+    "--api",
+    default="whisperX",
+    show_default=True,
+    type=click.Choice(["whisperX", "SpeechKit"]),
+    help="Speech recognition API.",
+)
 @click.option(
     "skip_processed",
     "--skip_processed",
@@ -72,124 +79,100 @@ def main(
     extension,
     left_suffix,
     right_suffix,
+    api,
     skip_processed,
     hash_func,
     webhook_url,
 ):
-    logger = logging.getLogger(__name__)
-
     load_dotenv(find_dotenv())
+    asyncio.run(
+        transcribe_pairs(
+            rec_dir,
+            extension,
+            left_suffix,
+            right_suffix,
+            api,
+            skip_processed,
+            hash_func,
+            webhook_url,
+        )
+    )
 
-    # This makes sense only for whisperX because SpeechKit transcribes channels separately, so
-    # for SpeechKit combine channels using mix_channels.py and transcribe two for the price of one
-    api = "whisperX"
-    language_code = os.environ.get("LANGUAGE_CODE")
-
-    dir = Directory(rec_dir)
-    regexp_include = f".+(?:{left_suffix}|{right_suffix})\\{extension}"
-    wavs = dir.get_records(regexp_include=regexp_include, skip_processed=skip_processed)
 
-    records = pd.DataFrame(wavs, columns=["filename"])
+async def transcribe_pairs(
+    rec_dir, extension, left_suffix, right_suffix, api, skip_processed, hash_func, webhook_url
+):
+    logger = logging.getLogger(__name__)
 
-    records.loc[:, "recordingfile"] = records["filename"].str.replace(left_suffix, "", regex=False)
-    records.loc[:, "recordingfile"] = records["recordingfile"].str.replace(
-        right_suffix, "", regex=False
-    )
-    records.loc[:, "channel"] = records["filename"].apply(
-        lambda x: "inbound" if left_suffix in x else "outbound"
-    )
+    # SpeechKit transcribes channels separately, so for it the legs are interleaved into
+    # a stereo record on the fly and transcribed two for the price of one
+    language_code = os.environ.get("LANGUAGE_CODE")
 
-    records = records.pivot_table(
-        index=["recordingfile"],
-        values="filename",
-        columns=["channel"],
-        aggfunc="first",
+    # Legs are paired by name, calls already merged are skipped
+    pairs = Directory(rec_dir).get_pairs(
+        left_suffix, right_suffix, extension, skip_processed=skip_processed
     )
 
     transcriber = Transcriber(
         api=api,  # type: ignore
         language_code=language_code,  # type: ignore
-        webhook_url=webhook_url,
         raise_exceptions=False,
     )
     parser = Parser()
 
-    for i, row in enumerate(records.itertuples(), start=1):
-        logger.info(f"Starting processing record {i} of {len(records)}")
-
-        # Skip if modified less than 1 minute ago to avoid processing incomplete files
-        last_edit = max(os.stat(row.inbound).st_mtime, os.stat(row.outbound).st_mtime)
-        if (datetime.now() - datetime.fromtimestamp(last_edit)).seconds < 60:
-            logger.info("File was modified less than a minute ago.")
-            continue
-
-        df = pd.DataFrame()
-        result_combined = dict(segments=[])
-        # Repeat for both channels' recordings
-        for channel, filename in enumerate([row.inbound, row.outbound], start=1):
-            logger.info(f"Transcribing {filename}")
-            # If there's no filename
-            if type(filename) is not str:
-                logger.info("Empty filename.")
+    async with aiohttp.ClientSession() as session:
+        for i, (record_path, inbound, outbound) in enumerate(pairs, start=1):
+            logger.info(f"Starting processing record {i} of {len(pairs)}")
+
+            # Skip if modified less than 1 minute ago to avoid processing incomplete files
+            last_edit = max(os.stat(path).st_mtime for path in (inbound, outbound) if path)
+            if (datetime.now() - datetime.fromtimestamp(last_edit)).seconds < 60:
+                logger.info("File was modified less than a minute ago.")
                 continue
-            # Process file
-            result = transcriber.transcribe_file(filename)
-            # Compose resulting json path
-            json_path = filename[:-4] + ".json"
-            with open(json_path, "w") as f:
-                # If result is empty create empty json file
-                # to skip the wav during next runs
-                if not result:
-                    logger.info("Empty result.")
-                    f.write("")
-                    continue
-                else:
-                    # Add speaker tag
-                    if "segments" in result:
-                        for segment in result["segments"]:  # type: ignore
-                            segment["speaker"] = str(channel)  # type: ignore
-                            if "words" in segment:
-                                for word in segment["words"]:  # type: ignore
-                                    word["speaker"] = str(channel)  # type: ignore
-                        result_combined["segments"] += result["segments"]  # type: ignore
-                    f.write(json.dumps(result, ensure_ascii=False))
-            df_tmp = parser.parse_result(result, channel)
-            df = pd.concat([df, df_tmp], ignore_index=True)
-
-        json_path = row.Index[:-4] + ".json"
-        logger.info(f"Writing combined json to {json_path}")
-        with open(json_path, "w") as f:
-            f.write(json.dumps(result_combined, ensure_ascii=False))
-
-        # Send webhook if URL is provided
-        if webhook_url and result_combined.get("segments"):
+
+            # Both legs are transcribed at the same time
+            logger.info(f"Transcribing {inbound} and {outbound}")
             try:
-                logger.info(f"Sending webhook to {webhook_url}")
-                sales_signals_api_key = os.environ.get("WEBHOOK_API_KEY")
-                headers = {"Authorization": f"Bearer {sales_signals_api_key}"}
-                # Add file name to payload
-                file_name = os.path.basename(row.Index)
-                result_combined["file_name"] = file_name
-                # Remove file extension
-                result_combined["transcript_id"] = ".".join(file_name.split(".")[:-1])
-                response = requests.post(
-                    webhook_url, json=result_combined, headers=headers, timeout=10
+                result = await transcriber.transcribe_pair_async(
+                    inbound, outbound, session, record_path=record_path
                 )
-                response.raise_for_status()
-                logger.info(f"Webhook sent successfully: {response.status_code}")
-            except Exception as e:
-                logger.warning(f"Webhook error: {e}")
-
-        logger.info(f"Combined DataFrame length: {len(df)}")
-
-        if len(df) == 0:
-            continue
-        df = df.sort_values("startTime")
-        html = parser.create_html(df)
-        htmlpath = parser.name_html(row.Index, hash_func=hash_func)
-        logger.info(f"Writing hmtl to {htmlpath}")
-        with open(htmlpath, "w") as f:
-            f.write(html)
+            except TransientError as e:
+                # Remaining files are left unmarked for the next run
+                logger.warning(f"Stopping, API keeps failing: {e}")
+                return
+            segments = parser.parse_segments(result) if result else []
+            if not segments:
+                logger.info("Empty result.")
+                continue
+
+            # Send webhook if URL is provided
+            if webhook_url:
+                await send_webhook(webhook_url, result, record_path, session, logger)
+
+            logger.info(f"Combined segments: {len(segments)}")
+            htmlpath = parser.name_html(record_path, hash_func=hash_func)
+            logger.info(f"Writing hmtl to {htmlpath}")
+            with open(htmlpath, "w") as f:
+                parser.write_html(segments, f)
+
+
+async def send_webhook(webhook_url, result, record_path, session, logger):
+    try:
+        logger.info(f"Sending webhook to {webhook_url}")
+        sales_signals_api_key = os.environ.get("WEBHOOK_API_KEY")
+        headers = {"Authorization": f"Bearer {sales_signals_api_key}"}
+        # Add file name to payload
+        file_name = os.path.basename(record_path)
+        payload = dict(result, file_name=file_name)
+        # Remove file extension
+        payload["transcript_id"] = ".".join(file_name.split(".")[:-1])
+        async with session.post(
+            webhook_url, json=payload, headers=headers, timeout=aiohttp.ClientTimeout(total=10)
+        ) as response:
+            response.raise_for_status()
+            logger.info(f"Webhook sent successfully: {response.status}")
+    except Exception as e:
+        logger.warning(f"Webhook error: {e}")
 
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@ import traceback
 from dotenv import find_dotenv, load_dotenv
 import click
 import logging
-from speechkitty import Directory, Transcriber, Parser
+from speechkitty import Directory, Transcriber, TransientError, Parser
 
 
 @click.command()
@@ -103,7 +103,12 @@ def main(
     for i, wav_path in enumerate(wavs, start=1):
         logger.info(f"Starting processing record {i} of {len(wavs)}")
         logger.info(f"Transcribing {wav_path}")
-        result = transcriber.transcribe_file(wav_path)
+        try:
+            result = transcriber.transcribe_file(wav_path)
+        except TransientError as e:
+            # Remaining files are left unmarked for the next run
+            logger.warning(f"Stopping, whisperX keeps failing: {e}")
+            break
 
         # Compose resulting json path
         json_path = wav_path[:-4] + ".json"
@@ -0,0 +1,151 @@
+import asyncio
+import email.utils
+import time
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from app.speechkitty.adaptive_limiter import AdaptiveLimiter, parse_retry_after
+from app.speechkitty.metrics import MetricsRegistry
+from app.speechkitty.speech_service import SpeechService
+from app.speechkitty.transcriber import Transcriber
+
+
+def response(status, retry_after=None):
+    response = MagicMock()
+    response.status = status
+    response.headers = {"Retry-After": retry_after} if retry_after is not None else {}
+    return response
+
+
+async def call(limiter, status, retry_after=None, duration=0.0):
+    async with limiter.slot() as slot:
+        await asyncio.sleep(duration)
+        slot.observe(response(status, retry_after))
+
+
+@pytest.mark.asyncio
+async def test_additive_increase():
+    limiter = AdaptiveLimiter(initial=2, max_limit=3)
+    for _ in range(2):
+        await call(limiter, 200)
+    # 2 + 1/2, then 2.5 + 1/2.5
+    assert limiter.limit == pytest.approx(2.9)
+    for _ in range(10):
+        await call(limiter, 200)
+    assert limiter.limit == 3
+
+
+@pytest.mark.asyncio
+async def test_decrease_once_per_window():
+    limiter = AdaptiveLimiter(initial=8)
+    # Requests in flight together all see the 429, the limit is halved once
+    await asyncio.gather(*(call(limiter, 429, duration=0.01) for _ in range(8)))
+    assert limiter.limit == 4
+    await call(limiter, 503)
+    assert limiter.limit == 2
+    await call(limiter, 429)
+    await call(limiter, 429)
+    assert limiter.limit == 1
+
+
+@pytest.mark.asyncio
+async def test_latency_above_target():
+    limiter = AdaptiveLimiter(initial=4, target_latency=0.01)
+    await call(limiter, 200, duration=0.05)
+    assert limiter.limit == 2
+
+
+@pytest.mark.asyncio
+async def test_timeout_decreases():
+    limiter = AdaptiveLimiter(initial=4)
+    with pytest.raises(asyncio.TimeoutError):
+        async with limiter.slot():
+            raise asyncio.TimeoutError()
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_limits_concurrency():
+    limiter = AdaptiveLimiter(initial=2)
+    running = []
+    peak = 0
+
+    async def task():
+        nonlocal peak
+        async with limiter.slot() as slot:
+            running.append(1)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+            slot.observe(response(200))
+
+    await asyncio.gather(*(task() for _ in range(6)))
+    assert peak == 2
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_passes_slot_on():
+    limiter = AdaptiveLimiter(initial=1)
+    slot = await limiter.acquire()
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0)
+    # Slot is taken for the waiter, which is cancelled before it resumes
+    limiter.release(slot)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert limiter.in_flight == 0
+    await asyncio.wait_for(limiter.acquire(), 1)
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses():
+    limiter = AdaptiveLimiter(initial=4)
+    await call(limiter, 429, retry_after="0.1")
+    started = time.monotonic()
+    await call(limiter, 200)
+    assert time.monotonic() - started >= 0.09
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("2") == 2
+    assert parse_retry_after("") is None
+    assert parse_retry_after("soon") is None
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 < parse_retry_after(date) <= 30
+
+
+@pytest.mark.asyncio
+@pytest.mark.filterwarnings("ignore: Submit task")
+async def test_speech_service_submit():
+    metrics = MetricsRegistry()
+    limiter = AdaptiveLimiter("submit", initial=4, metrics=metrics)
+    service = SpeechService("SpeechKit", transcribe_api_key="key", limiters={"submit": limiter})
+    session = MagicMock()
+    throttled = response(429, "0")
+    throttled.raise_for_status.side_effect = Exception("Too Many Requests")
+    session.post.return_value.__aenter__.return_value = throttled
+    assert await service.submit_yandex_task_async("http://storage/test.ogg", session) == ""
+    assert metrics.get("concurrency_limit", endpoint="submit") == 2
+
+    accepted = response(200)
+    accepted.json = AsyncMock(return_value={"id": "test_task_id"})
+    session.post.return_value.__aenter__.return_value = accepted
+    assert await service.submit_yandex_task_async("http://storage/test.ogg", session) == (
+        "test_task_id"
+    )
+    assert metrics.get("concurrency_limit", endpoint="submit") == 2.5
+
+
+def test_transcriber_adaptive_limits():
+    metrics = MetricsRegistry()
+    transcriber = Transcriber(
+        api="whisperX", whisper_endpoint="http://whisper", metrics=metrics, adaptive_limits=True
+    )
+    limiters = transcriber.speech_service.limiters
+    assert sorted(limiters) == ["operation", "submit", "whisper"]
+    assert limiters["whisper"].metrics is metrics
+    assert (
+        Transcriber(api="whisperX", whisper_endpoint="http://whisper").speech_service.limiters == {}
+    )
@@ -0,0 +1,128 @@
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+import wave
+import numpy as np
+import pytest
+from app.speechkitty.audio_converter import AudioConverter
+
+WAV_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav"
+WAV_IN_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav-in.wav"
+WAV_OUT_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav-out.wav"
+
+
+def read_samples(path: str) -> np.ndarray:
+    with wave.open(path) as f:
+        return np.frombuffer(f.readframes(f.getnframes()), np.int16)
+
+
+class TestPairConversion(unittest.TestCase):
+    def setUp(self):
+        self.converter = AudioConverter(raise_exceptions=True)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def cut(self, name: str, seconds: float) -> str:
+        path = os.path.join(self.temp_dir, name)
+        with wave.open(WAV_OUT_PATH) as src, wave.open(path, "wb") as dst:
+            dst.setparams(src.getparams())
+            dst.writeframes(src.readframes(int(src.getframerate() * seconds)))
+        return path
+
+    def test_interleave(self):
+        out = io.BytesIO()
+        info = self.converter.interleave(WAV_IN_PATH, WAV_OUT_PATH, out, chunk_frames=1000)
+        assert (info.channels, info.sample_rate, info.codec) == (2, 8000, "pcm_s16le")
+        frames = np.frombuffer(out.getvalue(), np.int16).reshape(-1, 2)
+        assert np.array_equal(frames[:, 0], read_samples(WAV_IN_PATH))
+        out_samples = read_samples(WAV_OUT_PATH)
+        assert np.array_equal(frames[: len(out_samples), 1], out_samples)
+
+    def test_interleave_pads_shorter_leg(self):
+        short = self.cut("short.wav", 1.5)
+        out = io.BytesIO()
+        info = self.converter.interleave(short, WAV_IN_PATH, out, chunk_frames=5000)
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.01)
+        frames = np.frombuffer(out.getvalue(), np.int16).reshape(-1, 2)
+        assert len(frames) == len(read_samples(WAV_IN_PATH))
+        assert np.array_equal(frames[:12000, 0], read_samples(short))
+        assert not frames[12000:, 0].any()
+
+    def test_pair_info_mismatch(self):
+        # Stereo record can't be a leg
+        with pytest.raises(ValueError):
+            self.converter.pair_info(WAV_IN_PATH, WAV_PATH)
+        resampled = os.path.join(self.temp_dir, "16k.wav")
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", WAV_OUT_PATH, "-ar", "16000", resampled],
+            check=True,
+        )
+        with pytest.raises(ValueError):
+            self.converter.pair_info(WAV_IN_PATH, resampled)
+
+    def test_pair_to_ogg_stream(self):
+        ogg_path = os.path.join(self.temp_dir, "call.ogg")
+
+        def consumer(stream) -> str:
+            with open(ogg_path, "wb") as f:
+                shutil.copyfileobj(stream, f)
+            return ogg_path
+
+        assert self.converter.pair_to_ogg_stream(WAV_IN_PATH, WAV_OUT_PATH, consumer) == ogg_path
+        info = self.converter.audio_probe.probe(ogg_path)
+        assert (info.codec, info.channels) == ("opus", 2)
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.1)
+
+    def test_pair_to_ogg_stream_consumer_failed(self):
+        def consumer(stream):
+            stream.read(100)
+            return None
+
+        assert self.converter.pair_to_ogg_stream(WAV_IN_PATH, WAV_OUT_PATH, consumer) is None
+
+
+def test_to_ogg_stream_lots_of_errors(tmp_path):
+    # ffmpeg that writes more errors than a pipe holds before its output
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text("#!/bin/sh\nhead -c 200000 /dev/zero | tr '\\0' e >&2\necho ogg\nexit 1\n")
+    ffmpeg.chmod(0o755)
+    converter = AudioConverter(raise_exceptions=True)
+    converter.ffmpeg = lambda: str(ffmpeg)
+    done = []
+
+    def convert():
+        with pytest.raises(RuntimeError, match="ffmpeg exited with code 1: e{200000}$"):
+            converter.to_ogg_stream(WAV_PATH, lambda stream: stream.read())
+        done.append(True)
+
+    thread = threading.Thread(target=convert, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert done
+
+
+def test_pair_to_ogg_stream_lots_of_errors(tmp_path):
+    ffmpeg = tmp_path / "ffmpeg"
+    ffmpeg.write_text(
+        "#!/bin/sh\ncat > /dev/null\nhead -c 200000 /dev/zero | tr '\\0' e >&2\necho ogg\nexit 1\n"
+    )
+    ffmpeg.chmod(0o755)
+    converter = AudioConverter(raise_exceptions=True)
+    converter.ffmpeg = lambda: str(ffmpeg)
+    done = []
+
+    def convert():
+        with pytest.raises(RuntimeError, match="ffmpeg exited with code 1: e{200000}$"):
+            converter.pair_to_ogg_stream(WAV_IN_PATH, WAV_OUT_PATH, lambda stream: stream.read())
+        done.append(True)
+
+    thread = threading.Thread(target=convert, daemon=True)
+    thread.start()
+    thread.join(10)
+    assert done
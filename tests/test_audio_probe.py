@@ -0,0 +1,84 @@
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+import pytest
+from app.speechkitty.audio_probe import AudioProbe
+
+WAV_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav"
+WAV_IN_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav-in.wav"
+OGG_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.ogg"
+
+
+class TestAudioProbe(unittest.TestCase):
+    def setUp(self):
+        self.probe = AudioProbe()
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def encode(self, name: str, *args: str) -> str:
+        path = os.path.join(self.temp_dir, name)
+        subprocess.run(
+            ["ffmpeg", "-y", "-loglevel", "error", "-i", WAV_PATH, *args, path], check=True
+        )
+        return path
+
+    def test_probe_wav(self):
+        info = self.probe.probe(WAV_PATH)
+        assert info.container == "wav"
+        assert info.codec == "pcm_s16le"
+        assert info.channels == 2
+        assert info.sample_rate == 8000
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.01)
+
+    def test_probe_wav_mono(self):
+        info = self.probe.probe(WAV_IN_PATH)
+        assert info.channels == 1
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.01)
+
+    def test_probe_wav_unset_data_size(self):
+        # Recorders leave data size unset until the file is closed
+        path = os.path.join(self.temp_dir, "streamed.wav")
+        shutil.copyfile(WAV_IN_PATH, path)
+        with open(path, "r+b") as f:
+            data = f.read()
+            offset = data.find(b"data") + 4
+            f.seek(offset)
+            f.write(struct.pack("<I", 0xFFFFFFFF))
+        assert self.probe.probe(path).duration_seconds == pytest.approx(50.2, abs=0.01)
+
+    def test_probe_ogg_opus(self):
+        info = self.probe.probe(OGG_PATH)
+        assert info.container == "ogg"
+        assert info.codec == "opus"
+        assert info.channels == 2
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.05)
+
+    def test_probe_ogg_vorbis(self):
+        path = self.encode("test.ogg", "-c:a", "libvorbis")
+        info = self.probe.probe(path)
+        assert info.codec == "vorbis"
+        assert info.sample_rate == 8000
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.05)
+
+    def test_probe_mp3_cbr(self):
+        path = self.encode("test.mp3", "-c:a", "libmp3lame", "-b:a", "32k", "-write_xing", "0")
+        info = self.probe.probe(path)
+        assert info.container == "mp3"
+        assert info.codec == "mp3"
+        assert info.channels == 2
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.2)
+
+    def test_probe_mp3_vbr(self):
+        path = self.encode("test.mp3", "-c:a", "libmp3lame", "-q:a", "5")
+        info = self.probe.probe(path)
+        assert info.sample_rate == 8000
+        assert info.duration_seconds == pytest.approx(50.2, abs=0.2)
+
+    def test_probe_no_file(self):
+        with pytest.raises(FileNotFoundError):
+            self.probe.probe(WAV_PATH + "nonexistent")
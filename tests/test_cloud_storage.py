@@ -0,0 +1,52 @@
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+import boto3
+from moto import mock_aws
+from app.speechkitty.cloud_storage import CloudStorage
+
+OGG_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.ogg"
+STORAGE_BUCKET_NAME = "test_bucket"
+
+
+class TestCloudStorage(unittest.TestCase):
+    def setUp(self):
+        self.cloud_storage = CloudStorage(
+            aws_access_key_id="test_access_key_id",
+            aws_secret_access_key="test_access_key",
+            bucket_name=STORAGE_BUCKET_NAME,
+            max_pool_connections=4,
+        )
+
+    def test_get_client_shared(self):
+        client = self.cloud_storage.get_client()
+        assert client is self.cloud_storage.get_client()
+        assert client.meta.config.max_pool_connections == 4
+
+    def test_get_client_created_once(self):
+        with patch.object(
+            self.cloud_storage, "new_client", wraps=self.cloud_storage.new_client
+        ) as new_client:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                clients = list(executor.map(lambda _: self.cloud_storage.get_client(), range(32)))
+        assert new_client.call_count == 1
+        assert all(client is clients[0] for client in clients)
+
+    def test_reset_client(self):
+        client = self.cloud_storage.get_client()
+        self.cloud_storage.reset_client()
+        assert client is not self.cloud_storage.get_client()
+
+    @mock_aws
+    def test_upload_delete_shared_client(self):
+        self.cloud_storage.storage_endpoint = None  # type: ignore
+        boto3.resource("s3").create_bucket(Bucket=STORAGE_BUCKET_NAME)
+        with patch.object(
+            self.cloud_storage, "new_client", wraps=self.cloud_storage.new_client
+        ) as new_client:
+            assert self.cloud_storage.upload_file(OGG_PATH)
+            self.cloud_storage.delete_file(OGG_PATH)
+        assert new_client.call_count == 1
+        objects = boto3.client("s3").list_objects_v2(Bucket=STORAGE_BUCKET_NAME)
+        assert os.path.basename(OGG_PATH) not in str(objects.get("Contents", []))
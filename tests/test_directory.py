@@ -1,4 +1,9 @@
+import os
+import shutil
+import tempfile
+import time
 import unittest
+from unittest.mock import patch
 from app.speechkitty.directory import Directory
 
 
@@ -23,3 +28,133 @@ class TestDirectory(unittest.TestCase):
     def test_get_records_include(self):
         include = "^.+(?:-in|-out)\\.wav"
         assert len(self.directory.get_records(regexp_include=include, skip_processed=True)) == 2
+
+    def test_get_pairs(self):
+        record = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54"
+        pairs = self.directory.get_pairs()
+        assert pairs == [(f"{record}.wav", f"{record}.wav-in.wav", f"{record}.wav-out.wav")]
+        # Merged json of the call is already there
+        assert self.directory.get_pairs(skip_processed=True) == []
+
+    def test_get_pairs_missing_leg(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for name in ["a.wav-in.wav", "a.wav-out.wav", "b.wav-out.wav", "c.wav"]:
+                open(os.path.join(temp_dir, name), "w").close()
+            pairs = Directory(temp_dir).get_pairs()
+        path = os.path.join(temp_dir, "")
+        assert pairs == [
+            (f"{path}a.wav", f"{path}a.wav-in.wav", f"{path}a.wav-out.wav"),
+            (f"{path}b.wav", None, f"{path}b.wav-out.wav"),
+        ]
+
+
+class TestDirectoryIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.temp_dir, "records")
+        for sub in ["2023/10", "2023/11"]:
+            os.makedirs(os.path.join(self.root, sub))
+        for name in ["2023/10/a.wav", "2023/10/a.json", "2023/11/b.wav"]:
+            open(os.path.join(self.root, name), "w").close()
+        # Directories modified right before a scan are listed every time
+        past = time.time_ns() - 3600 * 10**9
+        for path in ["", "2023", "2023/10", "2023/11"]:
+            os.utime(os.path.join(self.root, path), ns=(past, past))
+        self.index_path = os.path.join(self.temp_dir, "index.sqlite")
+        self.directory = Directory(path=self.root, index_path=self.index_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_records_same_as_walk(self):
+        plain = Directory(path=self.root)
+        assert sorted(self.directory.get_records()) == sorted(plain.get_records())
+        assert self.directory.get_records(skip_processed=True) == [
+            os.path.join(self.root, "2023/11/b.wav")
+        ]
+
+    def test_unchanged_directories_not_listed(self):
+        self.directory.get_records()
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            records = self.directory.get_records(skip_processed=True)
+        assert scandir.call_count == 0
+        assert records == [os.path.join(self.root, "2023/11/b.wav")]
+
+    def test_changed_directory_listed(self):
+        self.directory.get_records()
+        open(os.path.join(self.root, "2023/11/b.json"), "w").close()
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            records = self.directory.get_records(skip_processed=True)
+        assert scandir.call_count == 1
+        assert records == []
+
+    def test_racily_clean_directory_listed_again(self):
+        path = os.path.join(self.root, "2023/11")
+        open(os.path.join(path, "c.wav"), "w").close()
+        mtime_ns = os.stat(path).st_mtime_ns
+        self.directory.get_records()
+        # File added within the same tick of the timestamp doesn't change mtime
+        open(os.path.join(path, "d.wav"), "w").close()
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+        assert os.path.join(path, "d.wav") in self.directory.get_records()
+
+    def test_removed_directory_forgotten(self):
+        self.directory.get_records()
+        shutil.rmtree(os.path.join(self.root, "2023/11"))
+        assert self.directory.get_records() == [os.path.join(self.root, "2023/10/a.wav")]
+
+
+class TestDirectoryIterRecords(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        for sub in ["2023/10", "2023/11", "tmp"]:
+            os.makedirs(os.path.join(self.temp_dir, sub))
+        for name in ["2023/10/a.wav", "2023/10/a.json", "2023/11/b.WAV", "2023/11/c.txt"]:
+            with open(os.path.join(self.temp_dir, name), "w") as f:
+                f.write(name)
+        open(os.path.join(self.temp_dir, "tmp/d.wav"), "w").close()
+        self.directory = Directory(path=self.temp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def paths(self, **kwargs):
+        return sorted(entry.path for entry in self.directory.iter_records(**kwargs))
+
+    def test_iter_records_same_as_get_records(self):
+        directory = Directory(path="sample/records")
+        for skip_processed in [False, True]:
+            entries = directory.iter_records(skip_processed=skip_processed)
+            records = directory.get_records(skip_processed=skip_processed)
+            assert sorted(e.path for e in entries) == sorted(records)
+
+    def test_iter_records_skip_processed(self):
+        include = "(?i)\\.wav$"
+        assert self.paths(regexp_include=include, skip_processed=True) == [
+            os.path.join(self.temp_dir, "2023/11/b.WAV"),
+            os.path.join(self.temp_dir, "tmp/d.wav"),
+        ]
+
+    def test_iter_records_extensions(self):
+        assert self.paths(regexp_include=".", extensions=(".wav",)) == [
+            os.path.join(self.temp_dir, "2023/10/a.wav"),
+            os.path.join(self.temp_dir, "2023/11/b.WAV"),
+            os.path.join(self.temp_dir, "tmp/d.wav"),
+        ]
+
+    def test_iter_records_dir_exclude(self):
+        with patch("os.scandir", wraps=os.scandir) as scandir:
+            paths = self.paths(regexp_include="\\.wav$", dir_exclude="tmp$")
+        assert paths == [os.path.join(self.temp_dir, "2023/10/a.wav")]
+        assert scandir.call_count == 4
+
+    def test_iter_records_dir_include(self):
+        paths = self.paths(regexp_include=".", dir_include="2023(/11)?$")
+        assert paths == [
+            os.path.join(self.temp_dir, "2023/11/b.WAV"),
+            os.path.join(self.temp_dir, "2023/11/c.txt"),
+        ]
+
+    def test_iter_records_stat(self):
+        entry = next(self.directory.iter_records(regexp_include="c\\.txt$"))
+        assert entry.stat().st_size == len("2023/11/c.txt")
@@ -0,0 +1,247 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from app.speechkitty.audio_probe import AudioInfo
+from app.speechkitty.journal import JobJournal
+from app.speechkitty.pipeline import Pipeline
+from app.speechkitty.transcriber import Transcriber
+
+WAV_PATH = "sample/records/test.wav"
+OGG_PATH = "/tmp/test.ogg"
+OGG_LINK = "http://storage/test.ogg"
+TASK_ID = "test_task_id"
+RESULT_JSON = {"done": True, "result": "text"}
+
+
+class TestJobJournal(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.journal = JobJournal(os.path.join(self.temp_dir.name, "journal.sqlite"))
+
+    def tearDown(self):
+        self.journal.close()
+        self.temp_dir.cleanup()
+
+    def test_wal_mode(self):
+        mode = self.journal.connection.execute("PRAGMA journal_mode").fetchone()[0]
+        assert mode == "wal"
+
+    def test_record_keeps_fields(self):
+        self.journal.record(WAV_PATH, "probed", delay=2.0)
+        self.journal.record(WAV_PATH, "converted", ogg_path=OGG_PATH)
+        self.journal.record(WAV_PATH, "uploaded", ogg_link=OGG_LINK, object_key="test.ogg")
+        self.journal.record(WAV_PATH, "submitted", operation_id=TASK_ID)
+        entry = self.journal.get(WAV_PATH)
+        assert entry["state"] == "submitted"
+        assert (entry["delay"], entry["ogg_path"], entry["operation_id"]) == (
+            2.0,
+            OGG_PATH,
+            TASK_ID,
+        )
+        assert entry["submitted_at"] > 0
+
+    def test_probed_starts_new_run(self):
+        self.journal.record(WAV_PATH, "converted", ogg_path=OGG_PATH)
+        self.journal.record(WAV_PATH, "probed", delay=1.0)
+        assert self.journal.get(WAV_PATH)["ogg_path"] == ""
+
+    def test_pending(self):
+        self.journal.record("a.wav", "converted", ogg_path="a.ogg")
+        self.journal.record("b.wav", "submitted", operation_id="b")
+        self.journal.record("c.wav", "done")
+        self.journal.record("d.wav", "failed", error="upload")
+        assert [entry["path"] for entry in self.journal.pending()] == ["b.wav", "a.wav"]
+        assert self.journal.counts() == {"converted": 1, "submitted": 1, "done": 1, "failed": 1}
+
+    def test_unknown_state(self):
+        with self.assertRaises(ValueError):
+            self.journal.record(WAV_PATH, "finished")
+        with self.assertRaises(ValueError):
+            self.journal.record(WAV_PATH, "done", result="text")
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal.sqlite"))
+    yield journal
+    journal.close()
+
+
+@pytest.fixture
+def transcriber(journal):
+    t = Transcriber(
+        api="SpeechKit",
+        aws_access_key_id="test_key",
+        aws_secret_access_key="test_secret",
+        storage_bucket_name="test_bucket",
+        transcribe_api_key="test_api_key",
+        journal=journal,
+    )
+    t.audio_probe.probe_async = AsyncMock(
+        return_value=AudioInfo(
+            duration_seconds=1.2,
+            channels=1,
+            sample_rate=8000,
+            codec="pcm_s16le",
+            container="wav",
+        )
+    )
+    t.audio_converter.to_ogg_async = AsyncMock(return_value=OGG_PATH)
+    t.cloud_storage.upload_file_async = AsyncMock(return_value=OGG_LINK)
+    t.cloud_storage.delete_file_async = AsyncMock()
+    t.speech_service.submit_yandex_task_async = AsyncMock(return_value=TASK_ID)
+    t.speech_service.get_yandex_result_async = AsyncMock(return_value=RESULT_JSON)
+    return t
+
+
+@pytest.mark.asyncio
+@pytest.mark.filterwarnings("ignore: Result")
+async def test_restart_resumes_polling(transcriber, journal):
+    # First run loses the result, as if the process was stopped while polling
+    transcriber.speech_service.get_yandex_result_async.return_value = None
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) is None
+    assert journal.get(WAV_PATH)["state"] == "submitted"
+    transcriber.cloud_storage.delete_file_async.assert_not_called()
+
+    transcriber.speech_service.get_yandex_result_async.return_value = RESULT_JSON
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) == RESULT_JSON
+    # Nothing is converted, uploaded or submitted again
+    assert transcriber.audio_converter.to_ogg_async.call_count == 1
+    assert transcriber.cloud_storage.upload_file_async.call_count == 1
+    assert transcriber.speech_service.submit_yandex_task_async.call_count == 1
+    transcriber.cloud_storage.delete_file_async.assert_called_once()
+    assert journal.get(WAV_PATH)["state"] == "done"
+
+
+@pytest.mark.asyncio
+async def test_resume_uploaded(transcriber, journal):
+    journal.record(WAV_PATH, "probed", delay=0.0)
+    journal.record(WAV_PATH, "uploaded", ogg_link=OGG_LINK, object_key="test.ogg")
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) == RESULT_JSON
+    transcriber.audio_probe.probe_async.assert_not_called()
+    transcriber.cloud_storage.upload_file_async.assert_not_called()
+    transcriber.speech_service.submit_yandex_task_async.assert_called_once()
+
+
+@pytest.mark.asyncio
+@pytest.mark.filterwarnings("ignore: Upload")
+async def test_failed_starts_over(transcriber, journal):
+    transcriber.cloud_storage.upload_file_async = AsyncMock(return_value=None)
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) is None
+    assert journal.get(WAV_PATH)["error"] == "upload"
+    transcriber.cloud_storage.upload_file_async = AsyncMock(return_value=OGG_LINK)
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) == RESULT_JSON
+    assert transcriber.audio_converter.to_ogg_async.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_pipeline_resumes_submitted(transcriber, journal):
+    journal.record(WAV_PATH, "probed", delay=100.0)
+    journal.record(
+        WAV_PATH,
+        "submitted",
+        operation_id=TASK_ID,
+        ogg_link=OGG_LINK,
+        submitted_at=time.time() - 200,
+    )
+    results = {}
+
+    async def on_result(path, result):
+        results[path] = result
+
+    with patch("os.unlink"):
+        await Pipeline(transcriber, on_result=on_result).run([WAV_PATH], MagicMock())
+    assert results == {WAV_PATH: RESULT_JSON}
+    transcriber.speech_service.submit_yandex_task_async.assert_not_called()
+    transcriber.speech_service.get_yandex_result_async.assert_called_once()
+    assert journal.get(WAV_PATH)["state"] == "done"
+
+
+def test_sync_resumes_submitted(transcriber, journal):
+    journal.record(WAV_PATH, "probed", delay=30.0)
+    journal.record(WAV_PATH, "submitted", operation_id=TASK_ID, submitted_at=time.time() - 10)
+    transcriber.speech_service.get_yandex_result = MagicMock(return_value=RESULT_JSON)
+    transcriber.cloud_storage.delete_file = MagicMock()
+    with patch("time.sleep") as sleep, patch("os.unlink"):
+        assert transcriber.transcribe_file(WAV_PATH) == RESULT_JSON
+    # Only the rest of the pause is waited
+    assert 19 < sleep.call_args_list[0].args[0] <= 20
+    transcriber.speech_service.get_yandex_result.assert_called_once_with(TASK_ID)
+
+
+@pytest.mark.filterwarnings("ignore: Result")
+def test_sync_keeps_unfinished_submitted(transcriber, journal):
+    journal.record(WAV_PATH, "probed", delay=0.0)
+    journal.record(WAV_PATH, "submitted", operation_id=TASK_ID, ogg_path=OGG_PATH)
+    transcriber.speech_service.get_yandex_result = MagicMock(
+        return_value={"done": False, "id": TASK_ID}
+    )
+    transcriber.cloud_storage.delete_file = MagicMock()
+    with patch("time.sleep"), patch("os.unlink"):
+        assert transcriber.transcribe_file(WAV_PATH) is None
+    # Operation is still running, the next run polls it instead of losing it
+    assert journal.get(WAV_PATH)["state"] == "submitted"
+    transcriber.cloud_storage.delete_file.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_async_writes_off_event_loop(transcriber, journal):
+    threads = []
+    record = journal.record
+
+    def recording(*args, **kwargs):
+        threads.append(threading.current_thread())
+        record(*args, **kwargs)
+
+    journal.record = recording
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) == RESULT_JSON
+    assert threads and threading.main_thread() not in threads
+    assert journal.get(WAV_PATH)["state"] == "done"
+
+
+def record_submitted(journal, tmp_path, stream_upload):
+    """Journals a submitted file the way a run in the given mode leaves it, with the
+    converted ogg removed from the temp directory since"""
+    journal.record(WAV_PATH, "probed", delay=0.0)
+    if not stream_upload:
+        journal.record(WAV_PATH, "converted", ogg_path=str(tmp_path / "test.ogg"))
+    journal.record(WAV_PATH, "uploaded", ogg_link=OGG_LINK, object_key="test.ogg")
+    journal.record(WAV_PATH, "submitted", operation_id=TASK_ID)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("stream_upload", [False, True])
+async def test_resumed_submitted_deletes_object(transcriber, journal, tmp_path, stream_upload):
+    transcriber.stream_upload = stream_upload
+    record_submitted(journal, tmp_path, stream_upload)
+    assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) == RESULT_JSON
+    transcriber.cloud_storage.delete_file_async.assert_called_once_with("test.ogg", None)
+    assert journal.get(WAV_PATH)["state"] == "done"
+
+    transcriber.cloud_storage.delete_file_async.reset_mock()
+    record_submitted(journal, tmp_path, stream_upload)
+    await Pipeline(transcriber).run([WAV_PATH], MagicMock())
+    transcriber.cloud_storage.delete_file_async.assert_called_once_with("test.ogg", None)
+    assert journal.get(WAV_PATH)["state"] == "done"
+
+
+@pytest.mark.parametrize("stream_upload", [False, True])
+def test_sync_resumed_submitted_deletes_object(transcriber, journal, tmp_path, stream_upload):
+    transcriber.stream_upload = stream_upload
+    record_submitted(journal, tmp_path, stream_upload)
+    transcriber.speech_service.get_yandex_result = MagicMock(return_value=RESULT_JSON)
+    transcriber.cloud_storage.delete_file = MagicMock()
+    with patch("time.sleep"):
+        assert transcriber.transcribe_file(WAV_PATH) == RESULT_JSON
+    transcriber.cloud_storage.delete_file.assert_called_once_with("test.ogg", None)
+    assert journal.get(WAV_PATH)["state"] == "done"
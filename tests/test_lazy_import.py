@@ -0,0 +1,47 @@
+import subprocess
+import sys
+import unittest
+import app.speechkitty
+
+HEAVY_MODULES = ("pandas", "boto3", "botocore", "pydub", "requests", "aiohttp")
+
+
+def imported_modules(code: str) -> set:
+    """Runs the code in a fresh interpreter and returns heavy modules it imported"""
+    code += f"\nimport sys\nprint(*[m for m in {HEAVY_MODULES!r} if m in sys.modules])"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    return set(output.split())
+
+
+class TestLazyImport(unittest.TestCase):
+    def test_package(self):
+        assert imported_modules("import app.speechkitty") == set()
+
+    def test_directory(self):
+        assert imported_modules("from app.speechkitty import Directory") == set()
+
+    def test_parser_segments(self):
+        code = (
+            "from app.speechkitty import Parser\n"
+            "parser = Parser()\n"
+            "result = {'segments': [{'start': 0, 'end': 1, 'text': 'a'}]}\n"
+            "segments = parser.parse_segments(result)\n"
+            "assert parser.create_html(segments)"
+        )
+        assert imported_modules(code) == set()
+
+    def test_transcriber_without_storage(self):
+        code = (
+            "from app.speechkitty import Transcriber\n"
+            "Transcriber(api='whisperX', whisper_endpoint='http://localhost')"
+        )
+        assert imported_modules(code) == {"requests", "aiohttp"}
+
+    def test_exports(self):
+        for name in app.speechkitty.__all__:
+            assert getattr(app.speechkitty, name).__name__ == name
+            assert name in dir(app.speechkitty)
+        with self.assertRaises(AttributeError):
+            app.speechkitty.Missing
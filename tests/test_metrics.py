@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import unittest
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from app.speechkitty.audio_probe import AudioInfo
+from app.speechkitty.metrics import JsonLinesSink, MetricsRegistry, NullMetrics
+from app.speechkitty.operation_poller import OperationPoller
+from app.speechkitty.result_parser import Parser
+from app.speechkitty.transcriber import Transcriber
+
+WAV_PATH = "sample/records/test.wav"
+RESULT_JSON = {"done": True, "response": {}}
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.metrics = MetricsRegistry(buckets=(0.1, 1))
+
+    def test_counter_gauge_histogram(self):
+        self.metrics.inc("errors_total", stage="upload")
+        self.metrics.inc("errors_total", 2, stage="upload")
+        self.metrics.set("operations_in_flight", 5)
+        self.metrics.set("operations_in_flight", 3)
+        self.metrics.observe("stage_seconds", 0.5, stage="convert")
+        assert self.metrics.get("errors_total", stage="upload") == 3
+        assert self.metrics.get("errors_total", stage="submit") is None
+        assert self.metrics.get("operations_in_flight") == 3
+        assert self.metrics.get("stage_seconds", stage="convert") == 1
+
+    def test_to_prometheus(self):
+        self.metrics.inc("errors_total", stage='a"b')
+        self.metrics.observe("stage_seconds", 0.05, stage="probe")
+        self.metrics.observe("stage_seconds", 0.5, stage="probe")
+        self.metrics.observe("stage_seconds", 5, stage="probe")
+        text = self.metrics.to_prometheus()
+        assert "# TYPE speechkitty_errors_total counter" in text
+        assert 'speechkitty_errors_total{stage="a\\"b"} 1' in text
+        assert "# TYPE speechkitty_stage_seconds histogram" in text
+        assert 'speechkitty_stage_seconds_bucket{stage="probe",le="0.1"} 1' in text
+        assert 'speechkitty_stage_seconds_bucket{stage="probe",le="1"} 2' in text
+        assert 'speechkitty_stage_seconds_bucket{stage="probe",le="+Inf"} 3' in text
+        assert 'speechkitty_stage_seconds_sum{stage="probe"} 5.55' in text
+        assert 'speechkitty_stage_seconds_count{stage="probe"} 3' in text
+
+    def test_write_prometheus(self):
+        self.metrics.inc("errors_total")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "speechkitty.prom")
+            self.metrics.write_prometheus(path)
+            with open(path) as f:
+                assert f.read() == self.metrics.to_prometheus()
+            assert os.listdir(temp_dir) == ["speechkitty.prom"]
+
+    def test_json_lines_sink(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            sink = JsonLinesSink(os.path.join(temp_dir, "metrics.jsonl"))
+            metrics = MetricsRegistry(sinks=[sink])
+            with metrics.timer("stage_seconds", stage="convert"):
+                pass
+            metrics.inc("retries_total", stage="poll")
+            sink.close()
+            with open(sink.path) as f:
+                lines = [json.loads(line) for line in f]
+        assert [line["type"] for line in lines] == ["histogram", "counter"]
+        assert lines[0]["labels"] == {"stage": "convert"}
+        assert lines[1]["value"] == 1
+
+    def test_null_metrics(self):
+        metrics = NullMetrics()
+        with metrics.timer("stage_seconds", stage="convert") as timer:
+            metrics.inc("errors_total")
+        assert timer is metrics.timer("stage_seconds")
+        assert not metrics.enabled
+
+    def test_parser_empty_result(self):
+        parser = Parser(metrics=self.metrics)
+        assert parser.parse_result({"segments": []}).empty
+        assert parser.parse_segments({"response": {}}) == []
+        assert self.metrics.get("empty_results_total") == 2
+        assert self.metrics.get("stage_seconds", stage="parse") == 2
+
+
+@pytest.fixture
+def transcriber():
+    t = Transcriber(
+        api="SpeechKit",
+        aws_access_key_id="test_key",
+        aws_secret_access_key="test_secret",
+        storage_bucket_name="test_bucket",
+        transcribe_api_key="test_api_key",
+        webhook_url="http://webhook",
+        metrics=MetricsRegistry(),
+    )
+    t.audio_probe.probe_async = AsyncMock(
+        return_value=AudioInfo(
+            duration_seconds=1.2,
+            channels=1,
+            sample_rate=8000,
+            codec="pcm_s16le",
+            container="wav",
+        )
+    )
+    t.audio_converter.to_ogg_async = AsyncMock(return_value="/tmp/test.ogg")
+    t.cloud_storage.upload_file_async = AsyncMock(return_value="http://storage/test.ogg")
+    t.cloud_storage.delete_file_async = AsyncMock()
+    t.speech_service.submit_yandex_task_async = AsyncMock(return_value="id")
+    t.speech_service.get_yandex_result_async = AsyncMock(side_effect=[{"done": False}, RESULT_JSON])
+    t.poller.interval = 0.01
+    return t
+
+
+@pytest.mark.asyncio
+async def test_transcriber_stages(transcriber):
+    session = MagicMock()
+    session.post.return_value.__aenter__.return_value = MagicMock()
+    metrics = transcriber.metrics
+    with patch("os.unlink"):
+        assert await transcriber.transcribe_file_async(WAV_PATH, session) == RESULT_JSON
+    for stage in ["probe", "convert", "upload", "submit", "first_poll", "poll", "webhook"]:
+        assert metrics.get("stage_seconds", stage=stage) == 1, stage
+    assert metrics.get("retries_total", stage="poll") == 1
+    assert metrics.get("operations_in_flight") == 0
+    assert metrics.get("files_in_flight") == 0
+    assert metrics.get("errors_total", stage="upload") is None
+
+
+@pytest.mark.asyncio
+@pytest.mark.filterwarnings("ignore: Upload")
+async def test_transcriber_stage_error(transcriber):
+    transcriber.cloud_storage.upload_file_async = AsyncMock(return_value=None)
+    assert await transcriber.transcribe_file_async(WAV_PATH, MagicMock()) is None
+    assert transcriber.metrics.get("errors_total", stage="upload") == 1
+    transcriber.speech_service.submit_yandex_task_async.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_poller_error():
+    service = MagicMock()
+    service.get_yandex_result_async = AsyncMock(return_value=None)
+    metrics = MetricsRegistry()
+    poller = OperationPoller(service, metrics=metrics)
+    assert await poller.wait("id", MagicMock()) is None
+    assert metrics.get("errors_total", stage="poll") == 1
+    assert metrics.get("stage_seconds", stage="first_poll") == 1
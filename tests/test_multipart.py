@@ -0,0 +1,152 @@
+import os
+import email.parser
+import http.client
+import http.server
+import json
+import threading
+from unittest.mock import patch
+import pytest
+import requests_mock
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+from app.speechkitty.multipart import MultipartFileBody
+from app.speechkitty.speech_service import SpeechService
+
+WAV_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav"
+WHISPER_RESULT: dict = {"segments": []}
+
+
+def parse(content_type: str, body: bytes):
+    message = email.parser.BytesParser().parsebytes(
+        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+    )
+    return message.get_payload()
+
+
+def test_read_whole():
+    with open(WAV_PATH, "rb") as f:
+        data = f.read()
+    with MultipartFileBody(WAV_PATH) as body:
+        content = body.read()
+        assert len(content) == len(body)
+        assert body.read() == b""
+    parts = parse(body.content_type, content)
+    assert len(parts) == 1
+    assert parts[0].get_param("name", header="content-disposition") == "audio"
+    assert parts[0].get_filename() == os.path.basename(WAV_PATH)
+    assert parts[0].get_payload(decode=True) == data
+
+
+def test_read_chunks_closes_file():
+    body = MultipartFileBody(WAV_PATH)
+    chunks = []
+    while True:
+        chunk = body.read(8192)
+        if not chunk:
+            break
+        assert len(chunk) <= 8192
+        chunks.append(chunk)
+    assert body._file is None
+    assert sum(len(c) for c in chunks) == len(body)
+
+
+def test_transcribe_start_whisper_streamed():
+    endpoint = "http://whisper/transcribe"
+    service = SpeechService(api_type="whisperx", whisper_endpoint=endpoint, raise_exceptions=True)
+    with requests_mock.Mocker() as m:
+        m.post(endpoint, json=WHISPER_RESULT)
+        assert service.transcribe_start_whisper(WAV_PATH) == WHISPER_RESULT
+        request = m.last_request
+    assert request.headers["Content-Type"].startswith("multipart/form-data; boundary=")
+    assert int(request.headers["Content-Length"]) > os.path.getsize(WAV_PATH)
+
+
+@pytest.mark.asyncio
+async def test_transcribe_start_whisper_async_streamed():
+    received = {}
+
+    async def handler(request):
+        received["chunked"] = request.headers.get("Transfer-Encoding")
+        received["length"] = request.content_length
+        post = await request.post()
+        received["audio"] = post["audio"].file.read()
+        received["filename"] = post["audio"].filename
+        return web.json_response(WHISPER_RESULT)
+
+    app = web.Application(client_max_size=10 * 1024 * 1024)
+    app.router.add_post("/whisperx", handler)
+    service = SpeechService(api_type="whisperx", raise_exceptions=True, upload_chunk_size=4096)
+    with open(WAV_PATH, "rb") as f:
+        data = f.read()
+
+    async with TestServer(app) as server:
+        service.whisper_endpoint = str(server.make_url("/whisperx"))
+        async with ClientSession() as session:
+            result = await service.transcribe_start_whisper_async(WAV_PATH, session)
+
+    assert result == WHISPER_RESULT
+    assert received["chunked"] is None
+    assert received["length"] == len(MultipartFileBody(WAV_PATH))
+    assert received["audio"] == data
+    assert received["filename"] == os.path.basename(WAV_PATH)
+
+
+@pytest.mark.asyncio
+async def test_iter_chunks_async_closed_early():
+    opened = []
+
+    def recording_open(*args, **kwargs):
+        opened.append(open(*args, **kwargs))
+        return opened[-1]
+
+    body = MultipartFileBody(WAV_PATH, chunk_size=1024)
+    with patch("aiofiles.threadpool.sync_open", recording_open):
+        chunks = body.iter_chunks_async()
+        assert await chunks.__anext__() == body.preamble
+        assert len(await chunks.__anext__()) == 1024
+    await chunks.aclose()
+    assert len(opened) == 1 and opened[0].closed
+
+
+def test_transcribe_start_whisper_chunk_size():
+    received = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            received["headers"] = self.headers
+            received["body"] = self.rfile.read(int(self.headers["Content-Length"]))
+            content = json.dumps(WHISPER_RESULT).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        service = SpeechService(
+            api_type="whisperx",
+            whisper_endpoint=f"http://127.0.0.1:{server.server_port}/transcribe",
+            raise_exceptions=True,
+            upload_chunk_size=100_000,
+        )
+        send = http.client.HTTPConnection.send
+        with patch.object(http.client.HTTPConnection, "send", autospec=True, side_effect=send) as s:
+            assert service.transcribe_start_whisper(WAV_PATH) == WHISPER_RESULT
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Body is sent in chunks of the size set rather than in blocks of http.client
+    sizes = [len(call.args[1]) for call in s.call_args_list[1:]]
+    assert max(sizes) == 100_000
+    assert "Transfer-Encoding" not in received["headers"]
+    with MultipartFileBody(WAV_PATH) as body:
+        parts = parse(received["headers"]["Content-Type"], received["body"])
+        assert len(received["body"]) == len(body)
+    with open(WAV_PATH, "rb") as f:
+        assert parts[0].get_payload(decode=True) == f.read()
@@ -0,0 +1,96 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from app.speechkitty.operation_poller import OperationPoller
+
+DONE = {"done": True, "response": {}}
+NOT_DONE = {"done": False}
+
+
+@pytest.fixture
+def speech_service():
+    service = MagicMock()
+    service.get_yandex_result_async = AsyncMock(return_value=DONE)
+    return service
+
+
+@pytest.mark.asyncio
+async def test_wait_done(speech_service):
+    poller = OperationPoller(speech_service, interval=0.01)
+    session = MagicMock()
+    assert await poller.wait("id", session) == DONE
+    speech_service.get_yandex_result_async.assert_called_once_with("id", session)
+    await asyncio.sleep(0)
+    assert poller.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_wait_polls_until_done(speech_service):
+    speech_service.get_yandex_result_async.side_effect = [NOT_DONE, NOT_DONE, DONE]
+    poller = OperationPoller(speech_service, interval=0.01)
+    assert await poller.wait("id", MagicMock()) == DONE
+    assert speech_service.get_yandex_result_async.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_wait_max_attempts(speech_service):
+    speech_service.get_yandex_result_async.return_value = NOT_DONE
+    poller = OperationPoller(speech_service, interval=0.01, max_attempts=3)
+    assert await poller.wait("id", MagicMock()) is None
+    assert speech_service.get_yandex_result_async.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_wait_error(speech_service):
+    speech_service.get_yandex_result_async.return_value = None
+    poller = OperationPoller(speech_service, interval=0.01)
+    assert await poller.wait("id", MagicMock()) is None
+
+
+@pytest.mark.asyncio
+async def test_wait_exception(speech_service):
+    speech_service.get_yandex_result_async.side_effect = ValueError("bad json")
+    poller = OperationPoller(speech_service, interval=0.01)
+    with pytest.raises(ValueError):
+        await poller.wait("id", MagicMock())
+
+
+@pytest.mark.asyncio
+async def test_deadline_order(speech_service):
+    polled = []
+
+    async def get_result(id, session):
+        polled.append(id)
+        return DONE
+
+    speech_service.get_yandex_result_async.side_effect = get_result
+    poller = OperationPoller(speech_service)
+    session = MagicMock()
+    await asyncio.gather(
+        poller.wait("late", session, 0.05),
+        poller.wait("early", session, 0.01),
+        poller.wait("now", session),
+    )
+    assert polled == ["now", "early", "late"]
+
+
+@pytest.mark.asyncio
+async def test_rate_budget(speech_service):
+    poller = OperationPoller(speech_service, max_rps=100)
+    session = MagicMock()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await asyncio.gather(*[poller.wait(str(i), session) for i in range(10)])
+    # Ten polls at 100 per second take at least 0.09 seconds
+    assert loop.time() - started >= 0.09
+    assert speech_service.get_yandex_result_async.call_count == 10
+
+
+@pytest.mark.asyncio
+async def test_cancelled_wait_not_polled(speech_service):
+    poller = OperationPoller(speech_service)
+    task = asyncio.ensure_future(poller.wait("id", MagicMock(), 0.05))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.sleep(0.1)
+    speech_service.get_yandex_result_async.assert_not_called()
@@ -2,10 +2,14 @@ import hashlib
 import json
 from os import listdir
 import os
+import shutil
+import tempfile
 import unittest
+import warnings
+from unittest.mock import patch
 from xml.dom import minidom
 import pandas as pd
-from app.speechkitty.result_parser import Parser
+from app.speechkitty.result_parser import MANIFEST_NAME, Parser, Segment
 import pytest
 
 PATH = "sample/records"
@@ -36,6 +40,29 @@ class TestParser(unittest.TestCase):
         df = self.parser.parse_result(self.result_whisper)
         assert isinstance(df, pd.DataFrame)
 
+    def test_parse_result_columns(self):
+        df = self.parser.parse_result(self.result)
+        assert df["startTime"].dtype == float
+        assert df["endTime"].dtype == float
+        assert isinstance(df["channelTag"].dtype, pd.CategoricalDtype)
+        assert df["startTime"].is_monotonic_increasing
+        assert len(df) == len(self.result["response"]["chunks"])
+
+    def test_parse_result_empty_segments(self):
+        assert self.parser.parse_result({"segments": []}).empty
+
+    def test_parse_segments(self):
+        df = self.parser.parse_result(self.result)
+        segments = self.parser.parse_segments(self.result)
+        assert all(isinstance(s, Segment) for s in segments)
+        assert [s.start for s in segments] == df["startTime"].tolist()
+        assert [s.text for s in segments] == df["text"].tolist()
+
+    def test_parse_segments_whisper(self):
+        segments = self.parser.parse_segments(self.result_whisper, channel_tag=2)
+        assert len(segments) == len(self.result_whisper["segments"])
+        assert {s.channel for s in segments} == {2}
+
     def test_parse_result_no_chunks(self):
         del self.result["response"]["chunks"]
         assert self.parser.parse_result(self.result).empty
@@ -46,6 +73,54 @@ class TestParser(unittest.TestCase):
         doc = minidom.parseString(html)
         assert len(doc.getElementsByTagName("table")) == 1
 
+    def pandas_html(self, df):
+        # How create_html used to render the table
+        df = df.pivot_table(
+            index=["startTime", "endTime"],
+            values="text",
+            columns=["channelTag"],
+            aggfunc="first",
+            fill_value="",
+            observed=True,
+        )
+        return self.parser.header + df.to_html(index=True) + self.parser.footer
+
+    def test_create_html_same_as_pandas(self):
+        for result in [self.result, self.result_whisper]:
+            df = self.parser.parse_result(result)
+            html = self.pandas_html(df)
+            assert self.parser.create_html(df) == html
+            assert self.parser.create_html(self.parser.parse_segments(result)) == html
+
+    def test_create_html_formatting(self):
+        segments = [
+            {"start": 0.0, "end": 1.5, "text": " a & <b>\tc ", "speaker": "SPEAKER_00"},
+            {"start": 1.25, "end": 2.0, "text": "d", "speaker": "SPEAKER_01"},
+            {"start": 1.25, "end": 3.0, "text": "e", "speaker": "SPEAKER_00"},
+            {"start": 1e-7, "end": 12345678.5, "text": "f", "speaker": "SPEAKER_01"},
+        ]
+        for result in [{"segments": segments}, {"segments": segments[:3]}]:
+            df = self.parser.parse_result(result)
+            assert self.parser.create_html(df) == self.pandas_html(df)
+        # Integer times
+        result = {
+            "segments": [{"start": 1, "end": 2, "text": "a"}, {"start": 3, "end": 4, "text": "b"}]
+        }
+        df = self.parser.parse_result(result)
+        assert self.parser.create_html(df) == self.pandas_html(df)
+
+    def test_create_html_empty(self):
+        assert self.parser.create_html(pd.DataFrame()) == ""
+        assert self.parser.create_html([]) == ""
+
+    def test_stylesheet(self):
+        parser = Parser(stylesheet="speechkitty.css")
+        html = parser.create_html(parser.parse_segments(self.result))
+        assert '<link rel="stylesheet" type="text/css" href="speechkitty.css"/>' in html
+        assert "<style>" not in html
+        assert parser.css().startswith("table {")
+        minidom.parseString(html)
+
     def test_name_html(self):
         html_name = self.parser.name_html(self.wav_path, hash_func="")
         assert html_name[:-4] == self.wav_path[:-3]
@@ -66,3 +141,78 @@ class TestParser(unittest.TestCase):
             test_html_name = os.path.dirname(self.wav_path) + "/" + test_html_name
             test += [html_name == test_html_name]
         assert sum(test) == len(algorithms)
+
+
+class TestRenderDirectory(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.temp_dir, "sub"))
+        self.parser = Parser()
+        self.jsons = []
+        for i, name in enumerate(["a.json", "sub/b.json", "sub/c.json"]):
+            path = os.path.join(self.temp_dir, name)
+            with open(path, "w") as f:
+                json.dump({"segments": [{"start": i, "end": i + 1, "text": name}]}, f)
+            self.jsons.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_render_directory(self):
+        counts = self.parser.render_directory(self.temp_dir, workers=2, chunksize=2)
+        assert counts == {"rendered": 3, "unchanged": 0, "failed": 0}
+        for path in self.jsons:
+            with open(path) as f:
+                segments = self.parser.parse_segments(json.load(f))
+            with open(path[:-5] + ".html") as f:
+                assert f.read() == self.parser.create_html(segments)
+        assert os.path.exists(os.path.join(self.temp_dir, MANIFEST_NAME))
+        assert not [f for f in listdir(self.temp_dir) if f.endswith(".tmp")]
+
+    def test_render_directory_incremental(self):
+        self.parser.render_directory(self.temp_dir, workers=1)
+        counts = self.parser.render_directory(self.temp_dir, workers=1)
+        assert counts == {"rendered": 0, "unchanged": 3, "failed": 0}
+        # Same content with a new mtime is recognised by the digest
+        os.utime(self.jsons[0], ns=(0, 0))
+        with open(self.jsons[1], "w") as f:
+            json.dump({"segments": [{"start": 5, "end": 6, "text": "changed"}]}, f)
+        os.unlink(self.jsons[2][:-5] + ".html")
+        counts = self.parser.render_directory(self.temp_dir, workers=1)
+        assert counts == {"rendered": 2, "unchanged": 1, "failed": 0}
+        with open(self.jsons[1][:-5] + ".html") as f:
+            assert "changed" in f.read()
+        # Template changed
+        counts = Parser(stylesheet="style.css").render_directory(self.temp_dir, workers=1)
+        assert counts["rendered"] == 3
+
+    def test_render_directory_hash_func(self):
+        self.parser.render_directory(self.temp_dir, workers=1)
+        counts = self.parser.render_directory(self.temp_dir, hash_func="md5", workers=1)
+        assert counts["rendered"] == 3
+        html_path = self.parser.name_html(self.jsons[0][:-5] + ".wav", hash_func="md5")
+        assert os.path.exists(html_path)
+
+    def test_render_directory_empty(self):
+        # Records without result are marked as processed with an empty json
+        marker = os.path.join(self.temp_dir, "sub/d.json")
+        open(marker, "w").close()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            counts = self.parser.render_directory(self.temp_dir, workers=1)
+            assert counts == {"rendered": 3, "unchanged": 1, "failed": 0}
+            assert not os.path.exists(marker[:-5] + ".html")
+            with patch("app.speechkitty.result_parser._render_file") as render:
+                counts = self.parser.render_directory(self.temp_dir, workers=1)
+            render.assert_not_called()
+            assert counts == {"rendered": 0, "unchanged": 4, "failed": 0}
+
+    @pytest.mark.filterwarnings("ignore: Render error")
+    def test_render_directory_failed(self):
+        with open(self.jsons[0], "w") as f:
+            f.write("{")
+        counts = self.parser.render_directory(self.temp_dir, workers=1)
+        assert counts == {"rendered": 2, "unchanged": 0, "failed": 1}
+        # Failed files are tried again
+        counts = self.parser.render_directory(self.temp_dir, workers=1)
+        assert counts == {"rendered": 0, "unchanged": 2, "failed": 1}
@@ -0,0 +1,151 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock, patch
+from app.speechkitty.audio_probe import AudioInfo
+from app.speechkitty.pipeline import Pipeline
+from app.speechkitty.transcriber import Transcriber
+
+OGG_LINK = "http://storage/test.ogg"
+TASK_ID = "test_task_id"
+RESULT_JSON = {"done": True, "result": "text"}
+PATHS = [f"sample/records/test{i}.wav" for i in range(6)]
+
+
+def audio_info(duration_seconds=10.0):
+    return AudioInfo(
+        duration_seconds=duration_seconds,
+        channels=1,
+        sample_rate=8000,
+        codec="pcm_s16le",
+        container="wav",
+    )
+
+
+@pytest.fixture
+def transcriber():
+    t = Transcriber(
+        api="SpeechKit",
+        aws_access_key_id="test_key",
+        aws_secret_access_key="test_secret",
+        storage_bucket_name="test_bucket",
+        transcribe_api_key="test_api_key",
+    )
+    t.audio_probe.probe_async = AsyncMock(return_value=audio_info())
+    t.audio_converter.to_ogg_async = AsyncMock(side_effect=lambda path, info: path[:-4] + ".ogg")
+    t.cloud_storage.upload_file_async = AsyncMock(return_value=OGG_LINK)
+    t.cloud_storage.delete_file_async = AsyncMock()
+    t.speech_service.submit_yandex_task_async = AsyncMock(return_value=TASK_ID)
+    t.poller.wait = AsyncMock(return_value=RESULT_JSON)
+    return t
+
+
+def collector():
+    results = {}
+
+    async def on_result(path, result):
+        results[path] = result
+
+    return results, on_result
+
+
+@pytest.mark.asyncio
+async def test_run_all_stages(transcriber):
+    results, on_result = collector()
+    pipeline = Pipeline(transcriber, on_result=on_result, convert_workers=2)
+    session = MagicMock()
+    with patch("os.unlink"):
+        await pipeline.run(iter(PATHS), session)
+    assert results == {path: RESULT_JSON for path in PATHS}
+    assert pipeline.transcribed == len(PATHS)
+    assert pipeline.processed == dict.fromkeys(pipeline.processed, len(PATHS))
+    assert transcriber.cloud_storage.delete_file_async.call_count == len(PATHS)
+    transcriber.poller.wait.assert_called_with(TASK_ID, session, 10.0 / 6)
+
+
+@pytest.mark.asyncio
+async def test_convert_overlaps_upload(transcriber):
+    second_convert = asyncio.Event()
+    converted = []
+
+    async def to_ogg_async(path, info):
+        converted.append(path)
+        if len(converted) == 2:
+            second_convert.set()
+        return path[:-4] + ".ogg"
+
+    async def upload_file_async(path, client=None):
+        # Next file must be converting while this one uploads
+        await second_convert.wait()
+        return OGG_LINK
+
+    transcriber.audio_converter.to_ogg_async = to_ogg_async
+    transcriber.cloud_storage.upload_file_async = upload_file_async
+    pipeline = Pipeline(transcriber, convert_workers=1, upload_workers=1)
+    with patch("os.unlink"):
+        await asyncio.wait_for(pipeline.run(PATHS[:2], MagicMock()), timeout=5)
+    assert pipeline.transcribed == 2
+
+
+@pytest.mark.asyncio
+async def test_stage_workers_limit(transcriber):
+    running = {"now": 0, "max": 0}
+
+    async def to_ogg_async(path, info):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        return path[:-4] + ".ogg"
+
+    transcriber.audio_converter.to_ogg_async = to_ogg_async
+    pipeline = Pipeline(transcriber, convert_workers=2, upload_workers=8)
+    with patch("os.unlink"):
+        await pipeline.run(PATHS, MagicMock())
+    assert running["max"] == 2
+    assert pipeline.transcribed == len(PATHS)
+
+
+@pytest.mark.asyncio
+async def test_upload_failed(transcriber):
+    transcriber.cloud_storage.upload_file_async = AsyncMock(return_value=None)
+    results, on_result = collector()
+    pipeline = Pipeline(transcriber, on_result=on_result)
+    with patch("os.path.exists", return_value=True), patch("os.unlink") as unlink:
+        await pipeline.run(PATHS[:1], MagicMock())
+    assert results == {PATHS[0]: None}
+    assert pipeline.failed == 1
+    unlink.assert_called_once_with(PATHS[0][:-4] + ".ogg")
+    transcriber.speech_service.submit_yandex_task_async.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_short_audio_skipped(transcriber):
+    transcriber.audio_probe.probe_async = AsyncMock(return_value=audio_info(0.5))
+    results, on_result = collector()
+    await Pipeline(transcriber, on_result=on_result).run(PATHS[:1], MagicMock())
+    assert results == {PATHS[0]: None}
+    transcriber.audio_converter.to_ogg_async.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_stage_exception(transcriber):
+    transcriber.speech_service.submit_yandex_task_async = AsyncMock(side_effect=RuntimeError)
+    results, on_result = collector()
+    pipeline = Pipeline(transcriber, on_result=on_result)
+    with patch("os.unlink"):
+        with pytest.warns(UserWarning, match="Pipeline error: submit"):
+            await pipeline.run(PATHS[:2], MagicMock())
+    assert results == dict.fromkeys(PATHS[:2])
+    # Uploaded files are still removed
+    assert transcriber.cloud_storage.delete_file_async.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_whisper(transcriber):
+    transcriber.api = "whisperx"
+    transcriber.speech_service.transcribe_start_whisper_async = AsyncMock(return_value=RESULT_JSON)
+    results, on_result = collector()
+    await Pipeline(transcriber, on_result=on_result).run(PATHS, MagicMock())
+    assert results == {path: RESULT_JSON for path in PATHS}
+    transcriber.audio_converter.to_ogg_async.assert_not_called()
+    transcriber.poller.wait.assert_not_called()
@@ -0,0 +1,166 @@
+import os
+import shutil
+import tempfile
+import unittest
+import aiohttp
+import pytest
+import requests_mock
+from unittest.mock import patch
+from app.speechkitty.result_cache import (
+    DirectoryCacheBackend,
+    ResultCache,
+    SQLiteCacheBackend,
+)
+from app.speechkitty.transcriber import Transcriber
+from app.speechkitty.vad import VoiceDetector
+
+WAV_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav"
+WHISPER_ENDPOINT = "http://127.0.0.1:5001/whisperx?output=json&hf_token=secret"
+RESULT = {"segments": [{"start": 0.0, "end": 1.0, "text": "Привет"}]}
+
+
+class BackendTests:
+    def make_backend(self, max_size: int):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_put_get(self):
+        backend = self.make_backend(1024 * 1024)
+        backend.put("ab" * 32, b'{"a": 1}')
+        assert backend.get("ab" * 32) == b'{"a": 1}'
+        assert backend.get("cd" * 32) is None
+        backend.delete("ab" * 32)
+        assert backend.get("ab" * 32) is None
+        backend.close()
+
+    def test_evicts_least_recently_used(self):
+        data = os.urandom(1000)  # incompressible
+        backend = self.make_backend(2500)
+        backend.put("a" * 64, data)
+        backend.put("b" * 64, data)
+        # Touch the first entry, so the second one becomes the oldest
+        assert backend.get("a" * 64) == data
+        backend.put("c" * 64, data)
+        assert backend.get("a" * 64) == data
+        assert backend.get("b" * 64) is None
+        assert backend.get("c" * 64) == data
+        assert backend.size <= 2500
+        backend.close()
+
+
+class TestDirectoryCacheBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, max_size: int):
+        return DirectoryCacheBackend(self.temp_dir, max_size)
+
+    def test_size_restored(self):
+        backend = self.make_backend(1024 * 1024)
+        backend.put("ab" * 32, os.urandom(100))
+        assert self.make_backend(1024 * 1024).size == backend.size > 0
+
+    def test_evicts_in_batches(self):
+        backend = DirectoryCacheBackend(self.temp_dir, 10500, low_water=0.5)
+        for i in range(10):
+            backend.put(f"{i:02}" * 32, os.urandom(1000))
+        with patch.object(backend, "_entries", wraps=backend._entries) as entries:
+            for i in range(10, 20):
+                backend.put(f"{i:02}" * 32, os.urandom(1000))
+        # Every scan makes room for the next puts
+        assert entries.call_count <= 2
+        assert backend.size <= 10500
+        assert backend.get("19" * 32) is not None
+
+
+class TestSQLiteCacheBackend(BackendTests, unittest.TestCase):
+    def make_backend(self, max_size: int):
+        return SQLiteCacheBackend(os.path.join(self.temp_dir, "cache.sqlite"), max_size)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = ResultCache.directory(os.path.join(self.temp_dir, "cache"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_key_depends_on_content_only(self):
+        copy_path = os.path.join(self.temp_dir, "copy.wav")
+        shutil.copyfile(WAV_PATH, copy_path)
+        params = {"api": "speechkit", "language_code": "ru-RU"}
+        assert self.cache.key(WAV_PATH, params) == self.cache.key(copy_path, params)
+        assert self.cache.key(WAV_PATH, params) != self.cache.key(
+            WAV_PATH, {**params, "language_code": "en-US"}
+        )
+
+    def test_counters(self):
+        key = self.cache.key(WAV_PATH, {})
+        assert self.cache.get(key) is None
+        self.cache.put(key, RESULT)
+        assert self.cache.get(key) == RESULT
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    def test_recognition_params_ignore_token(self):
+        transcriber = Transcriber(api="whisperX", whisper_endpoint=WHISPER_ENDPOINT)
+        params = ResultCache.recognition_params(transcriber.speech_service)
+        transcriber.speech_service.whisper_endpoint = "http://other/whisperx?output=json"
+        assert params == ResultCache.recognition_params(transcriber.speech_service)
+        transcriber.speech_service.whisper_endpoint += "&diarize=%20"
+        assert params != ResultCache.recognition_params(transcriber.speech_service)
+
+    def test_recognition_params_vad(self):
+        transcriber = Transcriber(api="whisperX", whisper_endpoint=WHISPER_ENDPOINT)
+        params = ResultCache.recognition_params(transcriber.speech_service)
+        trimmed = ResultCache.recognition_params(transcriber.speech_service, VoiceDetector())
+        assert trimmed != params
+        assert trimmed != ResultCache.recognition_params(
+            transcriber.speech_service, VoiceDetector(max_silence=2.0)
+        )
+        assert trimmed == ResultCache.recognition_params(
+            transcriber.speech_service, VoiceDetector(block_frames=16)
+        )
+        assert params != ResultCache.recognition_params(
+            transcriber.speech_service, chunk_seconds=300.0
+        )
+
+    def test_transcribe_file_cached(self):
+        transcriber = Transcriber(
+            api="whisperX", whisper_endpoint=WHISPER_ENDPOINT, cache=self.cache
+        )
+        copy_path = os.path.join(self.temp_dir, "copy.wav")
+        shutil.copyfile(WAV_PATH, copy_path)
+        with requests_mock.Mocker() as m:
+            m.post(WHISPER_ENDPOINT, json=RESULT)
+            assert transcriber.transcribe_file(WAV_PATH) == RESULT
+            # Renamed copy is served from the cache
+            assert transcriber.transcribe_file(copy_path) == RESULT
+            assert m.call_count == 1
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    @pytest.mark.filterwarnings("ignore: Transcribe")
+    def test_failed_result_not_cached(self):
+        transcriber = Transcriber(
+            api="whisperX", whisper_endpoint=WHISPER_ENDPOINT, cache=self.cache
+        )
+        with requests_mock.Mocker() as m:
+            m.post(WHISPER_ENDPOINT, status_code=400)
+            assert transcriber.transcribe_file(WAV_PATH) is None
+            assert transcriber.transcribe_file(WAV_PATH) is None
+            assert m.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_transcribe_file_async_cached(tmp_path):
+    cache = ResultCache.sqlite(str(tmp_path / "cache.sqlite"))
+    transcriber = Transcriber(api="whisperX", whisper_endpoint=WHISPER_ENDPOINT, cache=cache)
+    cache.put(cache.key(WAV_PATH, cache.recognition_params(transcriber.speech_service)), RESULT)
+    # Session is closed, so any remote call would fail
+    session = aiohttp.ClientSession()
+    await session.close()
+    assert await transcriber.transcribe_file_async(WAV_PATH, session) == RESULT
+    assert cache.hits == 1
+    cache.close()
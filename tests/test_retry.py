@@ -0,0 +1,214 @@
+import unittest
+import aiohttp
+import pytest
+import requests
+import requests_mock
+from unittest.mock import AsyncMock, MagicMock, patch
+from botocore.exceptions import ClientError
+from app.speechkitty.cloud_storage import CloudStorage
+from app.speechkitty.metrics import MetricsRegistry
+from app.speechkitty.operation_poller import OperationPoller
+from app.speechkitty.pipeline import Pipeline
+from app.speechkitty.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, TransientError
+from app.speechkitty.speech_service import SpeechService
+from app.speechkitty.transcriber import Transcriber
+
+TASK_ID = "test_task_id"
+RESULT_JSON = {"done": True, "result": "text"}
+OPERATION_URL = f"{SpeechService.operation_endpoint}/{TASK_ID}"
+
+
+def speech_service(**retries):
+    return SpeechService(
+        "SpeechKit",
+        transcribe_api_key="key",
+        retries={name: RetryPolicy(base_delay=0, **kwargs) for name, kwargs in retries.items()},
+    )
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_idempotent_retried(self):
+        service = speech_service(operation={})
+        with requests_mock.Mocker() as m:
+            m.get(OPERATION_URL, [{"status_code": 503}, {"json": RESULT_JSON}])
+            assert service.get_yandex_result(TASK_ID) == RESULT_JSON
+            assert m.call_count == 2
+
+    @pytest.mark.filterwarnings("ignore: Result")
+    def test_client_error_not_retried(self):
+        service = speech_service(operation={})
+        with requests_mock.Mocker() as m:
+            m.get(OPERATION_URL, status_code=404)
+            assert service.get_yandex_result(TASK_ID) is None
+            assert m.call_count == 1
+
+    @pytest.mark.filterwarnings("ignore: Submit task")
+    def test_submit_retried_only_when_rejected(self):
+        service = speech_service(submit={"idempotent": False})
+        with requests_mock.Mocker() as m:
+            m.post(
+                service.transcribe_endpoint,
+                [{"status_code": 429}, {"json": {"id": TASK_ID}}],
+            )
+            assert service.submit_yandex_task("http://storage/test.ogg") == TASK_ID
+            assert m.call_count == 2
+        with requests_mock.Mocker() as m:
+            # Request may have reached the API, submitting again could start a second task
+            m.post(service.transcribe_endpoint, exc=requests.ReadTimeout)
+            assert service.submit_yandex_task("http://storage/test.ogg") == ""
+            assert m.call_count == 1
+
+    def test_transient_error_after_retries(self):
+        service = speech_service(submit={"idempotent": False})
+        with requests_mock.Mocker() as m:
+            m.post(service.transcribe_endpoint, status_code=503)
+            # Failure may go away, the caller is told so instead of getting an empty id
+            with self.assertRaises(TransientError) as raised:
+                service.submit_yandex_task("http://storage/test.ogg")
+            assert m.call_count == 3
+        assert isinstance(raised.exception.__cause__, requests.HTTPError)
+
+    def test_backoff(self):
+        policy = RetryPolicy(base_delay=1, max_delay=5)
+        assert all(0 <= policy.backoff(3) <= 5 for _ in range(100))
+        response = requests.Response()
+        response.status_code = 429
+        response.headers["Retry-After"] = "4"
+        error = requests.HTTPError(response=response)
+        assert policy.backoff(0, error) == 4
+
+    def test_storage_throttling_retried(self):
+        storage = CloudStorage("key", "secret", "test_bucket")
+        storage.retries["upload"] = RetryPolicy(base_delay=0)
+        client = MagicMock()
+        client.upload_file.side_effect = [
+            ClientError({"Error": {"Code": "SlowDown"}}, "PutObject"),
+            None,
+        ]
+        assert storage.upload_file("/tmp/test.ogg", client) is not None
+        assert client.upload_file.call_count == 2
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_opens_and_closes(self):
+        metrics = MetricsRegistry()
+        breaker = CircuitBreaker("submit", failure_threshold=2, reset_timeout=10, metrics=metrics)
+        breaker.record_failure()
+        breaker.check()
+        breaker.record_failure()
+        assert breaker.state == "open"
+        assert metrics.get("circuit_open", endpoint="submit") == 1
+        with self.assertRaises(CircuitOpenError) as raised:
+            breaker.check()
+        assert 9 < raised.exception.retry_in <= 10
+
+        with patch("time.monotonic", return_value=breaker._opened_at + 11):
+            assert breaker.state == "half_open"
+            # Only one trial call is let through
+            breaker.check()
+            with self.assertRaises(CircuitOpenError):
+                breaker.check()
+            breaker.record_success()
+        assert breaker.state == "closed"
+        assert metrics.get("circuit_open", endpoint="submit") == 0
+
+    def test_failed_trial_opens_again(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+        with patch("time.monotonic", return_value=breaker._opened_at + 11):
+            breaker.check()
+            breaker.record_failure()
+            assert breaker.state == "open"
+
+    @pytest.mark.filterwarnings("ignore: Result")
+    def test_answered_request_is_success(self):
+        service = speech_service(operation={})
+        service.breakers["operation"] = CircuitBreaker("operation", failure_threshold=2)
+        with requests_mock.Mocker() as m:
+            m.get(OPERATION_URL, status_code=404)
+            for _ in range(3):
+                assert service.get_yandex_result(TASK_ID) is None
+        assert service.breakers["operation"].state == "closed"
+
+    def test_retries_stop_when_open(self):
+        service = speech_service(operation={"attempts": 5})
+        service.breakers["operation"] = CircuitBreaker("operation", failure_threshold=2)
+        with requests_mock.Mocker() as m:
+            m.get(OPERATION_URL, status_code=503)
+            with self.assertRaises(CircuitOpenError):
+                service.get_yandex_result(TASK_ID)
+            # No request is sent while the circuit is open
+            with self.assertRaises(CircuitOpenError):
+                service.get_yandex_result(TASK_ID)
+            assert m.call_count == 2
+
+
+@pytest.fixture
+def transcriber():
+    t = Transcriber(
+        api="SpeechKit",
+        aws_access_key_id="test_key",
+        aws_secret_access_key="test_secret",
+        storage_bucket_name="test_bucket",
+        transcribe_api_key="test_api_key",
+    )
+    t.audio_probe.probe_async = AsyncMock()
+    t.audio_converter.to_ogg_async = AsyncMock()
+    return t
+
+
+@pytest.mark.asyncio
+async def test_pipeline_defers_files(transcriber):
+    breaker = transcriber.speech_service.breakers["submit"]
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    on_result = AsyncMock()
+    pipeline = Pipeline(transcriber, on_result=on_result)
+    await pipeline.run(["a.wav", "b.wav"], MagicMock())
+    assert pipeline.deferred == 2
+    assert pipeline.failed == 0
+    # Nothing is converted for an API that is down, and no file is marked processed
+    transcriber.audio_probe.probe_async.assert_not_called()
+    on_result.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_defers_transient_failures(transcriber):
+    transcriber.audio_probe.probe_async.return_value = MagicMock(duration_seconds=10.0, channels=1)
+    transcriber.audio_converter.to_ogg_async.return_value = "/tmp/test.ogg"
+    transcriber.cloud_storage.upload_file_async = AsyncMock(return_value="http://storage/test.ogg")
+    transcriber.cloud_storage.delete_file_async = AsyncMock()
+    transcriber.speech_service.retries["submit"].base_delay = 0
+    session = MagicMock()
+    session.post.return_value.__aenter__.side_effect = aiohttp.ClientResponseError(
+        MagicMock(), (), status=503
+    )
+    on_result = AsyncMock()
+    pipeline = Pipeline(transcriber, on_result=on_result)
+    with patch("os.unlink"):
+        await pipeline.run(["a.wav"], session)
+    assert session.post.call_count == 3
+    assert (pipeline.deferred, pipeline.failed) == (1, 0)
+    # File isn't marked processed, the next run transcribes it
+    on_result.assert_not_called()
+
+
+def test_transcribe_file_raises(transcriber):
+    transcriber.audio_probe.probe = MagicMock()
+    breaker = transcriber.cloud_storage.breaker
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        transcriber.transcribe_file("sample/records/test.wav")
+    transcriber.audio_probe.probe.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_poller_waits_for_circuit():
+    service = MagicMock()
+    service.get_yandex_result_async = AsyncMock(
+        side_effect=[CircuitOpenError("operation", 0.01), RESULT_JSON]
+    )
+    poller = OperationPoller(service)
+    assert await poller.wait(TASK_ID, MagicMock()) == RESULT_JSON
+    assert service.get_yandex_result_async.call_count == 2
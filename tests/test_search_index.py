@@ -0,0 +1,65 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import pytest
+from app.speechkitty.search_index import SearchIndex
+
+
+class TestSearchIndex(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.records = os.path.join(self.temp_dir, "records")
+        os.mkdir(self.records)
+        self.index = SearchIndex(os.path.join(self.temp_dir, "search.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.temp_dir)
+
+    def write_result(self, name: str, texts: list, mtime_ns: int = 0) -> str:
+        segments = [
+            {"start": i, "end": i + 0.5, "text": text, "speaker": f"SPEAKER_0{i % 2}"}
+            for i, text in enumerate(texts)
+        ]
+        path = os.path.join(self.records, name)
+        with open(path, "w") as f:
+            json.dump({"segments": segments}, f)
+        if mtime_ns:
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+        return path
+
+    def test_search(self):
+        path = self.write_result("a.json", ["Добрый день", "Проверка зрения, пожалуйста"])
+        self.write_result("b.json", ["проверка связи"])
+        assert self.index.update(self.records) == 2
+        hits = self.index.search("проверка зрения")
+        assert len(hits) == 1
+        assert (hits[0].json_path, hits[0].channel) == (path, "SPEAKER_01")
+        assert (hits[0].start, hits[0].end) == (1, 1.5)
+        assert len(self.index.search("ПРОВЕРКА")) == 2
+        assert self.index.search("проверка", channel="SPEAKER_00")[0].text == "проверка связи"
+        assert len(self.index.search("пров*", raw=True)) == 2
+        # Quotes and punctuation aren't query syntax
+        assert self.index.search('зрения, "пожалуйста')[0].json_path == path
+
+    def test_update_incremental(self):
+        self.write_result("a.json", ["первый звонок"])
+        assert self.index.update(self.records) == 1
+        assert self.index.update(self.records) == 0
+        # Rewritten result replaces its segments
+        self.write_result("a.json", ["второй звонок"])
+        assert self.index.update(self.records) == 1
+        assert [hit.text for hit in self.index.search("звонок")] == ["второй звонок"]
+        # Results older than the checkpoint are found by a full update only
+        self.write_result("old.json", ["старый звонок"], mtime_ns=10**18)
+        assert self.index.update(self.records) == 0
+        assert self.index.update(self.records, full=True) == 1
+        assert len(self.index.search("звонок")) == 2
+
+    @pytest.mark.filterwarnings("ignore: Index error")
+    def test_invalid_result(self):
+        with open(os.path.join(self.records, "invalid.json"), "w") as f:
+            f.write("{")
+        assert self.index.update(self.records) == 0
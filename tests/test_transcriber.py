@@ -7,6 +7,10 @@ import json
 import shutil
 import pytest
 import requests_mock
+import subprocess
+from unittest.mock import MagicMock, patch
+from app.speechkitty.audio_probe import AudioProbe
+from app.speechkitty.retry import TransientError
 from app.speechkitty.transcriber import Transcriber
 
 OGG_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.ogg"
@@ -78,6 +82,18 @@ class TestTranscriber(unittest.TestCase):
             OGG_PATH
         )
 
+    def test_to_ogg_single_ffmpeg_run(self):
+        info = AudioProbe().probe(WAV_PATH)
+        with patch("subprocess.run", wraps=subprocess.run) as run:
+            ogg_path = self.transcriber.to_ogg(WAV_PATH, info)
+        assert run.call_count == 1
+        assert AudioProbe().probe(ogg_path).codec == "opus"
+
+    def test_to_ogg_opus_remux(self):
+        info = AudioProbe().probe(OGG_PATH)
+        command = self.transcriber.audio_converter.ogg_command(OGG_PATH, "out.ogg", info)
+        assert command[command.index("-c:a") + 1] == "copy"
+
     @mock_aws
     @pytest.mark.filterwarnings("ignore: Upload")
     def test_upload_ogg_s3_fail_caught(self):
@@ -108,20 +124,58 @@ class TestTranscriber(unittest.TestCase):
         s3_resource = conn.create_bucket(Bucket="test_bucket")
         self.transcriber.delete_ogg(temp_path, s3_resource.meta.client)
 
-    @mock_aws
     def test_delete_ogg_fail_raised(self):
         self.transcriber.set_raise_exceptions(True)
-        try:
-            _ = self.transcriber.delete_ogg("")
-            assert False
-        except FileNotFoundError:
-            assert True
+        self.transcriber.cloud_storage.delete_file = MagicMock(side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            self.transcriber.delete_ogg("missing.ogg")
 
-    @mock_aws
     @pytest.mark.filterwarnings("ignore: Delete")
     def test_delete_ogg_fail_caught(self):
         self.transcriber.set_raise_exceptions(False)
-        self.transcriber.delete_ogg("")
+        self.transcriber.cloud_storage.delete_file = MagicMock(side_effect=ValueError)
+        self.transcriber.delete_ogg("missing.ogg")
+
+    @mock_aws
+    def test_delete_ogg_missing_file(self):
+        self.transcriber.set_raise_exceptions(True)
+        s3_resource = boto3.resource("s3").create_bucket(Bucket="test_bucket")
+        s3_resource.put_object(Key="test.ogg", Body=b"OggS")
+        # Temp file is gone, the object is deleted all the same
+        temp_path = self.transcriber.audio_converter.temp_dir + "/test.ogg"
+        self.transcriber.delete_ogg(temp_path, s3_resource.meta.client)
+        assert not list(s3_resource.objects.all())
+
+    @mock_aws
+    def test_convert_and_upload(self):
+        self.transcriber.stream_upload = True
+        s3_resource = boto3.resource("s3").create_bucket(Bucket="test_bucket")
+        temp_path = self.transcriber.audio_converter.temp_dir + "/" + os.path.basename(OGG_PATH)
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        file_name = os.path.basename(OGG_PATH)
+        file_link = f"{STORAGE_BASE_URL}/{STORAGE_BUCKET_NAME}/{file_name}"
+        assert file_link == self.transcriber.convert_and_upload(
+            WAV_PATH, s3_client=s3_resource.meta.client
+        )
+        assert not os.path.exists(temp_path)
+        body = s3_resource.Object(file_name).get()["Body"].read()
+        assert body.startswith(b"OggS")
+        self.transcriber.delete_ogg(file_name, s3_resource.meta.client)
+        assert not list(s3_resource.objects.all())
+
+    @mock_aws
+    @pytest.mark.filterwarnings("ignore: Convert")
+    def test_convert_and_upload_fail_caught(self):
+        self.transcriber.stream_upload = True
+        s3_resource = boto3.resource("s3").create_bucket(Bucket="test_bucket")
+        # ffmpeg fails once the upload of its output has already started
+        command = ["ffmpeg", "-loglevel", "error", "-i", WAV_PATH, "-f", "nonexistent", "-"]
+        with patch.object(self.transcriber.audio_converter, "ogg_command", return_value=command):
+            assert (
+                self.transcriber.convert_and_upload(WAV_PATH, None, s3_resource.meta.client) is None
+            )
+        assert not list(s3_resource.objects.all())
 
     def test_set_raise_exceptions(self):
         self.transcriber.set_raise_exceptions(True)
@@ -174,7 +228,6 @@ class TestTranscriber(unittest.TestCase):
         assert self.transcriber.transcribe_file(WAV_PATH, s3_resource.meta.client) is None
 
     @requests_mock.Mocker()
-    @pytest.mark.filterwarnings("ignore: Upload")
     def test_transcribe_file_no_ogg(self, m):
         self.transcriber.set_raise_exceptions(False)
         task_id = "ca9x8ew1l8g06hgdlf6r"
@@ -183,7 +236,10 @@ class TestTranscriber(unittest.TestCase):
         with open(JSON_PATH, "r") as f:
             result = f.read()
         m.get(self.transcriber.speech_service.operation_endpoint + "/" + task_id, text=result)
-        assert None is self.transcriber.transcribe_file(WAV_PATH)
+        self.transcriber.cloud_storage.retries["upload"].base_delay = 0
+        # Storage can't be reached, the file is left for a later run
+        with self.assertRaises(TransientError):
+            self.transcriber.transcribe_file(WAV_PATH)
 
     @mock_aws
     @requests_mock.Mocker()
@@ -1,6 +1,9 @@
+import asyncio
+import json
 import os
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
+from app.speechkitty.audio_probe import AudioInfo
 from app.speechkitty.transcriber import Transcriber
 
 # Constants
@@ -9,6 +12,17 @@ OGG_PATH = "sample/records/test.ogg"
 TASK_ID = "test_task_id"
 RESULT_JSON = {"done": True, "result": "text", "file_name": "test.wav"}
 WHISPER_RESULT = {"text": "whisper text"}
+CALL_ID = "rg-170-74994043564-20231021-171101-1697897360.54"
+
+
+def audio_info(duration_seconds, channels=1):
+    return AudioInfo(
+        duration_seconds=duration_seconds,
+        channels=channels,
+        sample_rate=8000,
+        codec="pcm_s16le",
+        container="wav",
+    )
 
 
 @pytest.fixture
@@ -34,15 +48,16 @@ async def test_transcribe_file_async_speechkit_success(transcriber):
     session = MagicMock()
 
     # Mock checking duration (which runs in executor)
-    with patch("pydub.AudioSegment.from_file") as mock_audio, patch("os.unlink"):
-        mock_audio.return_value.duration_seconds = 10.0
-        mock_audio.return_value.channels = 1
+    with patch("app.speechkitty.audio_probe.AudioProbe.probe") as mock_probe, patch("os.unlink"):
+        mock_probe.return_value = audio_info(10.0)
 
         result = await transcriber.transcribe_file_async(WAV_PATH, session)
 
         assert result == RESULT_JSON
 
-        transcriber.audio_converter.to_ogg_async.assert_called_once_with(WAV_PATH)
+        transcriber.audio_converter.to_ogg_async.assert_called_once_with(
+            WAV_PATH, mock_probe.return_value
+        )
         transcriber.cloud_storage.upload_file_async.assert_called_once()
         transcriber.speech_service.submit_yandex_task_async.assert_called_once()
         transcriber.speech_service.get_yandex_result_async.assert_called_once()
@@ -52,8 +67,8 @@ async def test_transcribe_file_async_speechkit_success(transcriber):
 @pytest.mark.asyncio
 async def test_transcribe_file_async_short_audio(transcriber):
     session = MagicMock()
-    with patch("pydub.AudioSegment.from_file") as mock_audio:
-        mock_audio.return_value.duration_seconds = 0.5  # Too short
+    with patch("app.speechkitty.audio_probe.AudioProbe.probe") as mock_probe:
+        mock_probe.return_value = audio_info(0.5)  # Too short
 
         result = await transcriber.transcribe_file_async(WAV_PATH, session)
         assert result is None
@@ -73,8 +88,8 @@ async def test_transcribe_file_async_whisper(transcriber):
 
     session = MagicMock()
 
-    with patch("pydub.AudioSegment.from_file") as mock_audio:
-        mock_audio.return_value.duration_seconds = 10.0
+    with patch("app.speechkitty.audio_probe.AudioProbe.probe") as mock_probe:
+        mock_probe.return_value = audio_info(10.0)
 
         result = await transcriber.transcribe_file_async(WAV_PATH, session)
 
@@ -99,11 +114,98 @@ async def test_transcribe_file_async_webhook(transcriber):
     post_ctx.__aexit__ = AsyncMock(return_value=None)
     session.post.return_value = post_ctx
 
-    with patch("pydub.AudioSegment.from_file") as mock_audio, patch("os.unlink"):
-        mock_audio.return_value.duration_seconds = 10.0
-        mock_audio.return_value.channels = 1
+    with patch("app.speechkitty.audio_probe.AudioProbe.probe") as mock_probe, patch("os.unlink"):
+        mock_probe.return_value = audio_info(10.0)
 
         result = await transcriber.transcribe_file_async(WAV_PATH, session)
 
         assert result == RESULT_JSON
         session.post.assert_called_once_with("http://webhook.url", json=RESULT_JSON)
+
+
+@pytest.mark.asyncio
+async def test_transcribe_file_async_releases_semaphore(transcriber):
+    session = MagicMock()
+    semaphore = asyncio.Semaphore(1)
+    waiting = asyncio.Event()
+
+    async def wait(id, session, delay):
+        # Slot must be free while the result is awaited
+        assert not semaphore.locked()
+        waiting.set()
+        return RESULT_JSON
+
+    transcriber.poller.wait = wait
+    with patch("app.speechkitty.audio_probe.AudioProbe.probe") as mock_probe, patch("os.unlink"):
+        mock_probe.return_value = audio_info(10.0)
+        result = await transcriber.transcribe_file_async(WAV_PATH, session, semaphore=semaphore)
+
+    assert result == RESULT_JSON
+    assert waiting.is_set()
+
+
+@pytest.mark.asyncio
+async def test_transcribe_pair_async_speechkit_stereo(transcriber, tmp_path):
+    legs = [f"sample/records/{CALL_ID}.wav-in.wav", f"sample/records/{CALL_ID}.wav-out.wav"]
+    record_path = str(tmp_path / "call.wav")
+    uploaded = []
+
+    def upload_stream(fileobj, key, s3_client=None):
+        uploaded.append((key, fileobj.read()))
+        return "http://storage/call.ogg"
+
+    transcriber.cloud_storage.upload_stream = upload_stream
+    transcriber.transcribe_file_async = AsyncMock()
+    delays = []
+
+    async def wait(id, session, delay):
+        delays.append(delay)
+        return {"response": {"chunks": [{"channelTag": "1"}, {"channelTag": "2"}]}}
+
+    transcriber.poller.wait = wait
+    result = await transcriber.transcribe_pair_async(
+        *legs, MagicMock(), record_path=record_path, speakers=("client", "operator")
+    )
+
+    # Legs are sent as one stereo record
+    transcriber.transcribe_file_async.assert_not_called()
+    assert [(key, data[:4]) for key, data in uploaded] == [("call.ogg", b"OggS")]
+    transcriber.speech_service.submit_yandex_task_async.assert_called_once()
+    assert delays == [pytest.approx(50.2 * 2 / 6, abs=0.01)]
+    transcriber.cloud_storage.delete_file_async.assert_called_once_with("call.ogg", None)
+    assert [chunk["channelTag"] for chunk in result["response"]["chunks"]] == [
+        "client",
+        "operator",
+    ]
+    with open(tmp_path / "call.json") as f:
+        assert json.load(f) == result
+
+
+@pytest.mark.asyncio
+async def test_transcribe_pair_async_speechkit_one_webhook(transcriber, tmp_path):
+    transcriber.webhook_url = "http://webhook.url"
+    session = MagicMock()
+    post_ctx = MagicMock()
+    post_ctx.__aenter__ = AsyncMock(return_value=MagicMock())
+    post_ctx.__aexit__ = AsyncMock(return_value=None)
+    session.post.return_value = post_ctx
+    words = [{"startTime": "0s", "endTime": "1s", "word": "a"}]
+    transcriber.speech_service.get_yandex_result_async = AsyncMock(
+        side_effect=lambda id, session: {
+            "done": True,
+            "response": {"chunks": [{"alternatives": [{"words": words}], "channelTag": "1"}]},
+        }
+    )
+    # Legs that can't be read for interleaving are transcribed one by one
+    legs = [str(tmp_path / "call.wav-in.wav"), str(tmp_path / "call.wav-out.wav")]
+    with patch("app.speechkitty.audio_probe.AudioProbe.probe") as mock_probe, patch("os.unlink"):
+        mock_probe.return_value = audio_info(10.0)
+        result = await transcriber.transcribe_pair_async(
+            *legs, session, record_path=str(tmp_path / "call.wav")
+        )
+
+    assert len(result["response"]["chunks"]) == 2
+    # Only the merged result of the call is sent
+    session.post.assert_called_once_with(
+        "http://webhook.url", json=dict(result, file_name="call.wav")
+    )
@@ -1,9 +1,12 @@
+import asyncio
 import os
+import time
 import unittest
 import json
 import pytest
 import requests_mock
-from app.speechkitty.transcriber import Transcriber
+from unittest.mock import MagicMock
+from app.speechkitty.transcriber import Transcriber, merge_legs
 
 OGG_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.ogg"
 WAV_PATH = "sample/records/rg-170-74994043564-20231021-171101-1697897360.54.wav"
@@ -71,3 +74,61 @@ class TestTranscriber(unittest.TestCase):
     def test_transcribe_file_no_wav_caught(self, m):
         self.transcriber.set_raise_exceptions(False)
         assert None is self.transcriber.transcribe_file(WAV_PATH + "nonexistent")
+
+
+def whisper_result(*starts):
+    return {"segments": [{"start": s, "end": s + 1, "text": str(s), "words": [{}]} for s in starts]}
+
+
+@pytest.mark.asyncio
+async def test_transcribe_pair_async(tmp_path):
+    transcriber = Transcriber(api="whisperX", whisper_endpoint=WHISPER_ENDPOINT)
+    results = {"in.wav": whisper_result(0, 2, 4), "out.wav": whisper_result(1, 3)}
+
+    async def transcribe_file_async(wav_path, session, s3_client=None, webhook=True):
+        await asyncio.sleep(0.2)
+        return results[os.path.basename(wav_path)]
+
+    transcriber.transcribe_file_async = transcribe_file_async
+    legs = [str(tmp_path / "in.wav"), str(tmp_path / "out.wav")]
+    start = time.monotonic()
+    result = await transcriber.transcribe_pair_async(
+        *legs, MagicMock(), record_path=str(tmp_path / "call.wav")
+    )
+    # Legs are transcribed at the same time
+    assert time.monotonic() - start < 0.35
+    assert [s["start"] for s in result["segments"]] == [0, 1, 2, 3, 4]
+    assert [s["speaker"] for s in result["segments"]] == ["1", "2", "1", "2", "1"]
+    assert result["segments"][1]["words"][0]["speaker"] == "2"
+    with open(tmp_path / "call.json") as f:
+        assert json.load(f) == result
+    with open(tmp_path / "out.json") as f:
+        assert json.load(f) == results["out.wav"]
+
+
+@pytest.mark.asyncio
+async def test_transcribe_pair_async_missing_leg(tmp_path):
+    transcriber = Transcriber(api="whisperX", whisper_endpoint=WHISPER_ENDPOINT)
+
+    async def transcribe_file_async(wav_path, session, s3_client=None, webhook=True):
+        return None
+
+    transcriber.transcribe_file_async = transcribe_file_async
+    record_path = str(tmp_path / "call.wav")
+    leg = str(tmp_path / "in.wav")
+    assert (
+        await transcriber.transcribe_pair_async(leg, None, MagicMock(), None, record_path) is None
+    )
+    # Empty jsons mark the files as processed
+    assert os.path.getsize(tmp_path / "in.json") == os.path.getsize(tmp_path / "call.json") == 0
+
+
+def test_merge_legs_speechkit():
+    def chunk(start):
+        words = [{"startTime": f"{start}s", "endTime": f"{start + 1}s", "word": "a"}]
+        return {"alternatives": [{"words": words, "text": "a"}], "channelTag": "1"}
+
+    left = {"done": True, "response": {"chunks": [chunk(0), chunk(10)]}}
+    right = {"done": True, "response": {"chunks": [chunk(5)]}}
+    merged = merge_legs([left, right], ["1", "2"])
+    assert [c["channelTag"] for c in merged["response"]["chunks"]] == ["1", "2", "1"]
@@ -0,0 +1,104 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import pytest
+from app.speechkitty.result_parser import Parser
+
+pytest.importorskip("pyarrow")
+
+from app.speechkitty.transcript_store import TranscriptStore  # noqa: E402
+
+PATH = "sample/records"
+CALL_ID = "rg-170-74994043564-20231021-171101-1697897360.54"
+
+
+def day(n: int) -> datetime.date:
+    return datetime.date(2023, 10, n)
+
+
+class TestTranscriptStore(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store = TranscriptStore(os.path.join(self.temp_dir, "store"))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_result(self, name: str, segments: list) -> str:
+        path = os.path.join(self.temp_dir, name)
+        with open(path, "w") as f:
+            json.dump({"segments": segments}, f)
+        return path
+
+    def test_ingest_directory(self):
+        assert self.store.ingest_directory(PATH, date_of=lambda path: day(21)) == 2
+        # Results already in the store are skipped
+        assert self.store.ingest_directory(PATH) == 0
+
+        with open(f"{PATH}/{CALL_ID}.json") as f:
+            df = Parser().parse_result(json.load(f))
+        segments = self.store.segments(call_ids=[CALL_ID]).to_pandas()
+        assert segments["start"].tolist() == df["startTime"].tolist()
+        assert segments["text"].tolist() == df["text"].tolist()
+        assert set(segments["channel"]) == {str(c) for c in df["channelTag"]}
+
+        calls = self.store.calls().to_pandas().set_index("call_id")
+        assert calls.loc[CALL_ID, "api"] == "SpeechKit"
+        assert calls.loc[CALL_ID + ".whisper", "api"] == "whisperX"
+        assert calls.loc[CALL_ID, "segments"] == len(df)
+        assert set(calls["date"]) == {"2023-10-21"}
+
+    def test_filter_by_date(self):
+        for n in (20, 21, 22):
+            path = self.write_result(f"call{n}.json", [{"start": 0, "end": 1, "text": str(n)}])
+            self.store.ingest([path], date_of=lambda path, n=n: day(n))
+        segments = self.store.segments(start_date=day(21), end_date=day(22))
+        assert sorted(segments.column("text").to_pylist()) == ["21", "22"]
+        assert self.store.calls(end_date=day(20)).column("call_id").to_pylist() == ["call20"]
+
+    def test_iter_results(self):
+        segments = [
+            {"start": 1.5, "end": 2.0, "text": "b", "speaker": "SPEAKER_01"},
+            {"start": 0.0, "end": 1.0, "text": "a", "speaker": "SPEAKER_00"},
+        ]
+        path = self.write_result("call.json", segments)
+        self.store.ingest([path])
+        results = list(self.store.iter_results())
+        assert results == [("call", {"segments": sorted(segments, key=lambda s: s["start"])})]
+
+    def test_empty_and_invalid(self):
+        assert self.store.segments().num_rows == 0
+        assert self.store.calls(columns=["call_id"]).column_names == ["call_id"]
+        empty = self.write_result("empty.json", [])
+        invalid = os.path.join(self.temp_dir, "invalid.json")
+        with open(invalid, "w") as f:
+            f.write("{")
+        with pytest.warns(UserWarning, match="Ingest error"):
+            assert self.store.ingest([empty, invalid]) == 1
+        assert self.store.calls().column("segments").to_pylist() == [0]
+
+    def test_empty_marker(self):
+        # Records without result are marked as processed with an empty json
+        marker = os.path.join(self.temp_dir, "marker.json")
+        open(marker, "w").close()
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            assert self.store.ingest_directory(self.temp_dir) == 1
+            assert self.store.ingest_directory(self.temp_dir) == 0
+        calls = self.store.calls(columns=["call_id", "api", "segments"]).to_pylist()
+        assert calls == [{"call_id": "marker", "api": "", "segments": 0}]
+        assert list(self.store.iter_results()) == []
+
+    def test_compact(self):
+        for n in range(3):
+            path = self.write_result(f"call{n}.json", [{"start": n, "end": n + 1, "text": "a"}])
+            self.store.ingest([path], date_of=lambda path: day(21))
+        before = self.store.segments().sort_by("call_id")
+        assert self.store.compact() == 1
+        assert len(self.store._dataset("segments").files) == 1
+        assert self.store.segments().sort_by("call_id").equals(before)
+        assert self.store.compact() == 0
@@ -0,0 +1,271 @@
+import asyncio
+import os
+import wave
+import aiohttp
+import numpy as np
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from app.speechkitty.audio_converter import AudioConverter
+from app.speechkitty.result_parser import Parser
+from app.speechkitty.transcriber import Transcriber
+from app.speechkitty.vad import RESULT_KEY, OffsetMap, VoiceDetector
+
+RATE = 8000
+
+
+def signal(*parts) -> np.ndarray:
+    """Mono int16 samples of (seconds, is_speech) parts: a tone for speech, faint noise
+    otherwise"""
+    rng = np.random.default_rng(0)
+    samples = []
+    for seconds, speech in parts:
+        t = np.arange(int(seconds * RATE)) / RATE
+        part = rng.normal(0, 30, len(t))
+        if speech:
+            part += 8000 * np.sin(2 * np.pi * 300 * t)
+        samples.append(part)
+    return np.concatenate(samples).astype(np.int16)
+
+
+def write_wav(path, samples: np.ndarray) -> str:
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(RATE)
+        f.writeframes(samples.tobytes())
+    return str(path)
+
+
+def seconds(regions):
+    return [(start / RATE, stop / RATE) for start, stop in regions]
+
+
+def test_detect_trims_edges():
+    samples = signal((3, False), (2, True), (4, False), (1, True), (2, False))
+    regions = VoiceDetector(padding=0.3).detect(samples, RATE)
+    assert seconds(regions) == [pytest.approx((2.7, 10.3), abs=0.04)]
+
+
+def test_detect_compresses_silence():
+    samples = signal((3, False), (2, True), (4, False), (1, True), (2, False))
+    regions = VoiceDetector(padding=0.3, max_silence=2.0).detect(samples, RATE)
+    assert seconds(regions) == [
+        pytest.approx((2.7, 5.3), abs=0.04),
+        pytest.approx((8.7, 10.3), abs=0.04),
+    ]
+    # Pauses up to max_silence are kept
+    regions = VoiceDetector(padding=0.3, max_silence=4.0).detect(samples, RATE)
+    assert len(regions) == 1
+
+
+def test_detect_no_speech():
+    detector = VoiceDetector()
+    assert detector.detect(signal((5, False)), RATE) == []
+    assert detector.detect(np.zeros(RATE * 5, np.int16), RATE) == []
+    assert detector.detect(np.zeros(0, np.int16), RATE) == []
+    # Clicks shorter than min_speech aren't speech
+    assert detector.detect(signal((2, False), (0.1, True), (2, False)), RATE) == []
+
+
+def test_offset_map():
+    speech = OffsetMap([(2.0, 5.0), (10.0, 12.0)])
+    assert speech.duration == 5.0
+    assert speech.to_original(0.5) == 2.5
+    assert speech.to_original(4.0) == 11.0
+    # Border of the regions
+    assert speech.to_original(3.0) == 10.0
+    assert speech.to_original(3.0, end=True) == 5.0
+    assert OffsetMap.from_frames([(8000, 16000)], RATE).regions == [(1.0, 2.0)]
+    assert OffsetMap.from_result({"segments": []}) is None
+
+
+def test_restore():
+    speech = OffsetMap([(2.0, 5.0), (10.0, 12.0)])
+    whisper = speech.attach(
+        {"segments": [{"start": 0.5, "end": 3.0, "words": [{"start": 3.5, "end": 4.0}]}]}
+    )
+    assert OffsetMap.from_result(whisper).regions == speech.regions
+    speech.restore(whisper)
+    assert RESULT_KEY not in whisper
+    assert whisper["segments"] == [
+        {"start": 2.5, "end": 5.0, "words": [{"start": 10.5, "end": 11.0}]}
+    ]
+    words = [{"startTime": "0.500s", "endTime": "3.500s"}]
+    speechkit = {"response": {"chunks": [{"alternatives": [{"words": words}]}]}}
+    speech.restore(speechkit)
+    assert words == [{"startTime": "2.500s", "endTime": "10.500s"}]
+
+
+def test_parser_restores_times():
+    result = OffsetMap([(2.0, 5.0), (10.0, 12.0)]).attach(
+        {
+            "segments": [
+                {"start": 0.5, "end": 1.0, "text": "a", "speaker": "1"},
+                {"start": 3.5, "end": 4.0, "text": "b", "speaker": "1"},
+            ]
+        }
+    )
+    parser = Parser()
+    segments = parser.parse_segments(result)
+    assert [(s.start, s.end) for s in segments] == [(2.5, 3.0), (10.5, 11.0)]
+    df = parser.parse_result(result)
+    assert df["startTime"].tolist() == [2.5, 10.5]
+    assert df["endTime"].tolist() == [3.0, 11.0]
+
+
+def test_converter_trims(tmp_path):
+    converter = AudioConverter(raise_exceptions=True)
+    converter.temp_dir = str(tmp_path)
+    samples = signal((3, False), (2, True), (4, False), (1, True), (2, False))
+    wav_path = write_wav(tmp_path / "call.wav", samples)
+    speech = converter.detect_speech(wav_path, VoiceDetector(max_silence=2.0))
+    assert speech.duration == pytest.approx(4.2, abs=0.08)
+
+    trimmed = converter.trim(wav_path, speech)
+    assert trimmed == str(tmp_path / "call.speech.wav")
+    with wave.open(trimmed) as f:
+        frames = np.frombuffer(f.readframes(f.getnframes()), np.int16)
+    kept = np.concatenate([samples[start:stop] for start, stop in speech.frames(RATE)])
+    assert np.array_equal(frames, kept)
+
+    ogg_path = converter.to_ogg(wav_path, speech=speech)
+    info = converter.audio_probe.probe(ogg_path)
+    assert (info.codec, info.channels) == ("opus", 1)
+    assert info.duration_seconds == pytest.approx(speech.duration, abs=0.05)
+
+    # Other records are sent as they are
+    assert converter.detect_speech(ogg_path, VoiceDetector()) is None
+
+
+@pytest.mark.asyncio
+async def test_transcribe_file_async_whisper(tmp_path):
+    transcriber = Transcriber(
+        api="whisperX", whisper_endpoint="http://whisper", vad=VoiceDetector(max_silence=2.0)
+    )
+    transcriber.audio_converter.temp_dir = str(tmp_path)
+    sent = []
+
+    async def transcribe_whisper_async(wav_path, session):
+        sent.append(transcriber.audio_probe.probe(wav_path).duration_seconds)
+        return {"segments": [{"start": 3.0, "end": 3.5, "text": "b", "speaker": "1"}]}
+
+    transcriber.transcribe_whisper_async = transcribe_whisper_async
+    wav_path = write_wav(
+        tmp_path / "call.wav", signal((3, False), (2, True), (4, False), (1, True), (2, False))
+    )
+    result = await transcriber.transcribe_file_async(wav_path, MagicMock())
+    assert sent == [pytest.approx(4.2, abs=0.08)]
+    (first_start, first_end), (second_start, _) = result[RESULT_KEY]
+    # Segment is in the second region of the record
+    start = second_start + 3.0 - (first_end - first_start)
+    assert [s.start for s in Parser().parse_segments(result)] == [start]
+    # Trimmed record is removed
+    assert os.listdir(tmp_path) == ["call.wav"]
+
+    # Records without speech are skipped
+    silent = write_wav(tmp_path / "silent.wav", signal((5, False)))
+    assert await transcriber.transcribe_file_async(silent, MagicMock()) is None
+    assert len(sent) == 1
+
+
+@pytest.mark.asyncio
+async def test_webhook_restores_times():
+    transcriber = Transcriber(
+        api="whisperX", whisper_endpoint="http://whisper", webhook_url="http://webhook"
+    )
+    transcriber._post_webhook = AsyncMock()
+    words = [{"startTime": "0.500s", "endTime": "3.500s"}]
+    result = OffsetMap([(2.0, 5.0), (10.0, 12.0)]).attach(
+        {"response": {"chunks": [{"alternatives": [{"words": words}]}]}}
+    )
+    await transcriber.send_webhook_async(result, MagicMock(), file_name="call.wav")
+    payload = transcriber._post_webhook.call_args.args[0]
+    assert RESULT_KEY not in payload
+    assert payload["file_name"] == "call.wav"
+    chunk = payload["response"]["chunks"][0]
+    assert chunk["alternatives"][0]["words"] == [{"startTime": "2.500s", "endTime": "10.500s"}]
+    # Result is left as it was
+    assert RESULT_KEY in result
+    assert words == [{"startTime": "0.500s", "endTime": "3.500s"}]
+
+
+def test_cut_points():
+    # Two seconds of speech after every pause of half a second
+    samples = signal(*[(0.5, False), (2.0, True)] * 8)
+    cuts = VoiceDetector().cut_points(samples, RATE, chunk_seconds=5.0)
+    assert len(cuts) == 3
+    for cut in cuts:
+        # Every cut is in a pause
+        assert (cut / RATE) % 2.5 < 0.5
+    assert VoiceDetector().cut_points(samples, RATE, chunk_seconds=20.0) == []
+
+
+def test_offset_map_slice():
+    speech = OffsetMap([(2.0, 5.0), (10.0, 12.0)])
+    assert speech.slice(4.0, 11.0).regions == [(4.0, 5.0), (10.0, 11.0)]
+    assert speech.slice(6.0, 9.0).regions == []
+
+
+@pytest.mark.asyncio
+async def test_transcribe_chunks(tmp_path):
+    transcriber = Transcriber(
+        api="whisperX", whisper_endpoint="http://whisper", chunk_seconds=5.0, chunk_workers=2
+    )
+    transcriber.audio_converter.temp_dir = str(tmp_path)
+    transcriber.speech_service.retries["whisper"].base_delay = 0
+    running = []
+    calls = []
+
+    async def transcribe_whisper_async(wav_path, session):
+        name = os.path.basename(wav_path)
+        calls.append(name)
+        running.append(name)
+        await asyncio.sleep(0.05)
+        assert len(running) <= 2
+        running.remove(name)
+        # Second chunk fails once and is retried alone
+        if name == "call.chunk1.wav" and calls.count(name) == 1:
+            raise aiohttp.ServerDisconnectedError()
+        return {
+            "segments": [{"start": 0.1, "end": 0.5, "text": name, "speaker": "1"}],
+            "language": "ru",
+        }
+
+    transcriber.speech_service._transcribe_start_whisper_async = transcribe_whisper_async
+    wav_path = write_wav(tmp_path / "call.wav", signal(*[(0.5, False), (2.0, True)] * 8))
+    result = await transcriber.transcribe_speech_async(wav_path, MagicMock())
+
+    chunks = transcriber.split(wav_path)
+    assert len(chunks) == 4
+    assert sorted(calls) == sorted([f"call.chunk{i}.wav" for i in range(4)] + ["call.chunk1.wav"])
+    assert result["language"] == "ru"
+    df = Parser().parse_result(result)
+    assert df["text"].tolist() == [f"call.chunk{i}.wav" for i in range(4)]
+    assert df["startTime"].tolist() == [chunk.regions[0][0] + 0.1 for chunk in chunks]
+    # Chunks are removed
+    assert os.listdir(tmp_path) == ["call.wav"]
+
+
+@pytest.mark.filterwarnings("ignore: Transcribe")
+def test_transcribe_chunks_sync(tmp_path):
+    transcriber = Transcriber(
+        api="whisperX", whisper_endpoint="http://whisper", chunk_seconds=5.0, chunk_workers=2
+    )
+    transcriber.audio_converter.temp_dir = str(tmp_path)
+    calls = []
+
+    def transcribe_whisper(wav_path):
+        calls.append(os.path.basename(wav_path))
+        return {"segments": [{"start": 0.1, "end": 0.5, "text": calls[-1], "speaker": "1"}]}
+
+    transcriber.transcribe_whisper = transcribe_whisper
+    wav_path = write_wav(tmp_path / "call.wav", signal(*[(0.5, False), (2.0, True)] * 8))
+    df = Parser().parse_result(transcriber.transcribe_speech(wav_path))
+    assert calls == [f"call.chunk{i}.wav" for i in range(4)]
+    assert df["text"].tolist() == calls
+    assert os.listdir(tmp_path) == ["call.wav"]
+
+    # Record is incomplete without a chunk
+    transcriber.transcribe_whisper = lambda wav_path: None
+    assert transcriber.transcribe_speech(wav_path) is None
+    assert os.listdir(tmp_path) == ["call.wav"]